@@ -0,0 +1,466 @@
+"""Micro-benchmarks for the segmentation and I/O hot paths
+
+Each case runs in its own process under the offscreen Qt platform, so peak memory is measured per case. Results can
+be saved as json, and a later run on the same machine compared against them, e.g. before and after a change
+
+    python benchmarks/run_benchmarks.py --quick --output baseline.json
+    python benchmarks/run_benchmarks.py --quick --output results.json --baseline baseline.json
+
+Exits with status 1 if any case is slower or uses more memory than the baseline by more than --threshold.
+
+With --check-seams, tiled GrabCut is compared against GrabCut solved in one piece with the same colour models
+instead, and it exits with status 1 if they disagree on more than --seam-threshold of the pixels near the seams.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+import numpy as np
+
+from src.Engines import ENGINES
+from src.GrabCut import grabcut_tiled
+from src.Masks import BACKGROUND, FOREGROUND, MASK_FORMATS, POSSIBLE_FOREGROUND, write_mask
+
+MEGAPIXELS = [1, 12, 50]
+FOLDER_SIZES = [100, 1000, 10000, 50000]
+QUICK_MEGAPIXELS = [1]
+QUICK_FOLDER_SIZES = [100, 1000]
+
+_app = None
+_temp_dirs = []
+
+
+@atexit.register
+def _remove_temp_dirs():
+    for folder in _temp_dirs:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def temp_dir():
+    folder = tempfile.mkdtemp(prefix='segmenter_bench_')
+    _temp_dirs.append(folder)
+    return folder
+
+
+def qt_app():
+    global _app
+    from PySide2.QtWidgets import QApplication
+    if _app is None:
+        _app = QApplication.instance() or QApplication([])
+    return _app
+
+
+def image_size(megapixels):
+    """(width, height) of a 4:3 image with about this many megapixels"""
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    return height * 4 // 3, height
+
+
+def synthetic_image(megapixels, seed=0):
+    """A noisy BGR image of an ellipse on a background, with a class mask of strokes marking both"""
+    width, height = image_size(megapixels)
+    rng = np.random.RandomState(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (60, 110, 40)
+    center, axes = (width // 2, height // 2), (width // 4, height // 3)
+    cv2.ellipse(image, center, axes, 0, 0, 360, (170, 90, 200), -1)
+    image = cv2.add(image, rng.randint(0, 40, size=image.shape, dtype=np.uint8))
+    seeds = np.zeros((height, width), dtype=np.uint8)
+    thickness = max(2, width // 100)
+    cv2.ellipse(seeds, center, (axes[0] // 2, axes[1] // 2), 0, 0, 360, FOREGROUND, thickness)
+    cv2.ellipse(seeds, center, (int(axes[0] * 1.1), int(axes[1] * 1.1)), 0, 0, 360, POSSIBLE_FOREGROUND, thickness)
+    cv2.rectangle(seeds, (0, 0), (width - 1, height - 1), BACKGROUND, thickness)
+    return image, seeds
+
+
+def synthetic_folder(num_files):
+    """A temporary folder of num_files tiny pngs and jpegs. Returns its path"""
+    folder = temp_dir()
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    encoded = {ext: cv2.imencode(ext, image)[1].tobytes() for ext in ['.png', '.jpg']}
+    for idx in range(num_files):
+        ext = '.png' if idx % 2 == 0 else '.jpg'
+        with open(os.path.join(folder, 'image{:06d}{}'.format(idx, ext)), 'wb') as f:
+            f.write(encoded[ext])
+    return folder
+
+
+def bench_segment(engine, megapixels):
+    image, seeds = synthetic_image(megapixels)
+    options = {}
+    if ENGINES[engine].uses_superpixels:
+        # Computed in the background when an image is opened, so only the graph solve is timed here
+        from src.Superpixels import Superpixels
+        options['superpixels'] = Superpixels.compute(image)
+
+    def run():
+        ENGINES[engine].segment(image, seeds, **options)
+    return run
+
+
+def bench_grabcut_tiled(processes, megapixels):
+    image, seeds = synthetic_image(megapixels)
+
+    def run():
+        grabcut_tiled(image, seeds, processes=processes)
+    return run
+
+
+def bench_autotune_calibrate():
+    from src.AutoTune import calibrate
+
+    def run():
+        calibrate()
+    return run
+
+
+def bench_superpixels(megapixels):
+    from src.Superpixels import Superpixels
+    image, _ = synthetic_image(megapixels)
+
+    def run():
+        Superpixels.compute(image)
+    return run
+
+
+def bench_qimage_to_bgr(megapixels):
+    qt_app()
+    from PySide2.QtGui import QImage
+    from src.Conversions import qimage_to_bgr
+    width, height = image_size(megapixels)
+    image = QImage(width, height, QImage.Format_RGB32)
+    image.fill(0xff336699)
+
+    def run():
+        qimage_to_bgr(image)
+    return run
+
+
+def _view(megapixels):
+    qt_app()
+    from PySide2.QtCore import QPointF
+    from PySide2.QtGui import QPixmap
+    from src.SegmenterView import ImageSegmenterView
+    view = ImageSegmenterView(None)
+    view.resize(1000, 800)
+    width, height = image_size(megapixels)
+    pixmap = QPixmap(width, height)
+    pixmap.fill()
+    view.setPhoto(pixmap)
+    view.set_pen_size(30)
+    points = [view.mapFromScene(QPointF(width * (0.1 + 0.8 * idx / 49.0), height * (0.3 + 0.4 * (idx % 2))))
+              for idx in range(50)]
+
+    def stroke():
+        view.save_state()
+        for point in points:
+            view.paint_point(point)
+        view.prev_point = None
+        view.history.commit()
+    return view, stroke
+
+
+def bench_view_stroke(megapixels):
+    view, stroke = _view(megapixels)
+    return stroke
+
+
+def bench_view_undo_redo(megapixels):
+    view, stroke = _view(megapixels)
+    stroke()
+
+    def run():
+        view.undo()
+        view.redo()
+    return run
+
+
+def bench_save_mask(mask_format, megapixels):
+    _, seeds = synthetic_image(megapixels)
+    folder = temp_dir()
+    path = os.path.join(folder, 'image_label.png')
+
+    def run():
+        write_mask(path, seeds, mask_format)
+    return run
+
+
+def mask_folder(num_files, megapixels=0.25):
+    """Folder of num_files png masks, with a mask store of the same masks"""
+    from src.MaskStore import MaskStore
+    _, seeds = synthetic_image(megapixels)
+    folder = temp_dir()
+    for idx in range(num_files):
+        write_mask(os.path.join(folder, 'image{:06d}_label.png'.format(idx)), seeds)
+    MaskStore.for_label_dir(folder).sync_pngs(folder)
+    return folder
+
+
+def bench_read_masks(num_files, from_store):
+    from src.Masks import read_mask
+    from src.MaskStore import MaskStore
+    folder = mask_folder(num_files)
+
+    def run():
+        if from_store:
+            store = MaskStore.for_label_dir(folder)
+            for name in store.names():
+                np.count_nonzero(store.get(name))
+        else:
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('_label.png'):
+                    np.count_nonzero(read_mask(os.path.join(folder, name)))
+    return run
+
+
+def bench_export(export_format, num_files, megapixels=0.25):
+    from src.Export import run_export
+    from src.LabelIndex import label_folder
+    image, seeds = synthetic_image(megapixels)
+    encoded = cv2.imencode('.jpg', image)[1].tobytes()
+    root = temp_dir()
+    image_dir = os.path.join(root, 'images')
+    label_dir = label_folder(root, 'Foot')
+    os.makedirs(image_dir)
+    os.makedirs(label_dir)
+    for idx in range(num_files):
+        with open(os.path.join(image_dir, 'image{:06d}.jpg'.format(idx)), 'wb') as f:
+            f.write(encoded)
+        write_mask(os.path.join(label_dir, 'image{:06d}_label.png'.format(idx)), seeds)
+
+    def run():
+        output_dir = os.path.join(root, 'export')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        run_export(image_dir, root, output_dir, export_format=export_format, allow_missing=True, log=lambda message: None)
+    return run
+
+
+def bench_thumbnails(num_files, megapixels=2):
+    from src.Thumbnails import make_thumbnail, thumbnail_path
+    image, _ = synthetic_image(megapixels)
+    encoded = cv2.imencode('.jpg', image)[1].tobytes()
+    root = temp_dir()
+    paths = []
+    for idx in range(num_files):
+        paths.append(os.path.join(root, 'image{:06d}.jpg'.format(idx)))
+        with open(paths[-1], 'wb') as f:
+            f.write(encoded)
+    cache_dir = os.path.join(root, 'thumbnails')
+
+    def run():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for path in paths:
+            make_thumbnail((path, thumbnail_path(cache_dir, path, 96), 96))
+    return run
+
+
+def bench_directory_scan(num_files, warm):
+    from src.Manifest import DirectoryManifest, MANIFEST_NAME
+    from src.Workers import DirectoryScanner
+    folder = synthetic_folder(num_files)
+    if warm:
+        DirectoryScanner(DirectoryManifest(folder)).run()
+
+    def run():
+        if not warm and os.path.exists(os.path.join(folder, MANIFEST_NAME)):
+            os.remove(os.path.join(folder, MANIFEST_NAME))
+        manifest = DirectoryManifest(folder).load()
+        if not manifest.is_current():
+            DirectoryScanner(manifest).run()
+    return run
+
+
+def tiled_processes():
+    """1, 2, 4, ... processes up to the number of cores, to show how tiled GrabCut scales"""
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    if counts[-1] != (os.cpu_count() or 1):
+        counts.append(os.cpu_count())
+    return counts
+
+
+def check_seams(megapixels, tile_size=512, overlap=32):
+    """Fraction of the pixels within overlap of a tile seam, and of all pixels, where tiled GrabCut disagrees with
+    GrabCut solved as a single tile"""
+    image, seeds = synthetic_image(megapixels)
+    height, width = seeds.shape
+    # The colour models come from the same coarse pass in both, which starts from OpenCV's random number generator
+    cv2.setRNGSeed(0)
+    tiled = grabcut_tiled(image, seeds, tile_size=tile_size, overlap=overlap)
+    cv2.setRNGSeed(0)
+    single = grabcut_tiled(image, seeds, tile_size=max(height, width), processes=1)
+    differs = np.isin(tiled, [FOREGROUND, POSSIBLE_FOREGROUND]) != np.isin(single, [FOREGROUND, POSSIBLE_FOREGROUND])
+    near_seams = np.zeros((height, width), dtype=bool)
+    for seam in range(tile_size, width, tile_size):
+        near_seams[:, max(0, seam - overlap):seam + overlap] = True
+    for seam in range(tile_size, height, tile_size):
+        near_seams[max(0, seam - overlap):seam + overlap, :] = True
+    return differs[near_seams].mean() if near_seams.any() else 0.0, differs.mean()
+
+
+def cases(quick=False):
+    """Map of case name to (setup function, arguments). Setup returns the callable that is timed"""
+    megapixels = QUICK_MEGAPIXELS if quick else MEGAPIXELS
+    folder_sizes = QUICK_FOLDER_SIZES if quick else FOLDER_SIZES
+    registry = {}
+    for mp in megapixels:
+        for engine in ENGINES:
+            registry['segment/{}/{}MP'.format(engine, mp)] = (bench_segment, (engine, mp))
+        for processes in tiled_processes():
+            registry['grabcut_tiled/{}MP/{}proc'.format(mp, processes)] = (bench_grabcut_tiled, (processes, mp))
+        registry['superpixels/{}MP'.format(mp)] = (bench_superpixels, (mp,))
+        registry['qimage_to_bgr/{}MP'.format(mp)] = (bench_qimage_to_bgr, (mp,))
+        registry['view_stroke/{}MP'.format(mp)] = (bench_view_stroke, (mp,))
+        registry['view_undo_redo/{}MP'.format(mp)] = (bench_view_undo_redo, (mp,))
+        for mask_format in MASK_FORMATS:
+            registry['save_mask/{}/{}MP'.format(mask_format, mp)] = (bench_save_mask, (mask_format, mp))
+    registry['autotune/calibrate'] = (bench_autotune_calibrate, ())
+    for num_files in folder_sizes:
+        registry['directory_scan/cold/{}'.format(num_files)] = (bench_directory_scan, (num_files, False))
+        registry['directory_scan/warm/{}'.format(num_files)] = (bench_directory_scan, (num_files, True))
+    for export_format in ['npz', 'tfrecord', 'coco']:
+        registry['export/{}/{}'.format(export_format, folder_sizes[0])] = (bench_export, (export_format, folder_sizes[0]))
+    registry['thumbnails/{}'.format(folder_sizes[0])] = (bench_thumbnails, (folder_sizes[0],))
+    for num_files in folder_sizes[:2]:
+        registry['read_masks/png/{}'.format(num_files)] = (bench_read_masks, (num_files, False))
+        registry['read_masks/store/{}'.format(num_files)] = (bench_read_masks, (num_files, True))
+    return registry
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024.0 * 1024.0)
+
+
+def run_case(name, repeat):
+    """Run one case in this process and return its result"""
+    setup, args = cases()[name]
+    run = setup(*args)
+    run()  # Warm up caches and lazy imports
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {'seconds': statistics.median(times), 'min_seconds': min(times), 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_isolated(name, repeat):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, '--repeat', str(repeat)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if output.returncode != 0:
+        return {'error': output.stderr.strip().splitlines()[-1] if output.stderr.strip() else 'exit {}'.format(output.returncode)}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print each case against the baseline and return the names of the cases that regressed"""
+    regressions = []
+    print('{:<40} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('case', 'seconds', 'baseline', 'ratio', 'peak MB', 'baseline'))
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        if 'error' in result:
+            print('{:<40} {}'.format(name, result['error']))
+            continue
+        ratio = result['seconds'] / base['seconds'] if base.get('seconds') else None
+        memory_ratio = None
+        if result.get('peak_rss_mb') and base.get('peak_rss_mb'):
+            memory_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+        flag = ''
+        if (ratio is not None and ratio > threshold) or (memory_ratio is not None and memory_ratio > threshold):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<40} {:>10.4f} {:>10} {:>8} {:>10} {:>10}{}'.format(
+            name, result['seconds'],
+            '{:.4f}'.format(base['seconds']) if base.get('seconds') else '-',
+            '{:.2f}x'.format(ratio) if ratio is not None else '-',
+            '{:.0f}'.format(result['peak_rss_mb']) if result.get('peak_rss_mb') else '-',
+            '{:.0f}'.format(base['peak_rss_mb']) if base.get('peak_rss_mb') else '-',
+            flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Only the 1MP images and the smaller folders')
+    parser.add_argument('--only', default=None, help='Only run cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='Compare against the results in this json file, saved by an earlier run with --output')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Ratio to the baseline that counts as a regression')
+    parser.add_argument('--check-seams', action='store_true', help='Check tiled GrabCut against single-shot GrabCut')
+    parser.add_argument('--seam-threshold', type=float, default=0.01,
+                        help='Fraction of pixels near the seams that tiled GrabCut may disagree on')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_case(args.child, args.repeat)))
+        return 0
+
+    if args.check_seams:
+        failed = 0
+        for mp in QUICK_MEGAPIXELS if args.quick else MEGAPIXELS:
+            near_seams, overall = check_seams(mp)
+            flag = '  FAILED' if near_seams > args.seam_threshold else ''
+            failed += 1 if flag else 0
+            print('{}MP: {:.4%} of pixels near seams and {:.4%} overall differ from single-shot GrabCut{}'.format(
+                mp, near_seams, overall, flag))
+        return 1 if failed > 0 else 0
+
+    names = [name for name in cases(args.quick) if args.only is None or args.only in name]
+    results = {}
+    for name in names:
+        results[name] = run_isolated(name, args.repeat)
+        result = results[name]
+        if 'error' in result:
+            print('{:<40} error: {}'.format(name, result['error']), file=sys.stderr)
+        else:
+            print('{:<40} {:.4f}s'.format(name, result['seconds']), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine_info(), 'results': results}, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if len(regressions) > 0:
+        print('{} case(s) regressed by more than {:.2f}x'.format(len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
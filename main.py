@@ -1,11 +1,98 @@
-from src.SegmenterWindow import SegmenterWindow
-from PySide2.QtWidgets import QApplication
+import argparse
+import sys
 
 
-if __name__ == '__main__':
-    import sys
+def run_gui():
+    from src.SegmenterWindow import SegmenterWindow
+    from PySide2.QtWidgets import QApplication
     app = QApplication(sys.argv)
     window = SegmenterWindow()
     window.setGeometry(100, 50, 1000, 1000)
     window.show()
-    sys.exit(app.exec_())
+    return app.exec_()
+
+
+def run_grabcut(args):
+    # Doesn't import Qt, so it can run on a machine without a display
+    from src.Batch import run_batch
+    failed = run_batch(args.image_dir, args.label_dir, output_dir=args.output_dir, engine=args.engine,
+                       processes=args.processes, mask_format=args.mask_format, compression=args.compression)
+    return 1 if failed > 0 else 0
+
+
+def store_masks(args):
+    from src.MaskStore import MaskStore
+    store = MaskStore.for_label_dir(args.label_dir)
+    updated = store.sync_pngs(args.label_dir)
+    print('Stored {} new or changed masks, {} in total, in {}'.format(updated, len(store), store.path))
+    return 0
+
+
+def export_masks(args):
+    from src.MaskStore import MaskStore
+    store = MaskStore.for_label_dir(args.label_dir)
+    exported = store.export_pngs(args.output_dir, mask_format=args.mask_format, compression=args.compression)
+    print('Exported {} masks to {}'.format(exported, args.output_dir))
+    return 0
+
+
+def run_export(args):
+    from src.Export import run_export
+    size = tuple(args.resize) if args.resize is not None else None
+    failed = run_export(args.image_dir, args.label_root, args.output_dir, export_format=args.format,
+                        label_types=args.label_types, val_fraction=args.val_fraction, size=size, crop=args.crop,
+                        shard_mb=args.shard_mb, processes=args.processes, allow_missing=args.allow_missing,
+                        seed=args.seed)
+    return 1 if failed > 0 else 0
+
+
+def parse_args(argv):
+    from src.Engines import ENGINES
+    from src.Masks import MASK_FORMATS, PNG_COMPRESSION_LEVELS
+    parser = argparse.ArgumentParser(description='Image segmentation tool. Opens the GUI if no command is given.')
+    subparsers = parser.add_subparsers(dest='command')
+    grabcut = subparsers.add_parser('grabcut', help='Re-run GrabCut (or another --engine) on a folder of images from their saved masks')
+    grabcut.add_argument('image_dir', help='Folder of images')
+    grabcut.add_argument('label_dir', help='Folder of saved _label.png masks to use as seeds, e.g. labels/Foot')
+    grabcut.add_argument('--output-dir', default=None, help='Where to write the results (default: overwrite the seeds)')
+    grabcut.add_argument('--engine', default='GrabCut', choices=list(ENGINES))
+    grabcut.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    grabcut.add_argument('--mask-format', default='RGBA', choices=MASK_FORMATS)
+    grabcut.add_argument('--compression', type=int, default=3, choices=PNG_COMPRESSION_LEVELS)
+    from src.Export import CROP_MODES, EXPORT_FORMATS, EXPORT_LABEL_TYPES
+    dataset = subparsers.add_parser('export', help='Export labelled images and their masks as a training dataset')
+    dataset.add_argument('image_dir', help='Folder of images')
+    dataset.add_argument('label_root', help='Folder holding a label folder per label type, e.g. labels')
+    dataset.add_argument('output_dir', help='Where to write the dataset')
+    dataset.add_argument('--format', default='npz', choices=EXPORT_FORMATS)
+    dataset.add_argument('--label-types', nargs='+', default=EXPORT_LABEL_TYPES, metavar='TYPE',
+                         help='Label types to export, later ones drawn over earlier ones (default: %(default)s)')
+    dataset.add_argument('--allow-missing', action='store_true', help='Include images missing some of the label types')
+    dataset.add_argument('--val-fraction', type=float, default=0.2, help='Fraction of the images in the val split')
+    dataset.add_argument('--seed', type=int, default=0, help='Changes which images go in the val split')
+    dataset.add_argument('--resize', type=int, nargs=2, default=None, metavar=('WIDTH', 'HEIGHT'))
+    dataset.add_argument('--crop', default='none', choices=CROP_MODES,
+                         help='Crop to the center at the --resize aspect ratio, or around the labels, before resizing')
+    dataset.add_argument('--shard-mb', type=int, default=256, help='Size of each npz or tfrecord shard')
+    dataset.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    store = subparsers.add_parser('store-masks', help="Create or update a label folder's memory mapped mask store from its png masks")
+    store.add_argument('label_dir', help='Folder of saved _label.png masks, e.g. labels/Foot')
+    export = subparsers.add_parser('export-masks', help="Write the masks in a label folder's mask store out as _label.png files")
+    export.add_argument('label_dir', help='Label folder holding the mask store, e.g. labels/Foot')
+    export.add_argument('output_dir', help='Where to write the png masks')
+    export.add_argument('--mask-format', default='RGBA', choices=MASK_FORMATS)
+    export.add_argument('--compression', type=int, default=3, choices=PNG_COMPRESSION_LEVELS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.command == 'grabcut':
+        sys.exit(run_grabcut(args))
+    elif args.command == 'export':
+        sys.exit(run_export(args))
+    elif args.command == 'store-masks':
+        sys.exit(store_masks(args))
+    elif args.command == 'export-masks':
+        sys.exit(export_masks(args))
+    sys.exit(run_gui())
@@ -0,0 +1,191 @@
+import json
+import math
+import os
+import platform
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from .GrabCut import _composite, seed_mask
+from .Masks import BACKGROUND, EMPTY, FOREGROUND
+
+CALIBRATION_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ImageSegmenter', 'autotune.json')
+# Bumped whenever the calibration measures something different, so old calibrations are redone
+CALIBRATION_VERSION = 1
+# Seconds per pixel of each part of a GrabCut run, used until the machine has been calibrated
+DEFAULT_COSTS = {'full': 2e-8, 'init': 1e-6, 'iteration': 1e-6}
+
+
+def machine_key():
+    """Identifies the machine and OpenCV build a calibration was measured on"""
+    return '{}|{}|{}|{}'.format(platform.node(), platform.machine(), os.cpu_count(), cv2.__version__)
+
+
+def _best_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(size=320, full_size=1024):
+    """Time the parts of a GrabCut run on a synthetic image and return their cost in seconds per pixel
+
+    'full' is the work done on every pixel of the full resolution image (resizing and compositing the mask), 'init'
+    the extra cost of the first GrabCut iteration, which fits the colour models with k-means, and 'iteration' the cost
+    of every other iteration, both per working resolution pixel. Takes a fraction of a second.
+    """
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (size, size, 3)).astype(np.uint8)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    segmentation = np.full((size, size), EMPTY, dtype=np.uint8)
+    cv2.circle(image, (size // 2, size // 2), size // 4, (40, 160, 220), -1)
+    cv2.circle(segmentation, (size // 2, size // 2), size // 8, FOREGROUND, -1)
+    segmentation[:4, :] = BACKGROUND
+    seeds = seed_mask(segmentation)
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+
+    def first():
+        cv2.grabCut(image, seeds.copy(), None, bgd_model.copy(), fgd_model.copy(), 1, cv2.GC_INIT_WITH_MASK)
+    mask, bgd_model, fgd_model = cv2.grabCut(image, seeds.copy(), None, bgd_model, fgd_model, 1,
+                                             cv2.GC_INIT_WITH_MASK)
+
+    def later():
+        cv2.grabCut(image, mask.copy(), None, bgd_model.copy(), fgd_model.copy(), 1, cv2.GC_EVAL)
+    first_time = _best_time(first)
+    iteration_time = _best_time(later)
+
+    full_image = cv2.resize(image, (full_size, full_size), interpolation=cv2.INTER_NEAREST)
+    full_segmentation = cv2.resize(segmentation, (full_size, full_size), interpolation=cv2.INTER_NEAREST)
+    working = ((mask & 1) * 255).astype(np.uint8)
+
+    def full():
+        cv2.resize(full_image, (size, size), interpolation=cv2.INTER_NEAREST)
+        cv2.resize(full_segmentation, (size, size), interpolation=cv2.INTER_NEAREST)
+        foreground = cv2.resize(working, (full_size, full_size), interpolation=cv2.INTER_NEAREST)
+        _composite(foreground, full_segmentation)
+    full_time = _best_time(full)
+
+    return {'full': full_time / float(full_size * full_size),
+            'init': max(first_time - iteration_time, 0) / float(size * size),
+            'iteration': iteration_time / float(size * size)}
+
+
+class LatencyTuner(object):
+    """Picks the working resolution and iteration count of GrabCut runs so that they take about target seconds
+
+    Run times are predicted from per-pixel costs measured by calibrate(), which are kept on disk per machine, and
+    corrected after every run by how long it actually took. The largest working resolution that fits the target
+    with two iterations is used, with any time left over spent on more iterations. Scale factors are picked from
+    quarter-octave steps, and a finer step than the last one chosen for the same image size has to fit the target
+    with headroom to spare, so noise in the timings doesn't flip the resolution back and forth and lose the warm start
+    of the next run. A target of None turns tuning off.
+    """
+    def __init__(self, target=0.5, path=CALIBRATION_PATH, min_pixels=16000, max_iterations=5, smoothing=0.5,
+                 headroom=0.8):
+        self.target = target
+        self.path = path
+        self.min_pixels = min_pixels
+        self.max_iterations = max_iterations
+        # Weight of the latest run when correcting the costs
+        self.smoothing = smoothing
+        self.headroom = headroom
+        # Scale step last chosen for each image shape
+        self.last_steps = {}
+        self.costs = dict(DEFAULT_COSTS)
+        self.calibrated = False
+        self.load()
+
+    def load(self):
+        """Read the saved target and costs, keeping the costs only if they were measured on this machine"""
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if 'target' in saved:
+            self.target = saved['target']
+        if saved.get('version') == CALIBRATION_VERSION and saved.get('machine') == machine_key():
+            try:
+                self.costs = {part: float(saved['costs'][part]) for part in DEFAULT_COSTS}
+                self.calibrated = True
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def save(self):
+        if self.path is None:
+            return
+        saved = {'version': CALIBRATION_VERSION, 'machine': machine_key(), 'target': self.target}
+        if self.calibrated:
+            saved['costs'] = self.costs
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(self.path))
+            with os.fdopen(handle, 'w') as f:
+                json.dump(saved, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    def set_costs(self, costs):
+        """Use costs measured by calibrate(), which takes long enough that it should be run in the background"""
+        self.costs = dict(costs)
+        self.calibrated = True
+        self.save()
+
+    def set_target(self, target):
+        self.target = target
+        self.save()
+
+    def predict(self, shape, rescale_factor, iterations, warm=False):
+        """Predicted seconds for a GrabCut run on an image of shape (height, width)
+
+        A warm run skips the k-means fit and runs a single iteration, see GrabCut._iterate_grabcut.
+        """
+        full_pixels = shape[0] * shape[1]
+        working_pixels = full_pixels * rescale_factor * rescale_factor
+        if warm:
+            return self.costs['full'] * full_pixels + self.costs['iteration'] * working_pixels
+        return self.costs['full'] * full_pixels + working_pixels * (self.costs['init'] +
+                                                                    self.costs['iteration'] * iterations)
+
+    def choose(self, shape):
+        """Options for grabcut_segmentation, rescale_factor and iterations, for an image of shape (height, width)
+
+        Chosen for a run that isn't warm started, so repeat runs on the same image are quicker than the target.
+        """
+        full_pixels = shape[0] * shape[1]
+        # Smallest scale that keeps at least min_pixels, in quarter-octave steps down from full resolution
+        min_step = max(0, int(math.floor(2 * math.log2(max(full_pixels, 1) / float(self.min_pixels)))))
+        chosen = min_step
+        last_step = self.last_steps.get(tuple(shape))
+        for step in range(min_step + 1):
+            limit = self.target * self.headroom if last_step is not None and step < last_step else self.target
+            if self.predict(shape, 2 ** (-step / 4.0), 2) <= limit:
+                chosen = step
+                break
+        self.last_steps[tuple(shape)] = chosen
+        rescale_factor = 2 ** (-chosen / 4.0)
+        iterations = 2
+        while iterations < self.max_iterations and self.predict(shape, rescale_factor, iterations + 1) <= self.target:
+            iterations += 1
+        return {'rescale_factor': rescale_factor, 'iterations': iterations}
+
+    def observe(self, shape, rescale_factor, iterations, seconds, warm=False):
+        """Correct the costs by how long a run took compared to its prediction"""
+        predicted = self.predict(shape, rescale_factor, iterations, warm)
+        if predicted <= 0 or seconds <= 0:
+            return
+        # Limited so that one run held up by something else can't throw the costs off too far
+        ratio = min(max(seconds / predicted, 0.25), 4.0)
+        correction = ratio ** self.smoothing
+        self.costs = {part: cost * correction for part, cost in self.costs.items()}
+        self.save()
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import time
+
+import cv2
+
+from .Engines import ENGINES
+from .LabelIndex import label_name
+from .Manifest import DirectoryManifest
+from .Masks import read_mask, write_mask
+
+
+def list_images(image_dir):
+    """Sorted image paths in a directory, using and updating its manifest"""
+    manifest = DirectoryManifest(image_dir).load()
+    for name, size, mtime in manifest.revalidate():
+        manifest.entries[name] = manifest.sniff(name, size, mtime)
+    manifest.save()
+    return manifest.image_paths()
+
+
+def _init_worker():
+    # Each process segments its own image, so OpenCV's internal threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def segment_file(job):
+    """Segment one image from its saved seed mask and write the result
+
+    Returns (image path, seconds taken, error message or None). Errors are returned rather than raised, so that one
+    bad image doesn't stop the rest of the batch.
+    """
+    image_path, seed_path, output_path, engine, mask_format, compression = job
+    start = time.time()
+    try:
+        # Seeds are drawn on the image as the tool shows it, which ignores the EXIF orientation
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            raise ValueError('Could not read image')
+        seeds = read_mask(seed_path)
+        if seeds is None:
+            raise ValueError('Could not read seed mask {}'.format(seed_path))
+        if seeds.shape != image.shape[:2]:
+            raise ValueError('Seed mask is {}x{} but the image is {}x{}'.format(seeds.shape[1], seeds.shape[0],
+                                                                             image.shape[1], image.shape[0]))
+        segmentation = ENGINES[engine].segment(image, seeds)
+        write_mask(output_path, segmentation, mask_format, compression)
+    except Exception as e:
+        return image_path, time.time() - start, str(e) or type(e).__name__
+    return image_path, time.time() - start, None
+
+
+def run_batch(image_dir, label_dir, output_dir=None, engine='GrabCut', processes=None, mask_format='RGBA', compression=3,
+              log=print):
+    """Re-segment every image in image_dir that has a seed mask in label_dir with an engine, across a process pool
+
+    Results are written to output_dir (label_dir by default, replacing the seeds) with the same _label.png names.
+    Returns the number of images that failed.
+    """
+    if output_dir is None:
+        output_dir = label_dir
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for image_path in list_images(image_dir):
+        seed_path = os.path.join(label_dir, label_name(image_path))
+        if os.path.exists(seed_path):
+            jobs.append((image_path, seed_path, os.path.join(output_dir, label_name(image_path)), engine, mask_format,
+                         compression))
+    log('Segmenting {} images with {} processes'.format(len(jobs), processes or os.cpu_count()))
+    start = time.time()
+    failed = 0
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        for idx, (image_path, seconds, error) in enumerate(pool.imap_unordered(segment_file, jobs)):
+            name = os.path.basename(image_path)
+            if error is None:
+                log('[{}/{}] {} {:.2f}s'.format(idx + 1, len(jobs), name, seconds))
+            else:
+                failed += 1
+                log('[{}/{}] {} failed after {:.2f}s: {}'.format(idx + 1, len(jobs), name, seconds, error))
+    log('Finished {} images in {:.1f}s, {} failed'.format(len(jobs), time.time() - start, failed))
+    return failed
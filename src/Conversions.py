@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+from PySide2.QtGui import QImage
+
+# Formats whose pixels are 4 bytes stored as B, G, R, A on little-endian machines
+BGRA_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied)
+CHANNELS = {QImage.Format_Grayscale8: 1, QImage.Format_Indexed8: 1, QImage.Format_RGB888: 3,
+            QImage.Format_RGB32: 4, QImage.Format_ARGB32: 4, QImage.Format_ARGB32_Premultiplied: 4}
+# Not available before Qt 5.14
+FORMAT_BGR888 = getattr(QImage, 'Format_BGR888', None)
+if FORMAT_BGR888 is not None:
+    CHANNELS[FORMAT_BGR888] = 3
+
+
+def qimage_to_array(image):
+    """View the pixels of a QImage as a (height, width) or (height, width, channels) array without copying
+
+    The row stride of the array is the image's bytesPerLine, so padding at the end of each row is skipped rather than
+    read as pixels. The view shares the image's memory, so the image must be kept alive while it is used.
+    """
+    if image.format() not in CHANNELS:
+        raise ValueError('Unsupported QImage format: {}'.format(image.format()))
+    channels = CHANNELS[image.format()]
+    height, width, stride = image.height(), image.width(), image.bytesPerLine()
+    buffer = np.frombuffer(image.constBits(), dtype=np.uint8, count=height * stride)
+    array = buffer.reshape(height, stride)[:, :width * channels]
+    if channels == 1:
+        return array
+    return array.reshape(height, width, channels)
+
+
+def qimage_to_bgr(image):
+    """Copy a QImage into a contiguous BGR array, as used by OpenCV
+
+    Images in one of the common formats are converted straight from their memory with a single copy.
+    """
+    if image.format() not in CHANNELS or image.format() == QImage.Format_Indexed8:
+        image = image.convertToFormat(QImage.Format_RGB32)
+    array = qimage_to_array(image)
+    if image.format() in BGRA_FORMATS:
+        return cv2.cvtColor(array, cv2.COLOR_BGRA2BGR)
+    if image.format() == QImage.Format_RGB888:
+        return cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+    if image.format() == QImage.Format_Grayscale8:
+        return cv2.cvtColor(array, cv2.COLOR_GRAY2BGR)
+    return array.copy()
+
+
+def array_to_qimage(array, image_format=None, color_table=None, copy=False):
+    """Wrap a uint8 array in a QImage that shares its memory
+
+    The format defaults to Grayscale8, or Indexed8 with a color_table, for (height, width) arrays, RGB888 for 3 channels
+    and ARGB32 (B, G, R, A in memory) for 4. Rows may be padded, but the pixels in each row must be contiguous. An
+    array that isn't laid out that way is copied first, and the image then owns its pixels as it does with copy=True.
+    Otherwise the caller must keep the array alive for as long as the image is used.
+    """
+    if array.dtype != np.uint8:
+        raise ValueError('Expected a uint8 array, got {}'.format(array.dtype))
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    if image_format is None:
+        if channels == 1:
+            image_format = QImage.Format_Indexed8 if color_table is not None else QImage.Format_Grayscale8
+        else:
+            image_format = {3: QImage.Format_RGB888, 4: QImage.Format_ARGB32}[channels]
+    pixel_strides = (1,) if channels == 1 else (channels, 1)
+    if array.strides[1:] != pixel_strides or array.strides[0] < array.shape[1] * channels:
+        array = np.ascontiguousarray(array)
+        copy = True
+    height, width = array.shape[:2]
+    stride = array.strides[0]
+    # A flat view from the first pixel to the end of the last row, so rows padded out by a larger array can be passed
+    # to Qt as one buffer
+    span = stride * (height - 1) + width * channels if height > 0 else 0
+    flat = np.lib.stride_tricks.as_strided(array, shape=(span,), strides=(1,))
+    image = QImage(flat.data, width, height, stride, image_format)
+    if color_table is not None:
+        image.setColorTable(color_table)
+    if copy:
+        image = image.copy()
+    return image
+
+
+def bgr_to_qimage(array):
+    """Copy a BGR array into a QImage that owns its pixels"""
+    if FORMAT_BGR888 is not None:
+        return array_to_qimage(array, FORMAT_BGR888, copy=True)
+    return array_to_qimage(cv2.cvtColor(array, cv2.COLOR_BGR2RGB), QImage.Format_RGB888, copy=True)
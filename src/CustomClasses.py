@@ -1,6 +1,6 @@
-from PySide2.QtWidgets import QHBoxLayout, QVBoxLayout, QSlider, QWidget, QLabel, QComboBox, QSpinBox, QLineEdit
+from PySide2.QtWidgets import QHBoxLayout, QVBoxLayout, QSlider, QWidget, QLabel, QComboBox, QSpinBox, QLineEdit, QDialog, QPlainTextEdit
 from PySide2.QtCore import Slot, Signal, Qt, QTimer, QRect
-from PySide2.QtGui import QMouseEvent, QColor, QPainter
+from PySide2.QtGui import QMouseEvent, QColor, QPainter, QFontDatabase
 import math
 
 
@@ -105,8 +105,13 @@ class LabeledSpinBox(QWidget):
     def value(self):
         return self.spinbox.value()
 
-    def setRange(self, minimum, maximum):
-        self.spinbox.setRange(minimum, maximum)
+    def setRange(self, minimum, maximum, quiet=False):
+        if quiet:
+            self.spinbox.blockSignals(True)
+            self.spinbox.setRange(minimum, maximum)
+            self.spinbox.blockSignals(False)
+        else:
+            self.spinbox.setRange(minimum, maximum)
         self.spinbox.setSuffix("/{}".format(maximum))
 
     def _valueChanged(self, value):
@@ -122,3 +127,25 @@ class ClickableLineEdit(QLineEdit):
 
     def mousePressEvent(self, e):
         self.clicked.emit(e)
+
+
+class LatencyDialog(QDialog):
+    """Shows the report of a LatencyRecorder, refreshed while the dialog is open"""
+    def __init__(self, recorder, parent=None, refresh_ms=1000):
+        super(LatencyDialog, self).__init__(parent)
+        self.setWindowTitle('Latency Report')
+        self.recorder = recorder
+        self.text = QPlainTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.text)
+        self.resize(900, 400)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(refresh_ms)
+        self.refresh()
+
+    def refresh(self):
+        self.text.setPlainText(self.recorder.report())
@@ -0,0 +1,76 @@
+import os
+import shutil
+import time
+
+# Entries written or used this recently are never removed, so files another process is still writing are left alone
+MIN_AGE = 60
+
+
+def touch(path):
+    """Mark a cache entry as used now, since access times are often not updated on read"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _entry_size(entry):
+    if not entry.is_dir(follow_symlinks=False):
+        return entry.stat(follow_symlinks=False).st_size
+    total = 0
+    for root, _, names in os.walk(entry.path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def cache_entries(cache_dir, depth=1):
+    """(path, bytes, last used) of each entry of a cache folder, the files or folders depth levels inside it"""
+    entries = []
+    try:
+        with os.scandir(cache_dir) as listing:
+            for entry in listing:
+                try:
+                    if depth > 1:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries.extend(cache_entries(entry.path, depth - 1))
+                    else:
+                        entries.append((entry.path, _entry_size(entry), entry.stat(follow_symlinks=False).st_mtime))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+
+def prune_cache(cache_dir, max_bytes, depth=1, keep=()):
+    """Remove the least recently used entries of a cache folder until the rest take up at most max_bytes
+
+    Entries are used when they are written or touch()ed. Those in keep, or used in the last MIN_AGE seconds, are
+    kept whatever their size. Returns the number of bytes freed.
+    """
+    entries = cache_entries(cache_dir, depth)
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return 0
+    keep = {os.path.normpath(path) for path in keep}
+    recent = time.time() - MIN_AGE
+    freed = 0
+    for path, size, used in sorted(entries, key=lambda entry: entry[2]):
+        if total - freed <= max_bytes:
+            break
+        if used > recent or os.path.normpath(path) in keep:
+            continue
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            # e.g. still memory mapped by another process on Windows
+            continue
+        freed += size
+    return freed
@@ -0,0 +1,248 @@
+import math
+
+import cv2
+import numpy as np
+
+from .GrabCut import (_check_seeds, _colour_costs, _composite, _Reporter, grabcut_multiresolution, grabcut_segmentation,
+                      grabcut_tiled, superpixel_segmentation)
+from .Masks import BACKGROUND, EMPTY, FOREGROUND, POSSIBLE_FOREGROUND
+from .Profiling import StageTimer
+
+
+def marker_seeds(segmentation):
+    """Boolean masks of the pixels known to be foreground and background, for engines that grow regions from them
+
+    These are the foreground and background strokes. Without any foreground strokes the possible foreground is used
+    instead, and without any background strokes the empty pixels along the edge of the image.
+    """
+    fg_seeds = segmentation == FOREGROUND
+    if not fg_seeds.any():
+        fg_seeds = segmentation == POSSIBLE_FOREGROUND
+    bg_seeds = segmentation == BACKGROUND
+    if not bg_seeds.any():
+        bg_seeds = np.zeros(segmentation.shape, dtype=bool)
+        for edge in [np.s_[0, :], np.s_[-1, :], np.s_[:, 0], np.s_[:, -1]]:
+            bg_seeds[edge] = segmentation[edge] == EMPTY
+    _check_seeds(fg_seeds.any(), True)
+    if not bg_seeds.any():
+        raise ValueError('You must select some background or leave some empty area along the edge of the image.')
+    return fg_seeds, bg_seeds
+
+
+def _reduce_seeds(fg_seeds, bg_seeds, size):
+    """Shrink seed masks to size (width, height) without losing thin strokes, dropping pixels covered by both"""
+    height, width = fg_seeds.shape
+    # Each pixel of the result looks at the block of pixels it covers, rather than only the nearest one
+    kernel = np.ones((int(math.ceil(height / float(size[1]))), int(math.ceil(width / float(size[0])))), np.uint8)
+    fg = cv2.resize(cv2.dilate(fg_seeds.astype(np.uint8), kernel), size, interpolation=cv2.INTER_NEAREST) > 0
+    bg = cv2.resize(cv2.dilate(bg_seeds.astype(np.uint8), kernel), size, interpolation=cv2.INTER_NEAREST) > 0
+    both = fg & bg
+    return fg & ~both, bg & ~both
+
+
+class SegmentationEngine(object):
+    """Turns an image and a class mask of seeds into a new class mask
+
+    Foreground and background strokes are kept as they are, and everything else becomes possible foreground or empty.
+    Images larger than working_pixels are reduced to that size before they are segmented and the foreground is scaled
+    back up, so an engine takes about the same time on any image. Subclasses implement foreground(), which is given
+    the reduced image with masks of the pixels known to be foreground and background.
+    """
+    name = None
+    # Shown as the engine's tooltip
+    description = ''
+    # None to always work at full resolution
+    working_pixels = None
+    # Whether segment() takes the image's precomputed Superpixels as a superpixels option
+    uses_superpixels = False
+    # Steps that foreground() reports, not counting the start and end of the run
+    steps = 1
+
+    def segment(self, image, segmentation, state=None, progress=None, is_cancelled=None, **options):
+        """Segment a BGR image using a class mask as seeds and return the new class mask
+
+        Raises ValueError if the seeds are insufficient and GrabCutCancelled if is_cancelled() becomes true. state is
+        a GrabCutState for engines that can warm start from their last run, and is ignored by the others.
+        """
+        report = _Reporter(self.steps + 1, progress, is_cancelled)
+        stages = StageTimer(self.name.lower())
+        height, width = segmentation.shape
+        fg_seeds, bg_seeds = marker_seeds(segmentation)
+        if self.working_pixels is not None and height * width > self.working_pixels:
+            scale = math.sqrt(self.working_pixels / float(height * width))
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            fg_seeds, bg_seeds = _reduce_seeds(fg_seeds, bg_seeds, size)
+        report(0)
+        stages.mark('resize')
+
+        foreground = self.foreground(image, fg_seeds, bg_seeds, report, **options)
+        stages.mark('segment')
+
+        foreground = foreground.astype(np.uint8) * 255
+        if foreground.shape != (height, width):
+            foreground = cv2.resize(foreground, (width, height), interpolation=cv2.INTER_LINEAR)
+            _, foreground = cv2.threshold(foreground, 127, 255, cv2.THRESH_BINARY)
+        stages.mark('upscale')
+        new_segmentation = _composite(foreground, segmentation)
+        stages.mark('composite')
+        report(report.total_steps)
+        return new_segmentation
+
+    def foreground(self, image, fg_seeds, bg_seeds, report, **options):
+        """Boolean foreground mask of a BGR image. report(step) should be called every so often to allow cancelling"""
+        raise NotImplementedError
+
+
+class FunctionEngine(SegmentationEngine):
+    """Engine for a segmentation function that picks its own resolution and keeps the strokes itself, like GrabCut"""
+    def __init__(self, name, function, description, uses_superpixels=False):
+        self.name = name
+        self.function = function
+        self.description = description
+        self.uses_superpixels = uses_superpixels
+
+    def segment(self, image, segmentation, state=None, progress=None, is_cancelled=None, **options):
+        return self.function(image, segmentation, state=state, progress=progress, is_cancelled=is_cancelled, **options)
+
+
+class WatershedEngine(SegmentationEngine):
+    """Floods the colour gradient of the image outwards from the foreground and background seeds"""
+    name = 'Watershed'
+    description = 'Grows the strokes out to the strongest edges between them. Works at up to 1 megapixel.'
+    working_pixels = 1000000
+
+    def foreground(self, image, fg_seeds, bg_seeds, report):
+        # watershed overwrites the outermost pixels with -1, so both are padded to keep seeds along the edge
+        markers = np.zeros((fg_seeds.shape[0] + 2, fg_seeds.shape[1] + 2), np.int32)
+        markers[1:-1, 1:-1][fg_seeds] = 1
+        markers[1:-1, 1:-1][bg_seeds] = 2
+        image = cv2.copyMakeBorder(cv2.GaussianBlur(image, (3, 3), 0), 1, 1, 1, 1, cv2.BORDER_REPLICATE)
+        cv2.watershed(image, markers)
+        report(1)
+        # The pixels between regions are marked -1, give them a neighbouring label
+        markers = markers[1:-1, 1:-1]
+        lines = markers <= 0
+        markers[lines] = 0
+        neighbours = cv2.dilate(markers.astype(np.uint8), np.ones((3, 3), np.uint8))
+        return np.where(lines, neighbours, markers) == 1
+
+
+class FloodFillEngine(SegmentationEngine):
+    """Fills outwards from the foreground seeds across pixels that are close in colour to them
+
+    A pixel is within tolerance if it is closer to the foreground colours than to the background colours, and no
+    further from them (in Lab units) than tolerance. Without a tolerance, it is set from the spread of the foreground
+    seed colours. Only the areas that are connected to a foreground seed are filled, and background strokes are never
+    crossed.
+    """
+    name = 'Flood Fill'
+    description = ('Fills from the foreground strokes across pixels of a similar colour, stopping at background '
+                   'strokes. Works at up to 1 megapixel.')
+    working_pixels = 1000000
+
+    def foreground(self, image, fg_seeds, bg_seeds, report, tolerance=None):
+        lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB).reshape(-1, 3).astype(np.float32)
+        fg_cost = _colour_costs(lab, fg_seeds.ravel())
+        bg_cost = _colour_costs(lab, bg_seeds.ravel())
+        if tolerance is None:
+            tolerance = max(10.0, 1.5 * float(np.percentile(fg_cost[fg_seeds.ravel()], 95)))
+        within = ((fg_cost <= tolerance) & (fg_cost < bg_cost)).reshape(fg_seeds.shape)
+        within = (within & ~bg_seeds) | fg_seeds
+        report(1)
+        _, components = cv2.connectedComponents(within.astype(np.uint8), connectivity=4)
+        filled = np.zeros(components.max() + 1, dtype=bool)
+        filled[components[fg_seeds]] = True
+        filled[0] = False
+        return filled[components]
+
+
+class RandomWalkerEngine(SegmentationEngine):
+    """Random walker style propagation of the seed labels
+
+    Each pixel's probability of being foreground is the weighted average of its neighbours', with weights that fall
+    off with the colour difference across each edge, and the seeds fixed at 1 and 0. This is solved by Jacobi
+    iterations from coarse to fine over an image pyramid, each level starting from the level below, so the labels
+    spread across the image in a few iterations per level.
+    """
+    name = 'Random Walker'
+    description = ('Spreads the strokes across the image, slowing down at edges, which copes well with soft or '
+                   'textured boundaries. Works at up to 0.25 megapixels.')
+    working_pixels = 250000
+    steps = 0
+
+    def foreground(self, image, fg_seeds, bg_seeds, report, iterations=40, min_size=4):
+        lab = cv2.cvtColor(cv2.GaussianBlur(image, (3, 3), 0), cv2.COLOR_BGR2LAB).astype(np.float32)
+        levels = [(lab, fg_seeds, bg_seeds)]
+        while min(levels[-1][0].shape[:2]) > 2 * min_size:
+            lab, fg, bg = levels[-1]
+            size = (lab.shape[1] // 2, lab.shape[0] // 2)
+            levels.append((cv2.resize(lab, size, interpolation=cv2.INTER_AREA),) + _reduce_seeds(fg, bg, size))
+        report.total_steps += len(levels)
+
+        probability = None
+        for step, (lab, fg, bg) in enumerate(reversed(levels)):
+            height, width = fg.shape
+            # Coarse levels are cheap and have to carry the labels furthest, so they get more iterations, but no more
+            # than it takes to cross them a few times
+            level_iterations = max(iterations, min(iterations * 2 ** (len(levels) - 1 - step), 4 * (height + width)))
+            weights = self._weights(lab, fg | bg)
+            # A small pull towards 0.5 keeps pixels cut off by strong edges on all sides from dividing by 0, and seeds
+            # have no neighbours, so they stay at 1 or 0
+            constant = np.where(fg, 1, np.where(bg, 0, 0.5 * weights[4])).astype(np.float32)
+            # Padded by a pixel so that each neighbour is a view of the same array
+            padded = np.zeros((height + 2, width + 2), dtype=np.float32)
+            if probability is None:
+                padded[1:-1, 1:-1] = 0.5
+            else:
+                padded[1:-1, 1:-1] = cv2.resize(probability, (width, height), interpolation=cv2.INTER_LINEAR)
+            neighbours = [padded[1:-1, :-2], padded[1:-1, 2:], padded[:-2, 1:-1], padded[2:, 1:-1]]
+            update = np.empty((height, width), dtype=np.float32)
+            term = np.empty((height, width), dtype=np.float32)
+            for _ in range(level_iterations):
+                np.copyto(update, constant)
+                for weight, neighbour in zip(weights[:4], neighbours):
+                    np.multiply(weight, neighbour, out=term)
+                    update += term
+                padded[1:-1, 1:-1] = update
+            probability = padded[1:-1, 1:-1].copy()
+            report(step + 1)
+        return probability > 0.5
+
+    @staticmethod
+    def _weights(lab, seeds, regularization=1e-6):
+        """Left, right, up and down neighbour weights of each pixel normalised to sum to 1, and the pull towards 0.5
+
+        Weights fall off with the squared colour difference to each neighbour, and are 0 at the edges of the image
+        and for seed pixels.
+        """
+        height, width = seeds.shape
+        diff_x = ((lab[:, 1:] - lab[:, :-1]) ** 2).sum(axis=2)
+        diff_y = ((lab[1:, :] - lab[:-1, :]) ** 2).sum(axis=2)
+        beta = 1.0 / (2 * max(float(diff_x.sum() + diff_y.sum()) / max(1, diff_x.size + diff_y.size), 1e-6))
+        weights = np.zeros((5, height, width), dtype=np.float32)
+        weights[0][:, 1:] = weights[1][:, :-1] = np.exp(-beta * diff_x)
+        weights[2][1:, :] = weights[3][:-1, :] = np.exp(-beta * diff_y)
+        weights[4] = regularization
+        weights /= weights.sum(axis=0)
+        weights[:, seeds] = 0
+        return weights
+
+
+ENGINES = {engine.name: engine for engine in [
+    FunctionEngine('GrabCut', grabcut_segmentation,
+                   'Runs GrabCut on the whole image at the highest resolution that fits the target latency, or at 1/8 '
+                   'scale when that is off. Repeat runs reuse the colour models of the last one.'),
+    FunctionEngine('GrabCut Multi-resolution', grabcut_multiresolution,
+                   'Runs GrabCut around the foreground strokes at low resolution, then refines the edges at up to '
+                   'full resolution. Slower, but gives much sharper edges on large images.'),
+    FunctionEngine('GrabCut Tiled', grabcut_tiled,
+                   'Runs GrabCut on the whole image at full resolution, split into tiles that are solved in parallel '
+                   'on every CPU core. For large images on machines with many cores.'),
+    FunctionEngine('Superpixel Graph Cut', superpixel_segmentation,
+                   'Labels whole superpixels with a graph cut, snapping the mask to their edges. Works at up to '
+                   '2 megapixels.', uses_superpixels=True),
+    WatershedEngine(),
+    FloodFillEngine(),
+    RandomWalkerEngine(),
+]}
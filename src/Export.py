@@ -0,0 +1,513 @@
+import collections
+import imghdr
+import json
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+import cv2
+import numpy as np
+
+from .Batch import list_images
+from .LabelIndex import label_folder, label_name
+from .Manifest import IMAGE_FORMATS, image_dimensions
+from .Masks import FOREGROUND, POSSIBLE_FOREGROUND, read_mask
+from .MaskStore import MaskStore, mask_key, store_dir
+from .Processes import process_pool
+
+try:
+    # Much faster than the pure Python version below, if it is installed
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+EXPORT_FORMATS = ['npz', 'tfrecord', 'coco']
+CROP_MODES = ['none', 'center', 'labels']
+# Label types are drawn over each other in this order, so wounds are kept where they lie on the foot
+EXPORT_LABEL_TYPES = ['Foot', 'Outer Wound', 'Inner Wound']
+
+
+def _crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+CRC32C_TABLE_NP = np.array(CRC32C_TABLE, dtype=np.uint32)
+
+
+def _crc32c_update(crc, data):
+    table = CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def _zeros_operator(length):
+    """Byte tables of the linear map that feeding length zero bytes applies to a CRC register"""
+    # The register starting from each of the 32 single bit values, all fed the zeros at once
+    columns = np.left_shift(np.uint32(1), np.arange(32, dtype=np.uint32))
+    for _ in range(length):
+        columns = CRC32C_TABLE_NP[columns & 0xFF] ^ (columns >> 8)
+    values = np.arange(256)
+    tables = []
+    for shift in range(0, 32, 8):
+        bits = (values[:, None] >> np.arange(8)) & 1
+        tables.append(np.bitwise_xor.reduce(np.where(bits, columns[shift:shift + 8], 0), axis=1).astype(np.uint32)
+                      .tolist())
+    return tables
+
+
+def crc32c(data, lanes=1024):
+    """CRC-32C (Castagnoli) checksum of bytes, as used by TFRecord files
+
+    Without the crc32c package, long inputs are split into lanes blocks whose CRCs are computed side by side with
+    numpy, then chained together. A CRC is linear, so each block's CRC combines with the register fed its length in
+    zero bytes.
+    """
+    if _crc32c is not None:
+        return _crc32c(data)
+    length = len(data) // lanes
+    if length < 64:
+        return _crc32c_update(0xFFFFFFFF, data) ^ 0xFFFFFFFF
+    blocks = np.frombuffer(data, dtype=np.uint8, count=lanes * length).reshape(lanes, length).T.copy()
+    crcs = np.zeros(lanes, dtype=np.uint32)
+    for row in blocks:
+        crcs = CRC32C_TABLE_NP[(crcs ^ row) & 0xFF] ^ (crcs >> 8)
+    t0, t1, t2, t3 = _zeros_operator(length)
+    crc = 0xFFFFFFFF
+    for block_crc in crcs.tolist():
+        crc = t0[crc & 0xFF] ^ t1[(crc >> 8) & 0xFF] ^ t2[(crc >> 16) & 0xFF] ^ t3[crc >> 24] ^ block_crc
+    return _crc32c_update(crc, data[lanes * length:]) ^ 0xFFFFFFFF
+
+
+def _masked_crc(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def tfrecord(data):
+    """Frame serialized bytes as a TFRecord: length, length checksum, data, data checksum"""
+    length = struct.pack('<Q', len(data))
+    return length + struct.pack('<I', _masked_crc(length)) + data + struct.pack('<I', _masked_crc(data))
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _field(number, payload):
+    """Length-delimited protobuf field"""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def tf_example(features):
+    """Serialize a dict of feature name to bytes, str, int or list of ints as a tf.train.Example
+
+    Written out by hand so that exporting doesn't need TensorFlow installed.
+    """
+    entries = []
+    for key in sorted(features):
+        value = features[key]
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if isinstance(value, bytes):
+            # Feature.bytes_list, BytesList.value
+            feature = _field(1, _field(1, value))
+        else:
+            values = [value] if isinstance(value, int) else value
+            # Feature.int64_list, packed Int64List.value
+            feature = _field(3, _field(1, b''.join(_varint(int(v)) for v in values)))
+        entries.append(_field(1, _field(1, key.encode('utf-8')) + _field(2, feature)))
+    # Example.features, Features.feature
+    return _field(1, b''.join(entries))
+
+
+def rle_counts(mask):
+    """COCO run lengths of a boolean mask: alternating runs of 0 and 1, column by column, starting with 0"""
+    flat = np.asfortranarray(mask).ravel(order='F').astype(np.int8)
+    changes = np.flatnonzero(np.diff(flat)) + 1
+    bounds = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(bounds).tolist()
+    if flat.size > 0 and flat[0]:
+        counts = [0] + counts
+    return counts
+
+
+def rle_string(counts):
+    """Compress run lengths into COCO's string form, the same as pycocotools' rleToString"""
+    out = []
+    for idx, count in enumerate(counts):
+        if idx > 2:
+            count -= counts[idx - 2]
+        more = True
+        while more:
+            bits = count & 0x1F
+            count >>= 5
+            more = count != -1 if bits & 0x10 else count != 0
+            if more:
+                bits |= 0x20
+            out.append(chr(bits + 48))
+    return ''.join(out)
+
+
+def split_of(name, val_fraction, seed=0):
+    """'train' or 'val' for an image, decided by a hash of its name so the split is the same on every export"""
+    bucket = zlib.crc32('{}|{}'.format(seed, name).encode('utf-8')) % 10000
+    return 'val' if bucket < val_fraction * 10000 else 'train'
+
+
+def _crop_box(shape, labels, crop, size):
+    """(x0, y0, x1, y1) to crop an image of shape (height, width) to before any resize"""
+    height, width = shape
+    if crop == 'center' and size is not None:
+        # The largest centred box with the same aspect ratio as size
+        aspect = size[0] / float(size[1])
+        crop_width, crop_height = min(width, int(round(height * aspect))), min(height, int(round(width / aspect)))
+        x0, y0 = (width - crop_width) // 2, (height - crop_height) // 2
+        return x0, y0, x0 + crop_width, y0 + crop_height
+    if crop == 'labels' and labels.any():
+        ys, xs = np.nonzero(labels)
+        margin_x, margin_y = (xs.max() - xs.min() + 1) // 10, (ys.max() - ys.min() + 1) // 10
+        return (max(0, xs.min() - margin_x), max(0, ys.min() - margin_y),
+                min(width, xs.max() + 1 + margin_x), min(height, ys.max() + 1 + margin_y))
+    return 0, 0, width, height
+
+
+# MaskStore of each label folder, opened once per worker process
+_stores = {}
+
+
+def _init_worker():
+    # Each process handles its own image, so OpenCV's internal threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+    _stores.clear()
+
+
+def _load_mask(label_dir, image_path):
+    """Class mask of an image from the label folder's MaskStore if it is up to date, or else its png"""
+    path = os.path.join(label_dir, label_name(image_path))
+    if label_dir not in _stores:
+        try:
+            _stores[label_dir] = MaskStore(store_dir(label_dir)) if os.path.isdir(store_dir(label_dir)) else None
+        except ValueError:
+            _stores[label_dir] = None
+    store = _stores[label_dir]
+    name = mask_key(path)
+    if store is not None and name in store and store.entries[name][4] >= os.stat(path).st_mtime_ns:
+        return np.array(store.get(name))
+    return read_mask(path)
+
+
+def _encode_image(image, kind):
+    ext = '.png' if kind == 'png' else '.jpg'
+    params = [cv2.IMWRITE_JPEG_QUALITY, 95] if ext == '.jpg' else []
+    ok, encoded = cv2.imencode(ext, image, params)
+    if not ok:
+        raise ValueError('Could not encode image')
+    return encoded.tobytes(), 'png' if ext == '.png' else 'jpeg'
+
+
+def prepare_sample(job):
+    """Load an image and its masks and turn them into what the export format writes
+
+    Runs in the worker processes, so the decoding, resizing and encoding are spread across the cores. Returns (image
+    path, split, sample, error message or None). The sample is (rgb image, class index mask) for npz, the framed
+    record bytes for tfrecord, and (height, width, encoded image or None, [(category, rle counts, bbox, area)]) for
+    coco.
+    """
+    image_path, split, label_dirs, export_format, size, crop = job
+    try:
+        masks = []
+        for label_dir in label_dirs:
+            mask = None if label_dir is None else _load_mask(label_dir, image_path)
+            masks.append(None if mask is None else np.isin(mask, [FOREGROUND, POSSIBLE_FOREGROUND]))
+        if all(mask is None for mask in masks):
+            raise ValueError('Could not read any of its masks')
+        shape = next(mask.shape for mask in masks if mask is not None)
+        kind = imghdr.what(image_path)
+        transform = size is not None or crop != 'none'
+        image = None
+        if export_format == 'npz' or transform:
+            image = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+            if image is None:
+                raise ValueError('Could not read image')
+            dimensions = image.shape[1], image.shape[0]
+        else:
+            # The file is passed through as it is, so only its size is needed
+            dimensions = image_dimensions(image_path, kind) if kind in IMAGE_FORMATS else None
+            if dimensions is None:
+                raise ValueError('Could not read image')
+        if dimensions != (shape[1], shape[0]):
+            raise ValueError('Mask is {}x{} but the image is {}x{}'.format(shape[1], shape[0], *dimensions))
+        masks = [np.zeros(shape, dtype=bool) if mask is None else mask for mask in masks]
+
+        if transform:
+            x0, y0, x1, y1 = _crop_box(shape, np.logical_or.reduce(masks), crop, size)
+            image = image[y0:y1, x0:x1]
+            masks = [mask[y0:y1, x0:x1] for mask in masks]
+            if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+                shrinking = size[0] * size[1] < image.shape[0] * image.shape[1]
+                image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+                masks = [cv2.resize(mask.astype(np.uint8), tuple(size), interpolation=cv2.INTER_NEAREST) > 0
+                         for mask in masks]
+        height, width = masks[0].shape
+
+        if export_format == 'coco':
+            encoded = _encode_image(image, kind)[0] if transform else None
+            annotations = [(category, rle_counts(mask), cv2.boundingRect(mask.astype(np.uint8)),
+                            int(np.count_nonzero(mask))) for category, mask in enumerate(masks, 1) if mask.any()]
+            return image_path, split, (height, width, encoded, annotations), None
+
+        # Label types later in the list are drawn over earlier ones
+        index_mask = np.zeros((height, width), dtype=np.uint8)
+        for category, mask in enumerate(masks, 1):
+            index_mask[mask] = category
+        if export_format == 'npz':
+            return image_path, split, (cv2.cvtColor(image, cv2.COLOR_BGR2RGB), index_mask), None
+
+        if transform:
+            encoded, image_format = _encode_image(image, kind)
+        else:
+            with open(image_path, 'rb') as f:
+                encoded = f.read()
+            image_format = 'png' if kind == 'png' else 'jpeg'
+        ok, mask_png = cv2.imencode('.png', index_mask)
+        if not ok:
+            raise ValueError('Could not encode mask')
+        example = tf_example({'image/encoded': encoded, 'image/format': image_format,
+                              'image/filename': os.path.basename(image_path), 'image/height': height,
+                              'image/width': width, 'mask/encoded': mask_png.tobytes(), 'mask/format': 'png'})
+        return image_path, split, tfrecord(example), None
+    except Exception as e:
+        return image_path, split, None, str(e) or type(e).__name__
+
+
+class _NpzShardWriter(object):
+    """Writes samples into .npz shards of about shard_bytes, one array at a time so no shard is held in memory
+
+    Each shard holds image_<n> (RGB) and mask_<n> arrays and a names array, and loads with np.load.
+    """
+    extension = '.npz'
+
+    def __init__(self, output_dir, split, shard_bytes):
+        self.output_dir = output_dir
+        self.split = split
+        self.shard_bytes = shard_bytes
+        self.shards = 0
+        self.file = None
+        self.names = []
+        self.written = 0
+
+    def _path(self, shard):
+        return os.path.join(self.output_dir, '{}-{:05d}{}'.format(self.split, shard, self.extension))
+
+    def add(self, name, sample):
+        if self.file is None:
+            self._open()
+        self._write(name, sample)
+        self.names.append(name)
+        if self.written >= self.shard_bytes:
+            self.close()
+
+    def _open(self):
+        self.file = zipfile.ZipFile(self._path(self.shards), mode='w', compression=zipfile.ZIP_STORED,
+                                    allowZip64=True)
+        self.shards += 1
+        self.names = []
+        self.written = 0
+
+    def _write_array(self, key, array):
+        with self.file.open(key + '.npy', mode='w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+        self.written += array.nbytes
+
+    def _write(self, name, sample):
+        image, mask = sample
+        self._write_array('image_{}'.format(len(self.names)), image)
+        self._write_array('mask_{}'.format(len(self.names)), mask)
+
+    def close(self):
+        if self.file is not None:
+            self._write_array('names', np.array(self.names, dtype=np.str_))
+            self.file.close()
+            self.file = None
+
+
+class _TFRecordShardWriter(_NpzShardWriter):
+    """Writes framed tf.train.Example records into .tfrecord shards of about shard_bytes"""
+    extension = '.tfrecord'
+
+    def _open(self):
+        self.file = open(self._path(self.shards), 'wb')
+        self.shards += 1
+        self.names = []
+        self.written = 0
+
+    def _write(self, name, sample):
+        self.file.write(sample)
+        self.written += len(sample)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class _CocoWriter(object):
+    """Streams a COCO instances json with RLE masks, one per label type present in each image
+
+    Images and annotations go to separate files as they come in and are joined at the end, so nothing is kept in
+    memory. Images are referenced by their original file names, or written to images/<split> when resized or cropped.
+    """
+    def __init__(self, output_dir, split, categories):
+        self.output_dir = output_dir
+        self.split = split
+        self.categories = categories
+        self.path = os.path.join(output_dir, '{}.json'.format(split))
+        self.image_dir = os.path.join(output_dir, 'images', split)
+        self.images = None
+        self.annotations = None
+        self.image_count = 0
+        self.annotation_count = 0
+
+    def add(self, name, sample):
+        if self.images is None:
+            self.images = open(self.path + '.tmp', 'w')
+            self.annotations = tempfile.TemporaryFile(mode='w+', dir=self.output_dir)
+        height, width, encoded, annotations = sample
+        file_name = name
+        if encoded is not None:
+            os.makedirs(self.image_dir, exist_ok=True)
+            file_name = os.path.join('images', self.split, name)
+            with open(os.path.join(self.output_dir, file_name), 'wb') as f:
+                f.write(encoded)
+        self.image_count += 1
+        image = {'id': self.image_count, 'file_name': file_name.replace(os.sep, '/'), 'height': height, 'width': width}
+        self.images.write((',' if self.image_count > 1 else '') + json.dumps(image))
+        for category, counts, bbox, area in annotations:
+            self.annotation_count += 1
+            annotation = {'id': self.annotation_count, 'image_id': self.image_count, 'category_id': category,
+                          'segmentation': {'size': [height, width], 'counts': rle_string(counts)},
+                          'area': area, 'bbox': list(bbox), 'iscrowd': 1}
+            self.annotations.write((',' if self.annotation_count > 1 else '') + json.dumps(annotation))
+
+    def close(self):
+        if self.images is None:
+            return
+        self.images.close()
+        self.annotations.seek(0)
+        with open(self.path, 'w') as f:
+            f.write('{"images": [')
+            with open(self.path + '.tmp') as images:
+                for block in iter(lambda: images.read(1 << 20), ''):
+                    f.write(block)
+            f.write('], "annotations": [')
+            for block in iter(lambda: self.annotations.read(1 << 20), ''):
+                f.write(block)
+            f.write('], "categories": {}}}'.format(json.dumps(self.categories)))
+        self.annotations.close()
+        os.remove(self.path + '.tmp')
+        self.images = None
+
+
+WRITERS = {'npz': _NpzShardWriter, 'tfrecord': _TFRecordShardWriter}
+
+
+def run_export(image_dir, label_root, output_dir, export_format='npz', label_types=EXPORT_LABEL_TYPES,
+               val_fraction=0.2, size=None, crop='none', shard_mb=256, processes=None, allow_missing=False, seed=0,
+               log=print):
+    """Export the labelled images of image_dir and their masks as a training dataset in output_dir
+
+    Masks of each label type are read from label_root/<label type>, from its MaskStore when that is up to date.
+    Images are used if they have a mask for every label type, or for any of them with allow_missing. Each image goes
+    to the train or val split by a hash of its name. size (width, height) resizes, after cropping to the center at
+    the same aspect ratio or to the labels plus a margin if crop is given.
+
+    npz and tfrecord exports hold combined masks, with 0 for unlabelled pixels and the position of the label type in
+    label_types + 1 elsewhere, in shards of about shard_mb. coco exports have a <split>.json with an RLE mask per
+    label type. Images are prepared in a process pool and written in order as they come in, with only a few in flight
+    at a time, so memory use doesn't grow with the size of the folder. Returns the number of images that failed.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format {}'.format(export_format))
+    if crop == 'center' and size is None:
+        raise ValueError('Cropping to the center needs a size to take the aspect ratio from')
+    os.makedirs(output_dir, exist_ok=True)
+    label_dirs = [label_folder(label_root, label_type) for label_type in label_types]
+    labelled = []
+    for label_dir in label_dirs:
+        try:
+            labelled.append(set(os.listdir(label_dir)))
+        except OSError:
+            labelled.append(set())
+
+    def jobs():
+        for image_path in list_images(image_dir):
+            has_mask = [label_name(image_path) in names for names in labelled]
+            if all(has_mask) or (allow_missing and any(has_mask)):
+                yield (image_path, split_of(os.path.basename(image_path), val_fraction, seed),
+                       [label_dir if present else None for label_dir, present in zip(label_dirs, has_mask)],
+                       export_format, size, crop)
+
+    categories = [{'id': idx, 'name': label_type} for idx, label_type in enumerate(label_types, 1)]
+    if export_format == 'coco':
+        writers = {split: _CocoWriter(output_dir, split, categories) for split in ['train', 'val']}
+    else:
+        writers = {split: WRITERS[export_format](output_dir, split, shard_mb * 1024 * 1024) for split in ['train', 'val']}
+    processes = processes or os.cpu_count() or 1
+    log('Exporting to {} with {} processes'.format(output_dir, processes))
+    start = time.time()
+    counts = collections.Counter()
+    failed = 0
+    with process_pool(processes, _init_worker) as executor:
+        pending = collections.deque()
+        job_iter = jobs()
+        try:
+            while True:
+                # Only a couple of images per process are in flight, so results never pile up in memory
+                while len(pending) < 2 * processes:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    pending.append(executor.submit(prepare_sample, job))
+                if len(pending) == 0:
+                    break
+                image_path, split, sample, error = pending.popleft().result()
+                name = os.path.basename(image_path)
+                if error is None:
+                    writers[split].add(name, sample)
+                    counts[split] += 1
+                else:
+                    failed += 1
+                    log('{} failed: {}'.format(name, error))
+                done = sum(counts.values()) + failed
+                if done % 100 == 0:
+                    log('{} images, {:.1f}s'.format(done, time.time() - start))
+        finally:
+            for future in pending:
+                future.cancel()
+            for writer in writers.values():
+                writer.close()
+    with open(os.path.join(output_dir, 'dataset.json'), 'w') as f:
+        json.dump({'format': export_format, 'classes': ['unlabelled'] + list(label_types), 'size': size, 'crop': crop,
+                   'val_fraction': val_fraction, 'seed': seed, 'counts': dict(counts)}, f, indent=2)
+    log('Exported {} train and {} val images in {:.1f}s, {} failed'.format(counts['train'], counts['val'],
+                                                                           time.time() - start, failed))
+    return failed
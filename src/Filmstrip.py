@@ -0,0 +1,302 @@
+import collections
+import functools
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from PySide2.QtCore import QAbstractListModel, QItemSelectionModel, QModelIndex, QObject, QPoint, QRect, QSize, Qt, QTimer, Signal
+from PySide2.QtGui import QColor, QPainter, QPixmap
+from PySide2.QtWidgets import QAbstractItemView, QListView, QStyle, QStyledItemDelegate
+
+from .DiskCache import prune_cache, touch
+from .Processes import process_pool
+from .Profiling import timed
+from .SegmenterView import OUTLINE_COLORS
+from .Thumbnails import _init_worker, make_thumbnail, thumbnail_path
+
+PATH_ROLE = Qt.UserRole
+# List of whether the image is labelled, for each label type
+STATUS_ROLE = Qt.UserRole + 1
+
+
+class ThumbnailLoader(QObject):
+    """Makes thumbnails in a background process pool and keeps the most recently used ones in memory
+
+    Thumbnails are stored as jpegs in cache_dir, so each image is only decoded once however often it is shown, and
+    the least recently used ones are removed once the cache takes up more than max_cache_bytes. ready is emitted with
+    the image path once its thumbnail can be fetched with get(). Requests for images that scrolled out of view before
+    a process picked them up are dropped. If a process dies, the pool is started again and the thumbnails it had been
+    given are retried once.
+    """
+    ready = Signal(str)
+    # Emitted from the pool's thread with the image path, the cache path, None or the error message or exception if
+    # it couldn't be made, and the generation of the pool that was asked to make it
+    _made = Signal(str, str, object, int)
+    # Thumbnails made between prunes of the cache
+    prune_interval = 1000
+
+    def __init__(self, cache_dir, size=96, max_items=1000, processes=None, parent=None, max_cache_bytes=1024 ** 3):
+        super(ThumbnailLoader, self).__init__(parent)
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_items = max_items
+        self.processes = processes
+        self.max_cache_bytes = max_cache_bytes
+        self.pixmaps = collections.OrderedDict()
+        self.failed = set()
+        # Future of each thumbnail being made
+        self.pending = {}
+        # Number of times each image was being made when the pool broke
+        self.broken = collections.Counter()
+        self.last_request = []
+        self.made_count = 0
+        self.executor = None
+        # Incremented whenever the pool is started again, so that failures of a broken pool only restart it once
+        self.generation = 0
+        self._made.connect(self._thumbnail_made)
+
+    def get(self, path):
+        """The thumbnail of an image as a QPixmap, or None if it isn't loaded"""
+        pixmap = self.pixmaps.get(path)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(path)
+        return pixmap
+
+    def request(self, paths):
+        """Load the thumbnails of paths, in order, from the cache or by making them, and drop any other requests"""
+        self.last_request = list(paths)
+        wanted = set(paths)
+        for path, future in list(self.pending.items()):
+            if path not in wanted and future.cancel():
+                del self.pending[path]
+        for path in paths:
+            if path in self.pixmaps or path in self.pending or path in self.failed:
+                continue
+            cache_path = thumbnail_path(self.cache_dir, path, self.size)
+            if cache_path is None:
+                self.failed.add(path)
+            elif os.path.exists(cache_path):
+                # Small enough to read straight away
+                touch(cache_path)
+                self._add(path, cache_path)
+            else:
+                future = self._executor().submit(make_thumbnail, (path, cache_path, self.size))
+                future.add_done_callback(functools.partial(self._future_done, path, cache_path, self.generation))
+                self.pending[path] = future
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = process_pool(self.processes, _init_worker)
+            self._prune()
+        return self.executor
+
+    def _prune(self):
+        if self.max_cache_bytes is not None:
+            self._executor().submit(prune_cache, self.cache_dir, self.max_cache_bytes, 2)
+
+    def _future_done(self, path, cache_path, generation, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self._made.emit(path, cache_path, error, generation)
+        else:
+            self._made.emit(*future.result(), generation)
+
+    def _thumbnail_made(self, path, cache_path, error, generation):
+        if generation != self.generation:
+            # From a pool that has been shut down, its thumbnails have been dropped or requested again
+            return
+        if isinstance(error, BrokenProcessPool):
+            # Every thumbnail the pool had been given fails with it, and is tried again in a new pool unless it was
+            # being made the last time the pool broke too
+            for broken_path in self.pending:
+                self.broken[broken_path] += 1
+                if self.broken[broken_path] > 1:
+                    self.failed.add(broken_path)
+            self.pending.clear()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            self.generation += 1
+            QTimer.singleShot(0, lambda: self.request(self.last_request))
+            return
+        self.pending.pop(path, None)
+        if error is not None:
+            self.failed.add(path)
+        else:
+            self._add(path, cache_path)
+            self.made_count += 1
+            if self.made_count % self.prune_interval == 0:
+                self._prune()
+
+    @timed('thumbnail/load')
+    def _add(self, path, cache_path):
+        pixmap = QPixmap(cache_path)
+        if pixmap.isNull():
+            self.failed.add(path)
+            return
+        self.pixmaps[path] = pixmap
+        while len(self.pixmaps) > self.max_items:
+            self.pixmaps.popitem(last=False)
+        self.ready.emit(path)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            self.generation += 1
+        self.pending.clear()
+
+
+class FilmstripModel(QAbstractListModel):
+    """List of the images in the folder with their thumbnails and label status, read from a LabelIndex"""
+    def __init__(self, loader, label_index, label_types, parent=None):
+        super(FilmstripModel, self).__init__(parent)
+        self.loader = loader
+        self.label_index = label_index
+        self.label_types = list(label_types)
+        self.paths = []
+        self.rows = {}
+        self.loader.ready.connect(self.thumbnail_ready)
+
+    def set_paths(self, paths):
+        self.beginResetModel()
+        self.paths = list(paths)
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.paths):
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.splitext(os.path.basename(path))[0]
+        elif role == Qt.ToolTipRole:
+            status = self.data(index, STATUS_ROLE)
+            labelled = [label_type for label_type, done in zip(self.label_types, status) if done]
+            return '{}\nLabelled: {}'.format(os.path.basename(path), ', '.join(labelled) if labelled else 'none')
+        elif role == Qt.DecorationRole:
+            return self.loader.get(path)
+        elif role == PATH_ROLE:
+            return path
+        elif role == STATUS_ROLE:
+            return [self.label_index.is_labelled(label_type, index.row()) for label_type in self.label_types]
+        return None
+
+    def thumbnail_ready(self, path):
+        row = self.rows.get(path)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def refresh_status(self):
+        """Redraw the label badges, after the label index has changed"""
+        if len(self.paths) > 0:
+            self.dataChanged.emit(self.index(0), self.index(len(self.paths) - 1), [STATUS_ROLE])
+
+
+class FilmstripDelegate(QStyledItemDelegate):
+    """Draws a thumbnail with the image name under it, and a badge per label type that is filled in if it's labelled
+
+    Badges use the same colours as the outlines of the other label types in the viewer.
+    """
+    def __init__(self, thumbnail_size, parent=None, margin=4, badge_size=10):
+        super(FilmstripDelegate, self).__init__(parent)
+        self.thumbnail_size = thumbnail_size
+        self.margin = margin
+        self.badge_size = badge_size
+
+    def sizeHint(self, option, index):
+        return QSize(self.thumbnail_size + 2 * self.margin,
+                     self.thumbnail_size + option.fontMetrics.height() + 3 * self.margin)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        left, top = option.rect.left() + self.margin, option.rect.top() + self.margin
+        thumbnail_rect = QRect(left, top, self.thumbnail_size, self.thumbnail_size)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is None:
+            painter.fillRect(thumbnail_rect, QColor(64, 64, 64))
+        else:
+            painter.drawPixmap(left + (self.thumbnail_size - pixmap.width()) // 2,
+                               top + (self.thumbnail_size - pixmap.height()) // 2, pixmap)
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        for idx, labelled in enumerate(index.data(STATUS_ROLE) or []):
+            color = OUTLINE_COLORS[idx % len(OUTLINE_COLORS)]
+            badge = QRect(left + 2 + idx * (self.badge_size + 3), top + 2, self.badge_size, self.badge_size)
+            painter.setPen(QColor(0, 0, 0))
+            painter.setBrush(color if labelled else QColor(0, 0, 0, 96))
+            painter.drawEllipse(badge)
+
+        text_rect = QRect(option.rect.left(), top + self.thumbnail_size + self.margin, option.rect.width(),
+                          option.fontMetrics.height())
+        text = option.fontMetrics.elidedText(index.data(Qt.DisplayRole), Qt.ElideMiddle, text_rect.width() - 4)
+        painter.setPen(option.palette.highlightedText().color() if option.state & QStyle.State_Selected
+                       else option.palette.text().color())
+        painter.drawText(text_rect, Qt.AlignCenter, text)
+        painter.restore()
+
+
+class FilmstripView(QListView):
+    """Scrolling list of image thumbnails
+
+    Every row has the same size, so the view only lays out and paints the rows on screen, and thumbnails are only
+    requested for those and a screenful either side, which keeps it smooth with tens of thousands of images.
+    """
+    def __init__(self, loader, parent=None):
+        super(FilmstripView, self).__init__(parent)
+        self.loader = loader
+        self.setUniformItemSizes(True)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        # Thumbnails are requested once scrolling pauses, rather than for every row that flies past
+        self.request_timer = QTimer(self)
+        self.request_timer.setSingleShot(True)
+        self.request_timer.setInterval(30)
+        self.request_timer.timeout.connect(self.request_visible)
+        self.verticalScrollBar().valueChanged.connect(self.schedule_request)
+
+    def setModel(self, model):
+        super(FilmstripView, self).setModel(model)
+        model.modelReset.connect(self.schedule_request)
+
+    def resizeEvent(self, event):
+        super(FilmstripView, self).resizeEvent(event)
+        self.schedule_request()
+
+    def showEvent(self, event):
+        super(FilmstripView, self).showEvent(event)
+        self.schedule_request()
+
+    def schedule_request(self, *args):
+        self.request_timer.start()
+
+    def request_visible(self):
+        model = self.model()
+        if model is None or model.rowCount() == 0 or not self.isVisible():
+            return
+        viewport = self.viewport().rect()
+        first = self.indexAt(QPoint(viewport.center().x(), viewport.top() + 1)).row()
+        last = self.indexAt(QPoint(viewport.center().x(), viewport.bottom() - 1)).row()
+        first = max(first, 0)
+        last = model.rowCount() - 1 if last < 0 else last
+        page = last - first + 1
+        rows = list(range(first, last + 1))
+        rows += list(range(last + 1, min(model.rowCount(), last + 1 + page)))
+        rows += list(range(first - 1, max(-1, first - 1 - page), -1))
+        self.loader.request([model.data(model.index(row), PATH_ROLE) for row in rows])
+
+    def set_current_row(self, row):
+        """Select and scroll to a row without emitting clicked or activated"""
+        model = self.model()
+        if model is None or row is None or not 0 <= row < model.rowCount():
+            return
+        index = model.index(row)
+        self.selectionModel().setCurrentIndex(index, QItemSelectionModel.ClearAndSelect)
+        self.scrollTo(index)
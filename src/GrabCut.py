@@ -0,0 +1,570 @@
+import concurrent.futures
+import math
+import multiprocessing
+import os
+
+import cv2
+import numpy as np
+
+from .Masks import BACKGROUND, EMPTY, FOREGROUND, POSSIBLE_FOREGROUND
+from .Processes import process_pool
+from .Profiling import StageTimer
+from .Superpixels import Superpixels, min_cut
+
+
+# Not available in older OpenCV builds, where GC_EVAL re-learns the colour models from each refinement tile instead
+GC_EVAL_FREEZE_MODEL = getattr(cv2, 'GC_EVAL_FREEZE_MODEL', None)
+
+# GrabCut mask value for each class of a segmentation mask, indexed by class
+SEED_VALUES = np.array([cv2.GC_PR_BGD, cv2.GC_FGD, cv2.GC_PR_FGD, cv2.GC_BGD], dtype=np.uint8)
+# New class of each class of a segmentation mask, plus 4 where the new foreground is set, see _composite
+COMPOSITE_TABLE = np.zeros(256, dtype=np.uint8)
+COMPOSITE_TABLE[[FOREGROUND, FOREGROUND + 4]] = FOREGROUND
+COMPOSITE_TABLE[[BACKGROUND, BACKGROUND + 4]] = BACKGROUND
+COMPOSITE_TABLE[[EMPTY + 4, POSSIBLE_FOREGROUND + 4]] = POSSIBLE_FOREGROUND
+
+
+class GrabCutCancelled(Exception):
+    pass
+
+
+class _Reporter(object):
+    def __init__(self, total_steps, progress=None, is_cancelled=None):
+        self.total_steps = total_steps
+        self.progress = progress
+        self.is_cancelled = is_cancelled
+
+    def __call__(self, step):
+        if self.progress is not None:
+            self.progress(step, self.total_steps)
+        if self.is_cancelled is not None and self.is_cancelled():
+            raise GrabCutCancelled()
+
+
+def _check_seeds(has_fg, has_bg):
+    if not has_bg:
+        raise ValueError('You must select some background or empty area.')
+    elif not has_fg:
+        raise ValueError('You must select some foreground or possible foreground.')
+
+
+def _composite(foreground, segmentation):
+    """Merge a full resolution 0/255 foreground mask back into the class mask as possible foreground
+
+    Foreground and background strokes are kept, everything else becomes possible foreground or empty.
+    """
+    return cv2.LUT(cv2.add(segmentation, cv2.bitwise_and(foreground, 4)), COMPOSITE_TABLE)
+
+
+class GrabCutState(object):
+    """Colour models and masks from the last GrabCut run on an image, used to warm start the next run
+
+    key identifies the working resolution and region the masks belong to. seeds are the seeds of the segmentation the
+    last run produced, i.e. what the user was shown, so that the next run can tell which pixels the user has changed
+    since. The colour models do not depend on the resolution, so they are reused even when the key changes. Arrays
+    held here are never modified in place, so a shallow copy is enough to hand the state to a background job.
+    """
+    def __init__(self):
+        self.key = None
+        self.seeds = None
+        self.mask = None
+        self.bgd_model = None
+        self.fgd_model = None
+        # Refinement inputs, outputs and colour models of the multi-resolution and tiled modes
+        self.refine_key = None
+        self.refine_input = None
+        self.refine_result = None
+        self.refine_models = None
+
+    def copy(self):
+        state = GrabCutState()
+        state.__dict__.update(self.__dict__)
+        return state
+
+    def is_warm(self):
+        return self.bgd_model is not None
+
+
+def _iterate_grabcut(seeds, image, iterations, report, state=None, key=None, warm_iterations=1):
+    """Run GrabCut from a mask of seeds, warm starting from state if it holds a previous run
+
+    A warm start begins from the previous result with only the seeds that changed since then applied, and evaluates
+    with the cached colour models instead of reinitialising them with k-means. Changes are found by comparing against
+    the result, not the previous seeds, so erasing area the last run grew into counts as a change.
+    """
+    if state is not None and state.is_warm():
+        bgd_model = state.bgd_model.copy()
+        fgd_model = state.fgd_model.copy()
+        if state.key == key:
+            mask = state.mask.copy()
+            changed = seeds != state.seeds
+            mask[changed] = seeds[changed]
+        else:
+            mask = seeds.copy()
+        mode = cv2.GC_EVAL
+        report.total_steps -= iterations - warm_iterations
+        iterations = warm_iterations
+    else:
+        bgd_model = np.zeros((1, 65), np.float64)
+        fgd_model = np.zeros((1, 65), np.float64)
+        mask = seeds.copy()
+        mode = cv2.GC_INIT_WITH_MASK
+    # One iteration per call so that progress can be reported and cancellation checked in between
+    for step in range(iterations):
+        mask, bgd_model, fgd_model = cv2.grabCut(image, mask, None, bgd_model, fgd_model, 1, mode)
+        mode = cv2.GC_EVAL
+        report(step + 1)
+    if state is not None:
+        state.key = key
+        # Strokes are kept and everything else is probable foreground or background, the seeds of the segmentation
+        # composited from this result
+        state.seeds = mask.copy()
+        state.mask = mask.copy()
+        state.bgd_model = bgd_model.copy()
+        state.fgd_model = fgd_model.copy()
+    return mask, bgd_model, fgd_model
+
+
+def grabcut_segmentation(image, segmentation, rescale_factor=0.125, iterations=2, state=None, progress=None, is_cancelled=None):
+    """Run GrabCut on a BGR image using a class mask as seeds
+
+    Returns the new class mask. Raises ValueError if the seeds are insufficient
+    and GrabCutCancelled if is_cancelled() becomes true between iterations. If a GrabCutState is given, the run is
+    warm started from it and it is updated with the new result.
+    """
+    report = _Reporter(iterations + 1, progress, is_cancelled)
+    stages = StageTimer('grabcut')
+
+    image_height, image_width = image.shape[:2]
+    image = cv2.resize(image, (int(image_width * rescale_factor), int(image_height * rescale_factor)), interpolation=cv2.INTER_NEAREST)
+    new_segmentation = cv2.resize(segmentation, (int(image_width * rescale_factor), int(image_height * rescale_factor)), interpolation=cv2.INTER_NEAREST)
+
+    mask = seed_mask(new_segmentation)
+    # GC_FGD and GC_PR_FGD are the odd mask values
+    foreground_count = cv2.countNonZero(mask & 1)
+    _check_seeds(foreground_count > 0, foreground_count < mask.size)
+    report(0)
+    stages.mark('resize')
+
+    mask, _, _ = _iterate_grabcut(mask, image, iterations, report, state=state, key=mask.shape)
+    stages.mark('grabCut')
+
+    pfg = ((mask & 1) * 255).astype(np.uint8)
+    new_segmentation = cv2.resize(pfg, (image_width, image_height), interpolation=cv2.INTER_NEAREST)
+    stages.mark('upscale')
+    new_segmentation = _composite(new_segmentation, segmentation)
+    stages.mark('composite')
+    report(report.total_steps)
+    return new_segmentation
+
+
+def seed_mask(segmentation):
+    """Convert a class mask into a GrabCut mask"""
+    return SEED_VALUES[segmentation]
+
+
+def stroke_roi(foreground, margin=0.25, min_margin=32):
+    """Bounding box (x0, y0, x1, y1) of the non-zero pixels of a foreground seed mask, padded by a relative margin"""
+    x0, y0, roi_width, roi_height = cv2.boundingRect(foreground)
+    if roi_width == 0 or roi_height == 0:
+        return None
+    x1, y1 = x0 + roi_width, y0 + roi_height
+    pad = max(min_margin, int(margin * max(x1 - x0, y1 - y0)))
+    height, width = foreground.shape
+    return max(0, x0 - pad), max(0, y0 - pad), min(width, x1 + pad), min(height, y1 + pad)
+
+
+def _solve_tile(job):
+    """GrabCut one (image, mask, bgd_model, fgd_model) tile with fixed colour models and return its new mask"""
+    tile_image, tile_mask, bgd_model, fgd_model = job
+    if GC_EVAL_FREEZE_MODEL is not None:
+        tile_mask, _, _ = cv2.grabCut(tile_image, tile_mask, None, bgd_model.copy(), fgd_model.copy(), 1, GC_EVAL_FREEZE_MODEL)
+    elif np.any(tile_mask % 2 == 0) and np.any(tile_mask % 2 == 1):
+        tile_mask, _, _ = cv2.grabCut(tile_image, tile_mask, None, bgd_model.copy(), fgd_model.copy(), 1, cv2.GC_EVAL)
+    return tile_mask
+
+
+def grabcut_multiresolution(image, segmentation, iterations=2, coarse_pixels=120000, refine_pixels=16000000,
+                            tile_size=128, tile_padding=16, max_samples=200000, state=None, progress=None, is_cancelled=None):
+    """Coarse-to-fine GrabCut restricted to the region around the foreground strokes
+
+    GrabCut is solved on a downscaled crop of the stroke bounding box (plus margin) with at most coarse_pixels pixels.
+    The coarse boundary is then refined at up to full resolution, but only inside the band of pixels that the
+    coarse solution could not resolve, one tile at a time with the colour models from the coarse pass. Everything
+    outside of the region of interest is treated as background. Only the coarse pass is warm started from state.
+    """
+    report = _Reporter(iterations + 2, progress, is_cancelled)
+    stages = StageTimer('grabcut')
+    image_height, image_width = image.shape[:2]
+    any_foreground = ((segmentation == FOREGROUND) | (segmentation == POSSIBLE_FOREGROUND)).astype(np.uint8)
+    roi = stroke_roi(any_foreground)
+    _check_seeds(roi is not None, cv2.countNonZero(any_foreground) < any_foreground.size)
+    x0, y0, x1, y1 = roi
+    roi_image = image[y0:y1, x0:x1]
+    roi_mask = seed_mask(segmentation[y0:y1, x0:x1])
+    roi_height, roi_width = roi_mask.shape
+    # GC_FGD and GC_PR_FGD are the odd mask values
+    _check_seeds(True, cv2.countNonZero(roi_mask & 1) < roi_mask.size)
+    report(0)
+
+    # Coarse pass
+    coarse_scale = min(1.0, math.sqrt(coarse_pixels / float(roi_width * roi_height)))
+    coarse_size = (max(1, int(roi_width * coarse_scale)), max(1, int(roi_height * coarse_scale)))
+    coarse_image = cv2.resize(roi_image, coarse_size, interpolation=cv2.INTER_AREA)
+    coarse_mask = cv2.resize(roi_mask, coarse_size, interpolation=cv2.INTER_NEAREST)
+    stages.mark('resize')
+    coarse_mask, bgd_model, fgd_model = _iterate_grabcut(coarse_mask, coarse_image, iterations, report,
+                                                         state=state, key=(roi, coarse_size))
+    stages.mark('coarse grabCut')
+    coarse_fg = ((coarse_mask == cv2.GC_FGD) | (coarse_mask == cv2.GC_PR_FGD)).astype(np.float32)
+
+    # Refinement pass, limited to a band around the coarse boundary
+    refine_scale = min(1.0, math.sqrt(refine_pixels / float(roi_width * roi_height)))
+    refine_size = (max(1, int(roi_width * refine_scale)), max(1, int(roi_height * refine_scale)))
+    if refine_size != (roi_width, roi_height):
+        refine_image = cv2.resize(roi_image, refine_size, interpolation=cv2.INTER_AREA)
+        refine_seeds = cv2.resize(roi_mask, refine_size, interpolation=cv2.INTER_NEAREST)
+    else:
+        refine_image = roi_image
+        refine_seeds = roi_mask
+    refine_fg = cv2.resize(coarse_fg, refine_size, interpolation=cv2.INTER_LINEAR) > 0.5
+
+    # A coarse pixel covers 1 / (coarse_scale / refine_scale) refined pixels, so the boundary is uncertain by about that much
+    band_radius = int(math.ceil(refine_scale / coarse_scale)) + 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band_radius + 1, 2 * band_radius + 1))
+    refine_fg_u8 = refine_fg.astype(np.uint8)
+    band = cv2.dilate(refine_fg_u8, kernel) != cv2.erode(refine_fg_u8, kernel)
+    user_seeds = (refine_seeds == cv2.GC_FGD) | (refine_seeds == cv2.GC_BGD)
+    band &= ~user_seeds
+
+    refine_mask = np.where(refine_fg, cv2.GC_FGD, cv2.GC_BGD).astype(np.uint8)
+    refine_mask[band] = np.where(refine_fg[band], cv2.GC_PR_FGD, cv2.GC_PR_BGD)
+    refine_mask[user_seeds] = refine_seeds[user_seeds]
+
+    refine_key = (roi, refine_size)
+    warm_refine = state is not None and state.refine_key == refine_key
+    if warm_refine:
+        bgd_model, fgd_model = state.refine_models
+    else:
+        # The coarse colour models were learnt from area-averaged pixels, so relearn them from full detail pixels
+        # sampled around the band before refining
+        near_band = cv2.dilate(band.astype(np.uint8), kernel, iterations=2).astype(bool)
+        sample_idx = np.flatnonzero(near_band)
+        if len(sample_idx) > max_samples:
+            sample_idx = np.random.RandomState(0).choice(sample_idx, max_samples, replace=False)
+        sample_labels = np.where(refine_fg.ravel()[sample_idx], cv2.GC_PR_FGD, cv2.GC_PR_BGD).astype(np.uint8)
+        if len(sample_idx) > 0 and sample_labels.min() != sample_labels.max():
+            sample_image = refine_image.reshape(-1, 3)[sample_idx].reshape(1, -1, 3)
+            cv2.grabCut(sample_image, sample_labels.reshape(1, -1), None, bgd_model, fgd_model, 0, cv2.GC_INIT_WITH_MASK)
+    stages.mark('band')
+
+    refine_height, refine_width = refine_mask.shape
+    tiles = []
+    for ty in range(0, refine_height, tile_size):
+        for tx in range(0, refine_width, tile_size):
+            if band[ty:ty + tile_size, tx:tx + tile_size].any():
+                tiles.append((tx, ty))
+    coarse_steps = report.total_steps - 2
+    report.total_steps = coarse_steps + 2 + len(tiles)
+    result = refine_mask.copy()
+    for tile_idx, (tx, ty) in enumerate(tiles):
+        px0, py0 = max(0, tx - tile_padding), max(0, ty - tile_padding)
+        px1, py1 = min(refine_width, tx + tile_size + tile_padding), min(refine_height, ty + tile_size + tile_padding)
+        tile_mask = refine_mask[py0:py1, px0:px1].copy()
+        tile_image = np.ascontiguousarray(refine_image[py0:py1, px0:px1])
+        if warm_refine and np.array_equal(tile_mask, state.refine_input[py0:py1, px0:px1]):
+            # Same inputs and models as last time, so the previous result for this tile still holds
+            result[ty:ty + tile_size, tx:tx + tile_size] = state.refine_result[ty:ty + tile_size, tx:tx + tile_size]
+            report(coarse_steps + 1 + tile_idx)
+            continue
+        tile_mask = _solve_tile((tile_image, tile_mask, bgd_model, fgd_model))
+        core_x0, core_y0 = tx - px0, ty - py0
+        core = tile_mask[core_y0:core_y0 + tile_size, core_x0:core_x0 + tile_size]
+        result[ty:ty + core.shape[0], tx:tx + core.shape[1]] = core
+        report(coarse_steps + 1 + tile_idx)
+    if state is not None:
+        state.refine_key = refine_key
+        state.refine_input = refine_mask
+        state.refine_result = result
+        state.refine_models = (bgd_model, fgd_model)
+    stages.mark('refine grabCut')
+
+    roi_fg = ((result == cv2.GC_FGD) | (result == cv2.GC_PR_FGD)).astype(np.uint8) * 255
+    if refine_size != (roi_width, roi_height):
+        roi_fg = cv2.resize(roi_fg, (roi_width, roi_height), interpolation=cv2.INTER_LINEAR)
+        roi_fg = np.where(roi_fg > 127, 255, 0).astype(np.uint8)
+    foreground = np.zeros((image_height, image_width), dtype=np.uint8)
+    foreground[y0:y1, x0:x1] = roi_fg
+    stages.mark('upscale')
+    new_segmentation = _composite(foreground, segmentation)
+    stages.mark('composite')
+    report(report.total_steps)
+    return new_segmentation
+
+
+def _init_tile_worker():
+    # Each process solves its own tile, so OpenCV's internal threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+# Shared by every tiled run, so the worker processes are only started once
+_tile_pool = None
+_tile_pool_processes = None
+
+
+def _tile_executor(processes):
+    """Process pool for solving tiles, or None if this process can't start one"""
+    global _tile_pool, _tile_pool_processes
+    # Workers of a multiprocessing pool, as used by the batch command, aren't allowed children of their own
+    if multiprocessing.current_process().daemon:
+        return None
+    if _tile_pool is None or _tile_pool_processes != processes:
+        if _tile_pool is not None:
+            _tile_pool.shutdown(wait=False)
+        _tile_pool = process_pool(processes, _init_tile_worker)
+        _tile_pool_processes = processes
+    return _tile_pool
+
+
+def _reset_tile_executor():
+    global _tile_pool, _tile_pool_processes
+    if _tile_pool is not None:
+        _tile_pool.shutdown(wait=False)
+    _tile_pool = None
+    _tile_pool_processes = None
+
+
+def tile_grid(height, width, tile_size, overlap):
+    """(x0, y0, x1, y1) of the tiles covering an image, each tile_size square plus overlap on every side"""
+    tiles = []
+    for ty in range(0, height, tile_size):
+        for tx in range(0, width, tile_size):
+            tiles.append((max(0, tx - overlap), max(0, ty - overlap),
+                          min(width, tx + tile_size + overlap), min(height, ty + tile_size + overlap)))
+    return tiles
+
+
+def _tile_weights(tile, height, width, overlap):
+    """Blending weight of each pixel of a tile from 0 to 100, ramping up from the tile edges over the overlap
+
+    Edges on the border of the image aren't ramped, since no other tile covers the pixels there.
+    """
+    x0, y0, x1, y1 = tile
+    ramps = []
+    for start, end, size in [(y0, y1, height), (x0, x1, width)]:
+        positions = np.arange(start, end)
+        distance = np.full(end - start, np.inf)
+        if start > 0:
+            distance = np.minimum(distance, positions - start + 1)
+        if end < size:
+            distance = np.minimum(distance, end - positions)
+        ramps.append(np.minimum(1.0, distance / float(overlap + 1)))
+    return np.round(100 * ramps[0][:, None] * ramps[1][None, :]).astype(np.int16)
+
+
+def _pin_edges(tile_mask, tile, height, width):
+    """Fix the edges of a tile that border other tiles to their starting labels
+
+    Without this, a tile is cut as if nothing lay beyond its edges, and areas that the colour models leave unsure of
+    can flip to whichever label is cheaper inside the tile rather than following the rest of the image.
+    """
+    x0, y0, x1, y1 = tile
+    edges = []
+    if y0 > 0:
+        edges.append(np.s_[0, :])
+    if y1 < height:
+        edges.append(np.s_[-1, :])
+    if x0 > 0:
+        edges.append(np.s_[:, 0])
+    if x1 < width:
+        edges.append(np.s_[:, -1])
+    for edge in edges:
+        # GC_FGD and GC_PR_FGD are the odd mask values
+        tile_mask[edge] = np.where(tile_mask[edge] & 1, cv2.GC_FGD, cv2.GC_BGD)
+    return tile_mask
+
+
+def grabcut_tiled(image, segmentation, iterations=2, coarse_pixels=120000, tile_size=512, overlap=32, processes=None,
+                  max_samples=200000, state=None, progress=None, is_cancelled=None):
+    """Full resolution GrabCut split into overlapping tiles that are solved in parallel by a pool of processes
+
+    The colour models are learnt once for the whole image: GrabCut is solved on a downscaled copy of the image, then
+    the models are relearnt from full resolution pixels labelled by that solution. Every tile is then cut with those
+    models fixed, starting from the downscaled solution, so the tiles agree on what foreground and background look
+    like, and with their edges held to the downscaled solution. Tiles overlap by overlap pixels on each side, and the
+    overlapping results are blended with weights that fall off towards each tile's edge, so the seams follow the tile
+    that saw the most context. Tiles holding only strokes are skipped. Only the coarse pass and tiles whose inputs haven't changed are reused from state.
+    """
+    report = _Reporter(iterations + 2, progress, is_cancelled)
+    stages = StageTimer('grabcut')
+    height, width = segmentation.shape
+    seeds = seed_mask(segmentation)
+    # GC_FGD and GC_PR_FGD are the odd mask values
+    foreground_count = cv2.countNonZero(seeds & 1)
+    _check_seeds(foreground_count > 0, foreground_count < seeds.size)
+    report(0)
+
+    # Coarse pass for the colour models and the starting labels
+    coarse_scale = min(1.0, math.sqrt(coarse_pixels / float(height * width)))
+    coarse_size = (max(1, int(width * coarse_scale)), max(1, int(height * coarse_scale)))
+    coarse_image = cv2.resize(image, coarse_size, interpolation=cv2.INTER_AREA)
+    coarse_mask = cv2.resize(seeds, coarse_size, interpolation=cv2.INTER_NEAREST)
+    stages.mark('resize')
+    coarse_mask, bgd_model, fgd_model = _iterate_grabcut(coarse_mask, coarse_image, iterations, report,
+                                                         state=state, key=('tiled', coarse_size))
+    stages.mark('coarse grabCut')
+    coarse_fg = ((coarse_mask & 1) * 255).astype(np.uint8)
+    _, initial_fg = cv2.threshold(cv2.resize(coarse_fg, (width, height), interpolation=cv2.INTER_LINEAR), 127, 1,
+                                  cv2.THRESH_BINARY)
+    hard = (seeds == cv2.GC_FGD) | (seeds == cv2.GC_BGD)
+    initial = np.where(hard, seeds, cv2.GC_PR_BGD + initial_fg * (cv2.GC_PR_FGD - cv2.GC_PR_BGD)).astype(np.uint8)
+
+    tiles_key = ('tiled', (height, width), tile_size, overlap)
+    warm_tiles = state is not None and state.refine_key == tiles_key
+    if warm_tiles:
+        bgd_model, fgd_model = state.refine_models
+    else:
+        # The coarse colour models were learnt from area-averaged pixels, so relearn them from full detail pixels
+        sample_idx = np.flatnonzero(~hard)
+        # An even spread over the image, which is much quicker than a random choice from tens of millions of pixels
+        sample_idx = sample_idx[::max(1, len(sample_idx) // max_samples)]
+        sample_labels = initial.ravel()[sample_idx]
+        if len(sample_idx) > 0 and (sample_labels & 1).min() != (sample_labels & 1).max():
+            sample_image = image.reshape(-1, 3)[sample_idx].reshape(1, -1, 3)
+            cv2.grabCut(sample_image, sample_labels.reshape(1, -1), None, bgd_model, fgd_model, 0, cv2.GC_INIT_WITH_MASK)
+    stages.mark('models')
+
+    jobs = []
+    for tile in tile_grid(height, width, tile_size, overlap):
+        x0, y0, x1, y1 = tile
+        tile_mask = initial[y0:y1, x0:x1]
+        if hard[y0:y1, x0:x1].all():
+            continue
+        if warm_tiles and tile in state.refine_result and np.array_equal(tile_mask, state.refine_input[y0:y1, x0:x1]):
+            # Same inputs and models as last time, so the previous result for this tile still holds
+            jobs.append((tile, None))
+        else:
+            tile_mask = _pin_edges(tile_mask.copy(), tile, height, width)
+            jobs.append((tile, (np.ascontiguousarray(image[y0:y1, x0:x1]), tile_mask, bgd_model, fgd_model)))
+    pending = [(tile, job) for tile, job in jobs if job is not None]
+    coarse_steps = report.total_steps - 2
+    report.total_steps = coarse_steps + 2 + len(pending)
+
+    solved = {}
+    executor = None
+    if len(pending) > 1 and processes != 1:
+        executor = _tile_executor(processes or os.cpu_count())
+    futures = {}
+    try:
+        if executor is not None:
+            try:
+                futures = {executor.submit(_solve_tile, job): tile for tile, job in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    solved[futures[future]] = future.result() & 1
+                    report(coarse_steps + len(solved))
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died, so the rest of the tiles are solved here and a new pool is started next time
+                _reset_tile_executor()
+        for tile, job in pending:
+            if tile not in solved:
+                solved[tile] = _solve_tile(job) & 1
+                report(coarse_steps + len(solved))
+    finally:
+        # Tiles that haven't started yet are dropped if the run is cancelled
+        for future in futures:
+            future.cancel()
+    stages.mark('tiles')
+
+    # Each tile votes for foreground or background with its blending weights, and pixels in no solved tile are strokes
+    votes = np.zeros((height, width), dtype=np.int16)
+    for tile, job in jobs:
+        x0, y0, x1, y1 = tile
+        if job is None:
+            solved[tile] = state.refine_result[tile]
+        weights = _tile_weights(tile, height, width, overlap)
+        votes[y0:y1, x0:x1] += np.where(solved[tile], weights, -weights)
+    if state is not None:
+        state.refine_key = tiles_key
+        state.refine_input = initial
+        state.refine_result = solved
+        state.refine_models = (bgd_model, fgd_model)
+    foreground = (votes > 0).astype(np.uint8) * 255
+    stages.mark('blend')
+    new_segmentation = _composite(foreground, segmentation)
+    stages.mark('composite')
+    report(report.total_steps)
+    return new_segmentation
+
+
+def _colour_costs(colors, members, clusters=5, max_samples=20000):
+    """Distance from each colour to the nearest k-means centre of the colours picked out by members
+
+    At most max_samples of the member colours are clustered, so this also works on every pixel of an image.
+    """
+    samples = colors[members]
+    if len(samples) > max_samples:
+        samples = samples[np.random.RandomState(0).choice(len(samples), max_samples, replace=False)]
+    clusters = min(clusters, len(samples))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+    _, _, centers = cv2.kmeans(samples.astype(np.float32), clusters, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    centers = centers.astype(colors.dtype)
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, which is a matrix product rather than a pass over the colours per centre
+    distances = (-2 * centers).dot(colors.T)
+    distances += np.einsum('ij,ij->i', centers, centers)[:, None]
+    distances = distances.min(axis=0) + np.einsum('ij,ij->i', colors, colors)
+    return np.sqrt(np.maximum(distances, 0))
+
+
+def superpixel_segmentation(image, segmentation, superpixels=None, iterations=2, smoothness=1.0, state=None,
+                            progress=None, is_cancelled=None):
+    """Segment on the graph of superpixels rather than on pixels, in the style of Lazy Snapping
+
+    Superpixels touched by foreground or background strokes are fixed, and colour models of the rest are fitted like
+    GrabCut's: possible foreground starts as foreground and empty area as background. Each round fits k-means colour
+    clusters to both sides and solves a min cut where keeping neighbouring superpixels together costs more the more
+    alike they are and the longer the boundary they share. superpixels should be precomputed for the image, they are
+    computed here if not given. state is accepted for a common interface with the other engines and isn't used.
+    """
+    report = _Reporter(iterations + 1, progress, is_cancelled)
+    stages = StageTimer('grabcut')
+    if superpixels is None or superpixels.full_shape != segmentation.shape:
+        superpixels = Superpixels.compute(image, segmentation.shape)
+    stages.mark('superpixels')
+
+    counts = superpixels.class_counts(segmentation, [FOREGROUND, POSSIBLE_FOREGROUND, BACKGROUND])
+    hard_fg = counts[:, 0] > counts[:, 2]
+    hard_bg = counts[:, 2] > counts[:, 0]
+    foreground = hard_fg | ((counts[:, 1] > 0) & ~hard_bg)
+    _check_seeds(foreground.any(), not foreground.all())
+    report(0)
+
+    sizes = superpixels.sizes
+    color_diff = ((superpixels.colors[superpixels.edges[:, 0]] - superpixels.colors[superpixels.edges[:, 1]]) ** 2).sum(axis=1)
+    beta = 1.0 / (2 * max(color_diff.mean(), 1e-6))
+    # Boundaries grow with the square root of area, so the smoothness term is scaled to match the area weighted data
+    edge_caps = smoothness * np.sqrt(sizes.mean()) * superpixels.edge_lengths * np.exp(-beta * color_diff) / 4
+    hard = sizes.sum() + 1
+    stages.mark('graph')
+    for step in range(iterations):
+        fg_cost = _colour_costs(superpixels.colors, foreground)
+        bg_cost = _colour_costs(superpixels.colors, ~foreground)
+        total = np.maximum(fg_cost + bg_cost, 1e-6)
+        # The source side is foreground, so the source link is cut when a superpixel is labelled background and its
+        # capacity is the cost of that label
+        source_caps = sizes * bg_cost / total
+        sink_caps = sizes * fg_cost / total
+        source_caps[hard_fg], sink_caps[hard_fg] = hard, 0
+        source_caps[hard_bg], sink_caps[hard_bg] = 0, hard
+        foreground = min_cut(source_caps, sink_caps, superpixels.edges, edge_caps)
+        report(step + 1)
+        if not foreground.any() or foreground.all():
+            break
+    stages.mark('min cut')
+
+    new_segmentation = superpixels.to_full(np.where(foreground, 255, 0).astype(np.uint8))
+    stages.mark('upscale')
+    new_segmentation = _composite(new_segmentation, segmentation)
+    stages.mark('composite')
+    report(report.total_steps)
+    return new_segmentation
+
@@ -0,0 +1,105 @@
+import collections
+import zlib
+
+import numpy as np
+
+
+class TileHistory(object):
+    """Undo/redo history that only stores the tiles each operation changed
+
+    An operation is started with begin(), the tiles it is about to change are recorded with touch() or
+    touch_changed(), and it is pushed onto the history with commit(). Tiles are stored zlib compressed, and the
+    oldest operations are dropped once the history grows past its byte budget. Undo and redo swap the stored tiles
+    with the current contents of the array in place, so only changed tiles are ever copied.
+    """
+    def __init__(self, budget_mb=64, tile_size=256, compression_level=1):
+        self.budget = budget_mb * 1024 * 1024
+        self.tile_size = tile_size
+        self.compression_level = compression_level
+        self.history = collections.deque()
+        self.future = collections.deque()
+        self.size = 0
+        self.pending = None
+
+    def __len__(self):
+        return len(self.history)
+
+    def begin(self):
+        self.pending = {}
+
+    def touch(self, array, x0, y0, x1, y1):
+        """Record the tiles of array overlapping the rectangle [x0, x1) x [y0, y1) before they are changed"""
+        if self.pending is None:
+            return
+        height, width = array.shape[:2]
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1, y1 = min(width, int(x1)), min(height, int(y1))
+        for ty in range(y0 // self.tile_size, (y1 - 1) // self.tile_size + 1):
+            for tx in range(x0 // self.tile_size, (x1 - 1) // self.tile_size + 1):
+                if (ty, tx) not in self.pending:
+                    self.pending[(ty, tx)] = self._compress(self._tile(array, ty, tx))
+
+    def touch_changed(self, old, new):
+        """Record the tiles of old that differ from new, for an operation that replaces the whole array"""
+        if self.pending is None:
+            return
+        height, width = old.shape[:2]
+        for ty in range((height + self.tile_size - 1) // self.tile_size):
+            for tx in range((width + self.tile_size - 1) // self.tile_size):
+                if (ty, tx) in self.pending:
+                    continue
+                old_tile = self._tile(old, ty, tx)
+                if old.shape != new.shape or not np.array_equal(old_tile, self._tile(new, ty, tx)):
+                    self.pending[(ty, tx)] = self._compress(old_tile)
+
+    def commit(self):
+        if self.pending:
+            self._clear(self.future)
+            self._push(self.history, self.pending)
+            while self.size > self.budget and len(self.history) > 1:
+                self._pop(self.history, last=False)
+        self.pending = None
+
+    def undo(self, array):
+        """Restore the state before the last operation into array. Returns False if there is nothing to undo"""
+        return self._swap(self.history, self.future, array)
+
+    def redo(self, array):
+        """Re-apply the last undone operation into array. Returns False if there is nothing to redo"""
+        return self._swap(self.future, self.history, array)
+
+    def clear(self):
+        self._clear(self.history)
+        self._clear(self.future)
+        self.pending = None
+
+    def _swap(self, source, target, array):
+        if len(source) == 0:
+            return False
+        tiles = self._pop(source)
+        current = {}
+        for (ty, tx), compressed in tiles.items():
+            tile = self._tile(array, ty, tx)
+            current[(ty, tx)] = self._compress(tile)
+            tile[...] = np.frombuffer(zlib.decompress(compressed), dtype=array.dtype).reshape(tile.shape)
+        self._push(target, current)
+        return True
+
+    def _tile(self, array, ty, tx):
+        return array[ty * self.tile_size:(ty + 1) * self.tile_size, tx * self.tile_size:(tx + 1) * self.tile_size]
+
+    def _compress(self, tile):
+        return zlib.compress(np.ascontiguousarray(tile).tobytes(), self.compression_level)
+
+    def _push(self, stack, tiles):
+        stack.append(tiles)
+        self.size += sum(len(compressed) for compressed in tiles.values())
+
+    def _pop(self, stack, last=True):
+        tiles = stack.pop() if last else stack.popleft()
+        self.size -= sum(len(compressed) for compressed in tiles.values())
+        return tiles
+
+    def _clear(self, stack):
+        while len(stack) > 0:
+            self._pop(stack)
@@ -0,0 +1,68 @@
+import collections
+import threading
+
+
+def _size(image):
+    # Label masks are cached as numpy arrays, everything else as QImages
+    if hasattr(image, 'nbytes'):
+        return image.nbytes
+    return image.sizeInBytes()
+
+
+class ImageCache(object):
+    """Thread-safe LRU cache of decoded QImages and label masks, bounded by a memory budget in MB
+
+    Keys are file paths, so source images and their label masks can share the same cache. Images are only evicted
+    from the cache, so a caller holding on to an image keeps it alive regardless of the budget.
+    """
+    def __init__(self, budget_mb=1024):
+        self.budget = budget_mb * 1024 * 1024
+        self.size = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        self._put(key, image, replace=True)
+
+    def add(self, key, image):
+        """Cache image unless key is already cached, e.g. with a newer mask put there while it was being read"""
+        self._put(key, image, replace=False)
+
+    def _put(self, key, image, replace):
+        if image is None or (hasattr(image, 'isNull') and image.isNull()):
+            return
+        with self._lock:
+            if key in self._images:
+                if not replace:
+                    return
+                self.size -= _size(self._images.pop(key))
+            self._images[key] = image
+            self.size += _size(image)
+            while self.size > self.budget and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= _size(evicted)
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._images:
+                self.size -= _size(self._images.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
@@ -0,0 +1,113 @@
+import bisect
+import os
+
+LABEL_TYPES = ['Foot', 'Inner Wound', 'Outer Wound']
+LABEL_SUFFIX = '_label.png'
+# Changes to more images than this in one rescan rebuild the index rather than updating it image by image
+MAX_INCREMENTAL_CHANGES = 256
+
+
+def label_folder(label_root, label_type):
+    return os.path.join(label_root, label_type.replace(' ', '_'))
+
+
+def label_name(image_path):
+    image_name = os.path.splitext(os.path.basename(image_path))[0]
+    return image_name + LABEL_SUFFIX
+
+
+class LabelIndex(object):
+    """In-memory record of which images have a saved mask for each label type
+
+    Each label folder is read with a single directory listing. The indices of labelled and unlabelled images are
+    kept in sorted lists so that finding the next (un)labelled image is a binary search rather than a stat per image.
+    Rescanning a folder only updates the images whose mask appeared or disappeared since the last listing or
+    set_labelled() call.
+    """
+    def __init__(self, label_types):
+        self.label_types = list(label_types)
+        self.label_root = None
+        self.src_paths = []
+        # Indices of the images each label file name belongs to
+        self.rows = {}
+        self.label_names = {label_type: set() for label_type in self.label_types}
+        self.labelled = {label_type: [] for label_type in self.label_types}
+        self.unlabelled = {label_type: [] for label_type in self.label_types}
+
+    def set_label_root(self, label_root):
+        self.label_root = label_root
+        for label_type in self.label_types:
+            self.rescan(label_type)
+
+    def set_paths(self, src_paths):
+        self.src_paths = list(src_paths)
+        self.rows = {}
+        for idx, path in enumerate(self.src_paths):
+            self.rows.setdefault(label_name(path), []).append(idx)
+        for label_type in self.label_types:
+            self._reindex(label_type)
+
+    def rescan(self, label_type):
+        """Re-list the folder for a label type. Returns the sorted indices of the images whose status changed"""
+        names = set()
+        if self.label_root is not None:
+            try:
+                names = {name for name in os.listdir(label_folder(self.label_root, label_type))
+                         if name.endswith(LABEL_SUFFIX)}
+            except OSError:
+                pass
+        changed = names.symmetric_difference(self.label_names[label_type])
+        self.label_names[label_type] = names
+        indices = sorted(idx for name in changed for idx in self.rows.get(name, []))
+        if len(indices) > MAX_INCREMENTAL_CHANGES:
+            self._reindex(label_type)
+        else:
+            for idx in indices:
+                self.set_labelled(label_type, idx, label_name(self.src_paths[idx]) in names)
+        return indices
+
+    def _reindex(self, label_type):
+        names = self.label_names[label_type]
+        labelled = []
+        unlabelled = []
+        for idx, path in enumerate(self.src_paths):
+            if label_name(path) in names:
+                labelled.append(idx)
+            else:
+                unlabelled.append(idx)
+        self.labelled[label_type] = labelled
+        self.unlabelled[label_type] = unlabelled
+
+    def is_labelled(self, label_type, idx):
+        labelled = self.labelled[label_type]
+        pos = bisect.bisect_left(labelled, idx)
+        return pos < len(labelled) and labelled[pos] == idx
+
+    def set_labelled(self, label_type, idx, labelled=True):
+        if self.is_labelled(label_type, idx) == labelled:
+            return
+        add_to, remove_from = self.labelled[label_type], self.unlabelled[label_type]
+        if labelled:
+            self.label_names[label_type].add(label_name(self.src_paths[idx]))
+        else:
+            self.label_names[label_type].discard(label_name(self.src_paths[idx]))
+            add_to, remove_from = remove_from, add_to
+        del remove_from[bisect.bisect_left(remove_from, idx)]
+        bisect.insort(add_to, idx)
+
+    def next_labelled(self, label_type, start):
+        """Index of the first labelled image at or after start, or None"""
+        return self._next(self.labelled[label_type], start)
+
+    def next_unlabelled(self, label_type, start):
+        """Index of the first unlabelled image at or after start, or None"""
+        return self._next(self.unlabelled[label_type], start)
+
+    def _next(self, indices, start):
+        pos = bisect.bisect_left(indices, start)
+        if pos < len(indices):
+            return indices[pos]
+        return None
+
+    def count(self, label_type):
+        return len(self.labelled[label_type])
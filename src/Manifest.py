@@ -0,0 +1,132 @@
+import imghdr
+import json
+import os
+import struct
+
+MANIFEST_NAME = '.segmenter_manifest.json'
+IMAGE_FORMATS = ['jpeg', 'png', 'jpg']
+# Start of frame markers hold the image size. 0xC4, 0xC8 and 0xCC share the range but are not frames.
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def image_dimensions(path, kind):
+    """Read the (width, height) of a png or jpeg from its header without decoding it. Returns None if it can't be found"""
+    with open(path, 'rb') as f:
+        if kind == 'png':
+            header = f.read(24)
+            if len(header) < 24:
+                return None
+            return struct.unpack('>II', header[16:24])
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            byte = f.read(1)
+            while byte and byte != b'\xff':
+                byte = f.read(1)
+            while byte == b'\xff':
+                byte = f.read(1)
+            if not byte:
+                return None
+            marker = ord(byte)
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                # Markers without a payload
+                continue
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack('>H', length_bytes)[0]
+            if marker in JPEG_SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack('>xHH', frame)
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+class DirectoryManifest(object):
+    """Cached listing of an image directory, saved as a small json index next to the images
+
+    Each file is recorded with its size, mtime, detected format and dimensions, so re-opening a directory only needs
+    to sniff files that are new or have changed. If the directory mtime hasn't changed since the last scan then no
+    files have been added or removed and the manifest can be used without listing the directory at all.
+    """
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, MANIFEST_NAME)
+        self.dir_mtime = None
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.dir_mtime = data['dir_mtime']
+            self.entries = data['entries']
+        except (OSError, ValueError, KeyError):
+            self.dir_mtime = None
+            self.entries = {}
+        return self
+
+    def save(self):
+        try:
+            created = not os.path.exists(self.path)
+            unchanged = os.stat(self.image_dir).st_mtime_ns == self.dir_mtime
+            self._write()
+            if created and unchanged:
+                # Creating the manifest touches the directory mtime itself, which shouldn't invalidate it
+                self.dir_mtime = os.stat(self.image_dir).st_mtime_ns
+                self._write()
+        except OSError:
+            # The manifest is only a cache, so a read-only image directory just means it gets rebuilt next time
+            pass
+
+    def _write(self):
+        # Written in place rather than renamed over, since adding a directory entry would change the directory mtime.
+        # A partially written manifest fails to load and is simply rebuilt.
+        with open(self.path, 'w') as f:
+            json.dump({'dir_mtime': self.dir_mtime, 'entries': self.entries}, f)
+
+    def is_current(self):
+        try:
+            return self.dir_mtime is not None and os.stat(self.image_dir).st_mtime_ns == self.dir_mtime
+        except OSError:
+            return False
+
+    def image_paths(self):
+        names = [name for name, entry in self.entries.items() if entry['format'] in IMAGE_FORMATS]
+        return sorted(os.path.join(self.image_dir, name) for name in names)
+
+    def revalidate(self):
+        """Drop entries for removed files and return (name, size, mtime) for every file that needs to be sniffed"""
+        # Taken before listing, so any change made during the scan is picked up next time
+        self.dir_mtime = os.stat(self.image_dir).st_mtime_ns
+        to_sniff = []
+        seen = set()
+        with os.scandir(self.image_dir) as it:
+            for dir_entry in it:
+                if dir_entry.name == MANIFEST_NAME or not dir_entry.is_file():
+                    continue
+                seen.add(dir_entry.name)
+                stat = dir_entry.stat()
+                entry = self.entries.get(dir_entry.name)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                    to_sniff.append((dir_entry.name, stat.st_size, stat.st_mtime_ns))
+        for name in list(self.entries):
+            if name not in seen:
+                del self.entries[name]
+        return to_sniff
+
+    def sniff(self, name, size, mtime):
+        """Detect the format and dimensions of a file. Returns the manifest entry without adding it"""
+        path = os.path.join(self.image_dir, name)
+        width = height = None
+        try:
+            kind = imghdr.what(path)
+            if kind in IMAGE_FORMATS:
+                dimensions = image_dimensions(path, kind)
+                if dimensions is not None:
+                    width, height = dimensions
+        except OSError:
+            kind = None
+        return {'size': size, 'mtime': mtime, 'format': kind, 'width': width, 'height': height}
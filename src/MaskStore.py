@@ -0,0 +1,258 @@
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from .LabelIndex import LABEL_SUFFIX
+from .Masks import file_mode, read_mask, write_mask
+
+# Folder inside each label folder that holds its mask store
+STORE_DIR_NAME = '.maskstore'
+# Bumped whenever the layout of the index or chunks changes
+STORE_VERSION = 1
+
+
+def store_dir(label_dir):
+    """Where the mask store of a label folder, e.g. labels/Foot, is kept"""
+    return os.path.join(label_dir, STORE_DIR_NAME)
+
+
+def mask_key(label_path):
+    """Name a mask is stored under, the image name of a _label.png file without its extension"""
+    name = os.path.basename(label_path)
+    return name[:-len(LABEL_SUFFIX)] if name.endswith(LABEL_SUFFIX) else os.path.splitext(name)[0]
+
+
+def _fsync_replace(temp_path, path):
+    os.replace(temp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class MaskStore(object):
+    """Every class mask of a label folder packed into a few large, memory mapped chunk files
+
+    Masks are stored as raw uint8 class indices, one after another in chunk files of up to chunk_bytes. index.npz
+    holds the name, chunk, offset and shape of each mask, so reading a mask is a slice of a memory mapped chunk rather
+    than a png decode, and reading a whole dataset runs at the speed of the page cache.
+
+    Chunks are only ever appended to. New masks are written past the end of the data the index knows about and
+    synced, then the index is replaced in one rename, so a reader or a crash part way through only ever sees the old
+    or the new set of masks. Space taken by replaced masks is reclaimed by compact(), which happens automatically once
+    more than half of the store is unused. Only one process should write to a store at a time, any number can read.
+    """
+    def __init__(self, path, chunk_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self._maps = {}
+        self._index_stamp = None
+        self.entries = {}
+        self.chunk_sizes = {}
+        self.refresh()
+
+    @classmethod
+    def for_label_dir(cls, label_dir, **kwargs):
+        return cls(store_dir(label_dir), **kwargs)
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index.npz')
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.path, '{:06d}.bin'.format(chunk))
+
+    def refresh(self):
+        """Re-read the index if another process has changed it since it was last read"""
+        try:
+            stat = os.stat(self._index_path())
+        except OSError:
+            self.entries = {}
+            self.chunk_sizes = {}
+            self._maps = {}
+            self._index_stamp = None
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, getattr(stat, 'st_ino', 0))
+        if stamp == self._index_stamp:
+            return
+        try:
+            with np.load(self._index_path()) as index:
+                if int(index['version']) != STORE_VERSION:
+                    raise ValueError('Unsupported mask store version {}'.format(int(index['version'])))
+                columns = [index[column].tolist() for column in ['chunks', 'offsets', 'heights', 'widths', 'stamps']]
+                self.entries = {name: entry for name, entry in zip(index['names'].tolist(), zip(*columns))}
+                self.chunk_sizes = dict(zip(index['chunk_ids'].tolist(), index['chunk_sizes'].tolist()))
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile) as e:
+            # A truncated or corrupt index is reported like a missing column, so callers only need to catch ValueError
+            raise ValueError('Could not read the mask store index in {}: {}'.format(self.path, e))
+        # Chunks that were compacted away or have grown are mapped again when next read
+        self._maps = {}
+        self._index_stamp = stamp
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return sorted(self.entries)
+
+    def stored_bytes(self):
+        return sum(height * width for _, _, height, width, _ in self.entries.values())
+
+    def get(self, name):
+        """Read-only (height, width) class mask stored under name, as a view of the memory mapped chunk
+
+        Raises KeyError if there is no mask with that name. Copy the result to modify it.
+        """
+        chunk, offset, height, width, _ = self.entries[name]
+        data = self._maps.get(chunk)
+        if data is None or len(data) < offset + height * width:
+            data = np.memmap(self._chunk_path(chunk), dtype=np.uint8, mode='r', shape=(self.chunk_sizes[chunk],))
+            self._maps[chunk] = data
+        return data[offset:offset + height * width].reshape(height, width)
+
+    def put(self, name, mask):
+        self.put_many([(name, mask)])
+
+    def put_many(self, items, removed=()):
+        """Store (name, class mask) pairs and drop the masks named in removed, as a single transaction"""
+        stamp = time.time_ns()
+        self._commit(((name, mask, stamp) for name, mask in items), removed)
+        if self._unused_bytes() > max(self.chunk_bytes, self.stored_bytes()):
+            self.compact()
+
+    def _commit(self, items, removed=(), entries=None, chunk_sizes=None):
+        """Append (name, mask, stamp) items to the chunks and write the index that includes them"""
+        entries = dict(self.entries if entries is None else entries)
+        chunk_sizes = dict(self.chunk_sizes if chunk_sizes is None else chunk_sizes)
+        for name in removed:
+            entries.pop(name, None)
+        chunk = max(chunk_sizes) if len(chunk_sizes) > 0 else 0
+        f = None
+        try:
+            for name, mask, stamp in items:
+                data = np.ascontiguousarray(mask, dtype=np.uint8)
+                used = chunk_sizes.get(chunk, 0)
+                if used > 0 and used + data.nbytes > self.chunk_bytes:
+                    if f is not None:
+                        self._sync(f)
+                        f.close()
+                        f = None
+                    chunk += 1
+                    used = 0
+                if f is None:
+                    f = self._open_chunk(chunk, used)
+                f.write(data.tobytes())
+                entries[name] = (chunk, used, data.shape[0], data.shape[1], stamp)
+                chunk_sizes[chunk] = used + data.nbytes
+            if f is not None:
+                self._sync(f)
+        finally:
+            if f is not None:
+                f.close()
+        self._write_index(entries, chunk_sizes)
+
+    def remove(self, names):
+        self.put_many([], removed=names)
+
+    def _open_chunk(self, chunk, used):
+        os.makedirs(self.path, exist_ok=True)
+        self._maps.pop(chunk, None)
+        f = open(self._chunk_path(chunk), 'r+b' if os.path.exists(self._chunk_path(chunk)) else 'w+b')
+        # Anything past the end the index knows about is left over from a write that was never committed
+        f.truncate(used)
+        f.seek(used)
+        return f
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _write_index(self, entries, chunk_sizes):
+        os.makedirs(self.path, exist_ok=True)
+        names = sorted(entries)
+        columns = list(zip(*[entries[name] for name in names])) if len(names) > 0 else [()] * 5
+        handle, temp_path = tempfile.mkstemp(suffix='.npz', dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, version=np.array(STORE_VERSION),
+                         names=np.array(names, dtype=np.str_),
+                         chunks=np.array(columns[0], dtype=np.int32),
+                         offsets=np.array(columns[1], dtype=np.int64),
+                         heights=np.array(columns[2], dtype=np.int32),
+                         widths=np.array(columns[3], dtype=np.int32),
+                         stamps=np.array(columns[4], dtype=np.int64),
+                         chunk_ids=np.array(sorted(chunk_sizes), dtype=np.int32),
+                         chunk_sizes=np.array([chunk_sizes[chunk] for chunk in sorted(chunk_sizes)], dtype=np.int64))
+                self._sync(f)
+            os.chmod(temp_path, file_mode(self._index_path()))
+            _fsync_replace(temp_path, self._index_path())
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._index_stamp = None
+        self.refresh()
+
+    def _unused_bytes(self):
+        return sum(self.chunk_sizes.values()) - self.stored_bytes()
+
+    def compact(self):
+        """Rewrite the masks into new chunks without the space left by replaced and removed masks"""
+        old_chunks = set(self.chunk_sizes)
+        # The new chunks start after every existing one, so readers of the old index can finish with the old chunks
+        first = max(old_chunks) + 1 if len(old_chunks) > 0 else 0
+        old = self.entries
+        names = sorted(old, key=lambda name: old[name][:2])
+        # The stamps record when each mask was saved, which compacting doesn't change
+        self._commit(((name, self._read_entry(old[name]), old[name][4]) for name in names),
+                     entries={}, chunk_sizes={first: 0})
+        for chunk in old_chunks - set(self.chunk_sizes):
+            try:
+                os.remove(self._chunk_path(chunk))
+            except OSError:
+                pass
+
+    def _read_entry(self, entry):
+        chunk, offset, height, width, _ = entry
+        with open(self._chunk_path(chunk), 'rb') as f:
+            f.seek(offset)
+            return np.frombuffer(f.read(height * width), dtype=np.uint8).reshape(height, width)
+
+    def sync_pngs(self, label_dir):
+        """Bring the store up to date with the _label.png files of a label folder
+
+        Files saved or changed after their mask was stored are read into it, and masks whose file is gone are
+        removed. Returns the number of masks added or updated.
+        """
+        items = []
+        present = set()
+        for entry in os.scandir(label_dir):
+            if not entry.name.endswith(LABEL_SUFFIX) or not entry.is_file():
+                continue
+            name = mask_key(entry.name)
+            present.add(name)
+            stored = self.entries.get(name)
+            if stored is None or entry.stat().st_mtime_ns > stored[4]:
+                mask = read_mask(entry.path)
+                if mask is not None:
+                    items.append((name, mask))
+        removed = [name for name in self.entries if name not in present]
+        if len(items) > 0 or len(removed) > 0:
+            self.put_many(items, removed)
+        return len(items)
+
+    def export_pngs(self, output_dir, mask_format='RGBA', compression=3, names=None):
+        """Write masks out as <name>_label.png files in output_dir, the same layout the tool saves. Returns the count"""
+        os.makedirs(output_dir, exist_ok=True)
+        names = self.names() if names is None else names
+        for name in names:
+            write_mask(os.path.join(output_dir, name + LABEL_SUFFIX), self.get(name), mask_format, compression)
+        return len(names)
@@ -0,0 +1,134 @@
+import os
+import stat
+import struct
+import tempfile
+import zlib
+
+import cv2
+import numpy as np
+
+# Read once, as the only way to read it is to set it, which would race with files created on other threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Class indices of a segmentation mask
+EMPTY = 0
+FOREGROUND = 1
+POSSIBLE_FOREGROUND = 2
+BACKGROUND = 3
+
+# BGRA colour of each class, as used on screen and in RGBA label files
+CLASS_COLORS = np.array([
+    [0, 0, 0, 0],
+    [0, 255, 0, 255],
+    [255, 0, 0, 255],
+    [0, 0, 255, 255],
+], dtype=np.uint8)
+
+MASK_FORMATS = ['RGBA', 'Palette', 'Single Channel']
+# zlib levels offered for png label files, from fastest to smallest
+PNG_COMPRESSION_LEVELS = list(range(10))
+
+
+def allocate_mask(height, width, on_disk=False):
+    """Create an empty class mask whose rows are padded to a multiple of 4 bytes, as QImage requires
+
+    The returned array is a (height, width) view, the padded buffer is available as its base. Masks for very large
+    images can be kept on_disk in an anonymous temporary file, so only the parts being used are paged in.
+    """
+    stride = (width + 3) // 4 * 4
+    if on_disk:
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(height, stride))[:, :width]
+    return np.zeros((height, stride), dtype=np.uint8)[:, :width]
+
+
+def decode_mask(array):
+    """Convert a label image read with cv2.IMREAD_UNCHANGED into a class mask
+
+    Single channel images already hold class indices. Colour images (RGBA label files and palette pngs, which OpenCV
+    expands to colour) are decoded from CLASS_COLORS, with foreground taking precedence where colours overlap.
+    """
+    if array.ndim == 2:
+        return np.minimum(array, BACKGROUND).astype(np.uint8)
+    mask = np.zeros(array.shape[:2], dtype=np.uint8)
+    mask[array[:, :, 0] > 127] = POSSIBLE_FOREGROUND
+    mask[array[:, :, 2] > 127] = BACKGROUND
+    mask[array[:, :, 1] > 127] = FOREGROUND
+    return mask
+
+
+def encode_rgba(mask):
+    return CLASS_COLORS[mask]
+
+
+def encode_palette_png(mask, compression=3):
+    """Encode a class mask as an 8 bit palette png with a transparent empty class"""
+    height, width = mask.shape
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    # The leading zero of each row is the png 'None' filter type
+    raw[:, 1:] = mask
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    palette = CLASS_COLORS[:, [2, 1, 0]].tobytes()
+    alpha = CLASS_COLORS[:, 3].tobytes()
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        chunk(b'PLTE', palette),
+        chunk(b'tRNS', alpha),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def encode_mask(mask, mask_format='RGBA', compression=3):
+    """Encode a class mask as png bytes in one of MASK_FORMATS"""
+    if mask_format == 'Palette':
+        return encode_palette_png(mask, compression)
+    if mask_format == 'Single Channel':
+        image = np.ascontiguousarray(mask)
+    else:
+        image = encode_rgba(mask)
+    success, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not success:
+        raise ValueError('Could not encode mask as {}'.format(mask_format))
+    return data.tobytes()
+
+
+def read_mask(path):
+    """Read a label file as a class mask, returns None if it can't be read"""
+    array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if array is None:
+        return None
+    return decode_mask(array)
+
+
+def file_mode(path):
+    """Permissions for a file written to path: those of the file it replaces, or the umask default for a new one
+
+    Temporary files are created readable only by their owner, so they are given these before being renamed into place.
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def write_mask(path, mask, mask_format='RGBA', compression=3):
+    """Write a class mask to path, via a temporary file in the same folder that is renamed into place
+
+    A reader never sees a partially written label file, even if the write fails or the app is closed part way.
+    """
+    data = encode_mask(mask, mask_format, compression)
+    handle, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, file_mode(path))
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
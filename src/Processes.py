@@ -0,0 +1,13 @@
+import concurrent.futures
+import multiprocessing
+
+
+def process_pool(processes=None, initializer=None):
+    """ProcessPoolExecutor whose workers are started with the spawn start method
+
+    Forking a process copies its memory but only the thread that forked, so a lock held by one of Qt's or OpenCV's
+    other threads at that moment stays locked forever in the child. Spawned workers start from a fresh interpreter
+    instead, which is safe from a process that also runs Qt and behaves the same on every platform.
+    """
+    return concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=initializer)
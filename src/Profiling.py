@@ -0,0 +1,156 @@
+import collections
+import contextlib
+import cProfile
+import csv
+import json
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is everything slower
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class LatencyRecorder(object):
+    """Rolling record of how long named operations take
+
+    The last window samples of each operation are kept, so the statistics follow recent behaviour rather than the
+    whole session. Samples can come from any thread.
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.counts = collections.Counter()
+        self.latest = None
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.window)
+            self.samples[name].append((time.time(), seconds))
+            self.counts[name] += 1
+            self.latest = (name, seconds)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def names(self):
+        with self._lock:
+            return sorted(self.samples)
+
+    def summary(self, name):
+        """count, last, mean, p50, p95 and max in milliseconds, plus a histogram, for the samples in the window"""
+        with self._lock:
+            durations = [seconds * 1000 for _, seconds in self.samples.get(name, [])]
+            total = self.counts[name]
+        if len(durations) == 0:
+            return None
+        ordered = sorted(durations)
+        histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        for duration in durations:
+            bucket = 0
+            while bucket < len(HISTOGRAM_BOUNDS_MS) and duration > HISTOGRAM_BOUNDS_MS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        return {
+            'count': total,
+            'last_ms': durations[-1],
+            'mean_ms': sum(durations) / len(durations),
+            'p50_ms': ordered[len(ordered) // 2],
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max_ms': ordered[-1],
+            'histogram': histogram,
+        }
+
+    def report(self):
+        """Plain text table of every operation's summary"""
+        lines = ['{:<28} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('operation', 'count', 'last ms', 'p50 ms', 'p95 ms', 'max ms')]
+        for name in self.names():
+            summary = self.summary(name)
+            if summary is None:
+                continue
+            lines.append('{:<28} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                name, summary['count'], summary['last_ms'], summary['p50_ms'], summary['p95_ms'], summary['max_ms']))
+        lines.append('')
+        bounds = ['<={}'.format(bound) for bound in HISTOGRAM_BOUNDS_MS] + ['>{}'.format(HISTOGRAM_BOUNDS_MS[-1])]
+        lines.append('{:<28} '.format('histogram (ms)') + ' '.join('{:>6}'.format(bound) for bound in bounds))
+        for name in self.names():
+            summary = self.summary(name)
+            if summary is None:
+                continue
+            lines.append('{:<28} '.format(name) + ' '.join('{:>6}'.format(count) for count in summary['histogram']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Write the samples to a .csv file (one row per sample) or anything else as json (summaries and samples)"""
+        with self._lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['operation', 'timestamp', 'milliseconds'])
+                for name in sorted(samples):
+                    for timestamp, seconds in samples[name]:
+                        writer.writerow([name, '{:.3f}'.format(timestamp), '{:.3f}'.format(seconds * 1000)])
+        else:
+            data = {
+                'histogram_bounds_ms': HISTOGRAM_BOUNDS_MS,
+                'operations': {name: self.summary(name) for name in sorted(samples)},
+                'samples': {name: [[timestamp, seconds * 1000] for timestamp, seconds in values]
+                            for name, values in samples.items()},
+            }
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2)
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+            self.counts.clear()
+            self.latest = None
+
+
+# Shared by the whole app, so timing hooks don't need a reference passed down to them
+recorder = LatencyRecorder()
+
+
+def timed(name):
+    return recorder.time(name)
+
+
+class StageTimer(object):
+    """Records the time between successive mark() calls as prefix/stage, for operations made of several stages"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        recorder.record('{}/{}'.format(self.prefix, stage), now - self.last)
+        self.last = now
+
+
+class ProfileCapture(object):
+    """Optional cProfile capture of the UI thread, saved as a .prof file for snakeviz or pstats"""
+    def __init__(self):
+        self.profile = None
+
+    def is_running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self, path=None):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        if path is not None:
+            self.profile.dump_stats(path)
+        self.profile = None
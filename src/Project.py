@@ -0,0 +1,202 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from .Manifest import DirectoryManifest, IMAGE_FORMATS
+
+PROJECT_DIR = os.path.join(os.path.expanduser('~'), '.local', 'share', 'ImageSegmenter', 'projects')
+# Holds only the path of the last image directory, everything else about the session is in its project store
+SESSION_FILE = os.path.join(os.path.dirname(__file__), 'meta.txt')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, format TEXT, width INTEGER,
+                                  height INTEGER);
+CREATE TABLE IF NOT EXISTS labels (name TEXT, label_type TEXT, labelled INTEGER NOT NULL DEFAULT 0, edited REAL,
+                                   PRIMARY KEY (name, label_type));
+CREATE INDEX IF NOT EXISTS labels_by_edit ON labels (label_type, edited);
+CREATE TABLE IF NOT EXISTS grabcut_runs (id INTEGER PRIMARY KEY, name TEXT, label_type TEXT, mode TEXT, seconds REAL,
+                                         finished REAL);
+"""
+
+
+def last_image_dir():
+    """The image directory open at the end of the last session, or None"""
+    try:
+        with open(SESSION_FILE, 'r') as f:
+            image_dir = f.readline().strip()
+    except OSError:
+        return None
+    return image_dir if os.path.isdir(image_dir) else None
+
+
+def set_last_image_dir(image_dir):
+    try:
+        with open(SESSION_FILE, 'w') as f:
+            f.write(image_dir + '\n')
+    except OSError:
+        pass
+
+
+def start_of_today():
+    return time.mktime(datetime.date.today().timetuple())
+
+
+class ProjectStore(object):
+    """SQLite database of everything known about one image directory
+
+    Holds the directory listing (the same entries as a DirectoryManifest), which images are labelled for each label
+    type and when their masks were last saved, how long GrabCut took on them, and the session state needed to reopen
+    the directory where it was left. The database lives in project_dir rather than next to the images, so it works
+    for read-only directories and writing to it doesn't change the image directory's mtime. If it can't be opened, an
+    in-memory database is used so the app still works for the session.
+    """
+    def __init__(self, image_dir, project_dir=PROJECT_DIR):
+        self.image_dir = image_dir
+        key = hashlib.sha1(os.path.abspath(image_dir).encode('utf-8')).hexdigest()
+        self.path = os.path.join(project_dir, key + '.sqlite')
+        # Also written to by the directory scanner's thread
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(project_dir, exist_ok=True)
+            self.db = self._connect(self.path)
+        except (OSError, sqlite3.Error):
+            self.path = ':memory:'
+            self.db = self._connect(self.path)
+
+    @staticmethod
+    def _connect(path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def session(self):
+        """Dict of the saved session values, such as label_dir, label_type and current_image"""
+        with self._lock:
+            return dict(self.db.execute('SELECT key, value FROM session'))
+
+    def set_session(self, **values):
+        with self._lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO session (key, value) VALUES (?, ?)',
+                                [(key, None if value is None else str(value)) for key, value in values.items()])
+
+    def load_files(self):
+        """(directory mtime, manifest entries) as last saved, with a None mtime if the directory has never been listed"""
+        with self._lock:
+            row = self.db.execute("SELECT value FROM session WHERE key = 'dir_mtime'").fetchone()
+            rows = self.db.execute('SELECT name, size, mtime, format, width, height FROM files').fetchall()
+        entries = {name: {'size': size, 'mtime': mtime, 'format': kind, 'width': width, 'height': height}
+                   for name, size, mtime, kind, width, height in rows}
+        return (int(row[0]) if row is not None and row[0] is not None else None), entries
+
+    def save_files(self, dir_mtime, entries):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM files')
+            self.db.executemany('INSERT INTO files (name, size, mtime, format, width, height) VALUES (?, ?, ?, ?, ?, ?)',
+                                [(name, entry['size'], entry['mtime'], entry['format'], entry['width'], entry['height'])
+                                 for name, entry in entries.items()])
+            self.db.execute("INSERT OR REPLACE INTO session (key, value) VALUES ('dir_mtime', ?)",
+                            (None if dir_mtime is None else str(dir_mtime),))
+
+    def labelled(self, label_type):
+        """Set of the names of the images with a mask for a label type"""
+        with self._lock:
+            return self._labelled(label_type)
+
+    def _labelled(self, label_type):
+        return {row[0] for row in self.db.execute('SELECT name FROM labels WHERE label_type = ? AND labelled = 1',
+                                                  (label_type,))}
+
+    def set_labelled(self, label_type, names):
+        """Record exactly which images (by file name) have a mask for a label type
+
+        Only the images whose status differs from the stored one are written.
+        """
+        names = set(names)
+        with self._lock, self.db:
+            stored = self._labelled(label_type)
+            self._update_labelled(label_type, names - stored, stored - names)
+
+    def update_labelled(self, label_type, labelled=(), unlabelled=()):
+        """Record that some images have a mask for a label type and others don't, leaving the rest as they are"""
+        with self._lock, self.db:
+            self._update_labelled(label_type, labelled, unlabelled)
+
+    def _update_labelled(self, label_type, labelled, unlabelled):
+        self.db.executemany('INSERT INTO labels (name, label_type, labelled) VALUES (?, ?, 1) '
+                            'ON CONFLICT (name, label_type) DO UPDATE SET labelled = 1',
+                            [(name, label_type) for name in labelled])
+        self.db.executemany('UPDATE labels SET labelled = 0 WHERE name = ? AND label_type = ?',
+                            [(name, label_type) for name in unlabelled])
+
+    def record_edit(self, name, label_type, when=None):
+        """Record that the mask for an image was saved"""
+        with self._lock, self.db:
+            self.db.execute('INSERT INTO labels (name, label_type, labelled, edited) VALUES (?, ?, 1, ?) '
+                            'ON CONFLICT (name, label_type) DO UPDATE SET labelled = 1, edited = excluded.edited',
+                            (name, label_type, time.time() if when is None else when))
+
+    def record_grabcut(self, name, label_type, mode, seconds):
+        with self._lock, self.db:
+            self.db.execute('INSERT INTO grabcut_runs (name, label_type, mode, seconds, finished) VALUES (?, ?, ?, ?, ?)',
+                            (name, label_type, mode, seconds, time.time()))
+
+    def unlabelled(self, label_type):
+        """Sorted names of the images without a mask for a label type"""
+        formats = ', '.join('?' * len(IMAGE_FORMATS))
+        with self._lock:
+            rows = self.db.execute('SELECT name FROM files WHERE format IN ({}) AND name NOT IN '
+                                   '(SELECT name FROM labels WHERE label_type = ? AND labelled = 1) '
+                                   'ORDER BY name'.format(formats), IMAGE_FORMATS + [label_type]).fetchall()
+        return [row[0] for row in rows]
+
+    def edited_since(self, label_type, since):
+        """Sorted names of the images whose mask for a label type was saved at or after the since timestamp"""
+        with self._lock:
+            rows = self.db.execute('SELECT name FROM labels WHERE label_type = ? AND edited >= ? ORDER BY name',
+                                   (label_type, since)).fetchall()
+        return [row[0] for row in rows]
+
+    def labelled_today(self, label_type):
+        return self.edited_since(label_type, start_of_today())
+
+    def grabcut_times(self, label_type=None):
+        """(name, mode, seconds) of every GrabCut run, oldest first"""
+        query = 'SELECT name, mode, seconds FROM grabcut_runs'
+        args = ()
+        if label_type is not None:
+            query += ' WHERE label_type = ?'
+            args = (label_type,)
+        with self._lock:
+            return self.db.execute(query + ' ORDER BY id', args).fetchall()
+
+
+class ProjectManifest(DirectoryManifest):
+    """DirectoryManifest kept in a ProjectStore instead of a json file next to the images
+
+    A json manifest left by an earlier version or by the batch command is used the first time the directory is opened.
+    """
+    def __init__(self, store):
+        super(ProjectManifest, self).__init__(store.image_dir)
+        self.store = store
+
+    def load(self):
+        self.dir_mtime, self.entries = self.store.load_files()
+        if self.dir_mtime is None:
+            super(ProjectManifest, self).load()
+            if self.dir_mtime is not None:
+                self.save()
+        return self
+
+    def save(self):
+        self.store.save_files(self.dir_mtime, self.entries)
@@ -0,0 +1,159 @@
+import hashlib
+import imghdr
+import json
+import math
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from .DiskCache import prune_cache, touch
+from .Manifest import IMAGE_FORMATS, image_dimensions
+
+PYRAMID_INFO = 'pyramid.json'
+# Bumped whenever the way levels are built changes, so pyramids cached by older versions are built again
+PYRAMID_VERSION = 2
+
+
+def image_pixels(path):
+    """Number of pixels in a png or jpeg, read from its header. Returns 0 if it can't be found"""
+    try:
+        kind = imghdr.what(path)
+        if kind not in IMAGE_FORMATS:
+            return 0
+        dimensions = image_dimensions(path, kind)
+    except OSError:
+        return 0
+    if dimensions is None:
+        return 0
+    return dimensions[0] * dimensions[1]
+
+
+def decode_reduced(path, min_pixels):
+    """Decode an image at 1/2, 1/4 or 1/8 scale if it still has at least min_pixels, which jpegs can do directly
+
+    Returns (BGR image, full resolution (height, width)), or (None, None) if it can't be read. Orientation is ignored
+    to match how the image is shown.
+    """
+    full_shape = None
+    try:
+        kind = imghdr.what(path)
+        if kind in IMAGE_FORMATS:
+            dimensions = image_dimensions(path, kind)
+            if dimensions is not None:
+                full_shape = (dimensions[1], dimensions[0])
+    except OSError:
+        return None, None
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if full_shape is not None:
+        for factor, reduced in [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+            if full_shape[0] * full_shape[1] / float(factor * factor) >= min_pixels:
+                flags = reduced | cv2.IMREAD_IGNORE_ORIENTATION
+                break
+    image = cv2.imread(path, flags)
+    if image is not None and full_shape is None:
+        full_shape = image.shape[:2]
+    return image, full_shape
+
+
+def level_for_scale(scale, num_levels):
+    """Pyramid level with the least detail that still has at least one pixel per screen pixel at the given zoom"""
+    if scale >= 1:
+        return 0
+    return max(0, min(num_levels - 1, int(math.floor(math.log2(1.0 / scale)))))
+
+
+class ImagePyramid(object):
+    """A BGR image and its successive halvings, stored as memory mapped arrays
+
+    Viewing a region only pages in the part of the level being shown, so memory use follows what is on screen rather
+    than the size of the image. Level n is 1 / 2 ** n the size of the full image. With a cache_dir the levels are kept
+    as .npy files keyed on the path, size and mtime of the image, so re-opening it doesn't decode it again, and the
+    least recently opened pyramids are removed once the cache grows past max_cache_bytes. Without one, they are
+    written to anonymous temporary files that are removed once the pyramid is released.
+    """
+    def __init__(self, path, levels):
+        self.path = path
+        self.levels = levels
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level(self, idx):
+        return self.levels[idx]
+
+    @classmethod
+    def open(cls, path, cache_dir=None, min_size=256, max_cache_bytes=8 * 1024 ** 3):
+        """Load the pyramid for an image from cache_dir, or build it. Returns None if the image can't be read"""
+        pyramid_dir = None
+        if cache_dir is not None:
+            stat = os.stat(path)
+            key = '{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, PYRAMID_VERSION)
+            pyramid_dir = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+            pyramid = cls._load(path, pyramid_dir)
+            if pyramid is not None:
+                touch(pyramid_dir)
+                return pyramid
+            try:
+                os.makedirs(pyramid_dir, exist_ok=True)
+            except OSError:
+                pyramid_dir = None
+        pyramid = cls._build(path, pyramid_dir, min_size)
+        if pyramid_dir is not None and max_cache_bytes is not None:
+            prune_cache(cache_dir, max_cache_bytes, keep=[pyramid_dir])
+        return pyramid
+
+    @classmethod
+    def _load(cls, path, pyramid_dir):
+        try:
+            with open(os.path.join(pyramid_dir, PYRAMID_INFO), 'r') as f:
+                num_levels = json.load(f)['levels']
+            levels = [np.load(os.path.join(pyramid_dir, 'level{}.npy'.format(idx)), mmap_mode='r') for idx in range(num_levels)]
+        except (OSError, ValueError, KeyError):
+            return None
+        return cls(path, levels)
+
+    @classmethod
+    def _build(cls, path, pyramid_dir, min_size):
+        # The full image has to be decoded once, but only one level is held in memory at a time after that
+        # Without its EXIF rotation, the same way QImage and decode_reduced read it, so masks line up
+        image = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            return None
+        levels = []
+        while True:
+            levels.append(cls._store(image, pyramid_dir, len(levels)))
+            height, width = image.shape[:2]
+            if max(width, height) <= min_size:
+                break
+            image = cv2.resize(image, ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA)
+        if pyramid_dir is not None:
+            # Written last, so an interrupted build is never mistaken for a complete one
+            with open(os.path.join(pyramid_dir, PYRAMID_INFO), 'w') as f:
+                json.dump({'levels': len(levels), 'width': levels[0].shape[1], 'height': levels[0].shape[0]}, f)
+        return cls(path, levels)
+
+    @staticmethod
+    def _store(image, pyramid_dir, idx):
+        if pyramid_dir is not None:
+            try:
+                stored = np.lib.format.open_memmap(os.path.join(pyramid_dir, 'level{}.npy'.format(idx)), mode='w+',
+                                                   dtype=image.dtype, shape=image.shape)
+                stored[...] = image
+                stored.flush()
+                return np.load(os.path.join(pyramid_dir, 'level{}.npy'.format(idx)), mmap_mode='r')
+            except OSError:
+                pass
+        stored = np.memmap(tempfile.TemporaryFile(), dtype=image.dtype, mode='w+', shape=image.shape)
+        stored[...] = image
+        return stored
@@ -1,22 +1,211 @@
 from PySide2 import QtCore
-from PySide2.QtCore import Signal, QPoint, Slot
-from PySide2.QtWidgets import QGraphicsScene, QGraphicsView, QGraphicsPixmapItem, QFrame
-from PySide2.QtGui import QColor, QBrush, QPixmap, QPainter, QImage, QPen
-import collections
+from PySide2.QtCore import Signal, QPoint
+from PySide2.QtWidgets import QGraphicsScene, QGraphicsView, QGraphicsPixmapItem, QGraphicsItem, QGraphicsPathItem, QFrame
+from PySide2.QtGui import QColor, QBrush, QPixmap, QPainterPath, QImage, QPen, QPolygonF, QTransform
+import math
+import cv2
+import numpy as np
+from .Conversions import array_to_qimage, bgr_to_qimage
+from .History import TileHistory
+from .ImageCache import ImageCache
+from .Masks import BACKGROUND, CLASS_COLORS, EMPTY, FOREGROUND, POSSIBLE_FOREGROUND, allocate_mask
+from .Profiling import timed
+from .Pyramid import level_for_scale
+
+MASK_COLOR_TABLE = [QColor(red, green, blue, alpha).rgba() for blue, green, red, alpha in CLASS_COLORS]
+# Subsampled mask levels are only used to draw when zoomed out, so there is no need to go past 1/64 scale
+MAX_MASK_LEVELS = 7
+# Outlines of the inactive label layers, in the order the layers were given
+OUTLINE_COLORS = [QColor(255, 255, 0), QColor(0, 255, 255), QColor(255, 0, 255), QColor(255, 255, 255)]
+
+
+def mask_image(mask):
+    """Wrap a class mask from allocate_mask in an Indexed8 QImage that shares its memory
+
+    The colour table maps each class to its display colour, so edits to the mask show up without any conversion.
+    The caller must keep the mask alive for as long as the image is used.
+    """
+    return array_to_qimage(mask, QImage.Format_Indexed8, color_table=MASK_COLOR_TABLE)
+
+
+def mask_outline(mask, max_size=2048):
+    """QPainterPath around the foreground and possible foreground of a class mask
+
+    Large masks are traced on a subsampled copy, since the outline is only drawn as a guide.
+    """
+    step = max(1, int(math.ceil(max(mask.shape) / float(max_size))))
+    foreground = cv2.inRange(np.ascontiguousarray(mask[::step, ::step]), FOREGROUND, POSSIBLE_FOREGROUND)
+    contours, _ = cv2.findContours(foreground, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    path = QPainterPath()
+    for contour in contours:
+        points = (contour[:, 0, :] * step + step // 2).tolist()
+        path.addPolygon(QPolygonF([QtCore.QPointF(x, y) for x, y in points]))
+        path.closeSubpath()
+    return path
+
+
+def visible_tiles(rect, bounds, span):
+    """(x, y, width, height) of each span sized tile of bounds that overlaps rect, all in full resolution pixels"""
+    rect = rect.intersected(bounds)
+    if rect.isEmpty():
+        return []
+    tiles = []
+    for y in range(int(rect.top()) // span * span, int(math.ceil(rect.bottom())), span):
+        for x in range(int(rect.left()) // span * span, int(math.ceil(rect.right())), span):
+            tiles.append((x, y, min(span, int(bounds.width()) - x), min(span, int(bounds.height()) - y)))
+    return tiles
+
+
+class TiledImageItem(QGraphicsItem):
+    """Draws an ImagePyramid one tile at a time, from the level that matches the current zoom
+
+    Only the tiles that are exposed get read from the pyramid, and the converted tiles are kept in a small cache so
+    panning and repainting don't convert them again.
+    """
+    def __init__(self, tile_size=512, cache_mb=128):
+        super(TiledImageItem, self).__init__()
+        self.pyramid = None
+        self.tile_size = tile_size
+        self.tiles = ImageCache(budget_mb=cache_mb)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def setPyramid(self, pyramid):
+        self.prepareGeometryChange()
+        self.pyramid = pyramid
+        self.tiles.clear()
+        self.update()
+
+    def boundingRect(self):
+        if self.pyramid is None:
+            return QtCore.QRectF()
+        return QtCore.QRectF(0, 0, self.pyramid.width, self.pyramid.height)
+
+    def paint(self, painter, option, widget=None):
+        if self.pyramid is None:
+            return
+        level = level_for_scale(option.levelOfDetailFromTransform(painter.worldTransform()), len(self.pyramid))
+        span = self.tile_size << level
+        for x, y, width, height in visible_tiles(option.exposedRect, self.boundingRect(), span):
+            key = (level, x, y)
+            image = self.tiles.get(key)
+            if image is None:
+                image = self._tile(level, x >> level, y >> level)
+                self.tiles.put(key, image)
+            painter.drawImage(QtCore.QRectF(x, y, width, height), image)
+
+    def _tile(self, level, x, y):
+        return bgr_to_qimage(self.pyramid.level(level)[y:y + self.tile_size, x:x + self.tile_size])
+
+
+class SegmentationLayer(QGraphicsItem):
+    """Draws the segmentation straight from its Indexed8 QImage
+
+    Nothing is converted or uploaded when the mask changes, so an edit only has to call invalidate() with the
+    rectangle it touched and only the exposed part of the mask is redrawn. When zoomed out, the mask is drawn from
+    subsampled tiles instead, so that a large mask isn't scaled down in full on every repaint.
+    """
+    def __init__(self, tile_size=512, cache_mb=32):
+        super(SegmentationLayer, self).__init__()
+        self.image = None
+        self.mask = None
+        self.tile_size = tile_size
+        self.tiles = ImageCache(budget_mb=cache_mb)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def setImage(self, image, mask=None):
+        self.prepareGeometryChange()
+        self.image = image
+        self.mask = mask
+        self.tiles.clear()
+        self.update()
+
+    def invalidate(self, rect=None):
+        """Drop the subsampled tiles overlapping rect, or all of them, and repaint"""
+        if rect is None:
+            self.tiles.clear()
+            self.update()
+            return
+        for level in range(1, MAX_MASK_LEVELS):
+            span = self.tile_size << level
+            for x, y, _, _ in visible_tiles(rect, self.boundingRect(), span):
+                self.tiles.discard((level, x, y))
+        self.update(rect)
+
+    def boundingRect(self):
+        if self.image is None:
+            return QtCore.QRectF()
+        return QtCore.QRectF(self.image.rect())
+
+    def paint(self, painter, option, widget=None):
+        if self.image is None:
+            return
+        level = 0
+        if self.mask is not None:
+            level = level_for_scale(option.levelOfDetailFromTransform(painter.worldTransform()), MAX_MASK_LEVELS)
+        if level == 0:
+            rect = option.exposedRect.toAlignedRect().intersected(self.image.rect())
+            painter.drawImage(rect.topLeft(), self.image, rect)
+            return
+        span = self.tile_size << level
+        for x, y, width, height in visible_tiles(option.exposedRect, self.boundingRect(), span):
+            key = (level, x, y)
+            image = self.tiles.get(key)
+            if image is None:
+                step = 1 << level
+                image = array_to_qimage(self.mask[y:y + height:step, x:x + width:step], QImage.Format_Indexed8,
+                                        color_table=MASK_COLOR_TABLE, copy=True)
+                self.tiles.put(key, image)
+            painter.drawImage(QtCore.QRectF(x, y, width, height), image)
+
+
+class MaskLayer(object):
+    """The class mask for one label type of the current image, with its own undo history and unsaved changes flag
+
+    The mask is only allocated once the layer is shown or a saved mask is loaded into it.
+    """
+    def __init__(self, color):
+        self.mask = None
+        self.image = None
+        self.history = TileHistory(budget_mb=64)
+        self.changed = False
+        self.outline = QGraphicsPathItem()
+        pen = QPen(color, 2)
+        pen.setCosmetic(True)
+        self.outline.setPen(pen)
+        self.outline.setOpacity(0.6)
+        self.outline.hide()
+        # Set when the mask may no longer match the outline
+        self.outline_stale = True
+
+    def reset(self):
+        self.mask = None
+        self.image = None
+        self.history.clear()
+        self.changed = False
+        self.outline.setPath(QPainterPath())
+        self.outline_stale = True
 
 
 class ImageSegmenterView(QGraphicsView):
     photoClicked = Signal(QPoint)
+    # Emitted when a reduced resolution preview is no longer enough, the receiver should call swapPhoto
+    fullResolutionRequested = Signal()
     def __init__(self, parent):
         super(ImageSegmenterView, self).__init__(parent)
         self._zoom = 0
         self.empty = True
         self._scene = QGraphicsScene(self)
         self._photo = QGraphicsPixmapItem()
+        self._photo_rect = QtCore.QRectF()
+        # True while _photo holds a reduced resolution preview scaled up to the full image size
+        self.preview = False
+        # Used instead of _photo for images too large to hold as a single pixmap
+        self._tiled_photo = TiledImageItem()
         self.image_hidden = False
-        self._seglayer = QGraphicsPixmapItem()
+        self._seglayer = SegmentationLayer()
         self._seglayer.setOpacity(0.5)
         self._scene.addItem(self._photo)
+        self._scene.addItem(self._tiled_photo)
         self._scene.addItem(self._seglayer)
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
@@ -26,24 +215,122 @@ class ImageSegmenterView(QGraphicsView):
         self.setBackgroundBrush(QBrush(QtCore.Qt.darkGray))
         self.setFrameShape(QFrame.NoFrame)
 
-        self.seg_image = None
+        # One layer per label type, each holding a one byte class index per pixel. mask, seg_image, history and
+        # changed refer to the active layer
+        self.layers = {}
+        self.active_layer = None
+        self.show_outlines = False
+        self._mask_size = None
+        self._mask_on_disk = False
+        self.set_layer_names([None])
         self.start = False
         self.prev_point = None
-        self.painter = None
-        self.segmenter_pen = QPen(QtCore.Qt.green, 30, QtCore.Qt.SolidLine)
-        self.segmenter_pen.setCapStyle(QtCore.Qt.RoundCap)
-        self.segmenter_pen.setJoinStyle(QtCore.Qt.RoundJoin)
-        self.erase = False
-        self.changed = False
+        self.brush_class = FOREGROUND
+        self.pen_size = 30
+        # Superpixels of the current image, used by the superpixel brush to fill whole regions
+        self.superpixels = None
+        self.superpixel_brush = False
+        self.filled_superpixels = set()
+
+    @property
+    def mask(self):
+        return self.layers[self.active_layer].mask
 
-        self.history = collections.deque(maxlen=10)
-        self.future = collections.deque(maxlen=10)
+    @property
+    def seg_image(self):
+        return self.layers[self.active_layer].image
+
+    @property
+    def history(self):
+        return self.layers[self.active_layer].history
+
+    @property
+    def changed(self):
+        return self.layers[self.active_layer].changed
+
+    @changed.setter
+    def changed(self, value):
+        self.layers[self.active_layer].changed = value
+
+    def set_layer_names(self, names, active=None):
+        """Replace the layers with an empty one for each name, showing active or else the first one"""
+        for layer in self.layers.values():
+            self._scene.removeItem(layer.outline)
+        self.layers = {}
+        for idx, name in enumerate(names):
+            layer = MaskLayer(OUTLINE_COLORS[idx % len(OUTLINE_COLORS)])
+            self._scene.addItem(layer.outline)
+            self.layers[name] = layer
+        self.active_layer = active if active in self.layers else names[0]
+        if self._mask_size is not None:
+            self._reset_layers(*self._mask_size, on_disk=self._mask_on_disk)
+
+    def set_active_layer(self, name):
+        """Show and edit the layer for another label type. Its mask, history and changed flag are kept as they were"""
+        if name == self.active_layer:
+            return
+        self.start = False
+        self.prev_point = None
+        self.layers[self.active_layer].outline_stale = True
+        self.active_layer = name
+        layer = self.layers[name]
+        if self._mask_size is not None and layer.mask is None:
+            self.set_mask(allocate_mask(*self._mask_size, on_disk=self._mask_on_disk))
+        self._seglayer.setImage(layer.image, layer.mask)
+        self._update_outlines()
+
+    def changed_layers(self):
+        """Names of the layers with unsaved changes"""
+        return [name for name, layer in self.layers.items() if layer.changed]
+
+    def load_layer(self, name, mask=None):
+        """Set a layer to a saved mask, or clear it if mask is None. This isn't undoable and leaves it unchanged"""
+        layer = self.layers[name]
+        layer.history.clear()
+        layer.changed = False
+        layer.outline_stale = True
+        if mask is None and layer.mask is not None:
+            layer.mask[...] = EMPTY
+        elif mask is not None:
+            if layer.mask is None or layer.mask.shape != mask.shape:
+                self.set_mask(allocate_mask(mask.shape[0], mask.shape[1], on_disk=self._mask_on_disk), name)
+            layer.mask[...] = mask
+        if name == self.active_layer:
+            self._seglayer.invalidate()
+        else:
+            self._update_outlines()
+
+    def set_show_outlines(self, show):
+        """Draw the foreground of the inactive layers as faint outlines"""
+        self.show_outlines = show
+        self._update_outlines()
+
+    def _update_outlines(self):
+        for name, layer in self.layers.items():
+            visible = self.show_outlines and name != self.active_layer and layer.mask is not None
+            if visible and layer.outline_stale:
+                layer.outline.setPath(mask_outline(layer.mask))
+                layer.outline_stale = False
+            layer.outline.setVisible(visible)
+
+    def _reset_layers(self, height, width, on_disk=False):
+        """Clear every layer for a new image, allocating only the active one"""
+        self._mask_size = (height, width)
+        self._mask_on_disk = on_disk
+        for layer in self.layers.values():
+            layer.reset()
+        self.set_mask(allocate_mask(height, width, on_disk=on_disk))
+        self._update_outlines()
 
     def hasPhoto(self):
         return not self.empty
 
+    def photoRect(self):
+        """Scene rectangle of the image at full resolution"""
+        return QtCore.QRectF(self._photo_rect)
+
     def fitInView(self, scale=True):
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self.photoRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.hasPhoto():
@@ -56,61 +343,111 @@ class ImageSegmenterView(QGraphicsView):
                 self.scale(factor, factor)
             self._zoom = 0
 
-    def setPhoto(self, pixmap=None):
+    def setPhoto(self, pixmap=None, full_size=None):
+        """Show a pixmap. If full_size is given, the pixmap is a preview of an image of that size
+
+        Without a pixmap the image and every layer are cleared, leaving nothing to paint on or save.
+        """
         self._zoom = 0
         if pixmap and not pixmap.isNull():
             self.empty = False
             self.changed = False
-            self._photo.setPixmap(pixmap)
-            self.seg_image = QImage(pixmap.width(), pixmap.height(), QImage.Format_ARGB32_Premultiplied)
-            self.seg_image.fill(QtCore.Qt.transparent)
-            self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
+            self._tiled_photo.setPyramid(None)
+            if full_size is None:
+                full_size = pixmap.size()
+            self._photo_rect = QtCore.QRectF(0, 0, full_size.width(), full_size.height())
+            self._set_photo_pixmap(pixmap)
+            self._reset_layers(full_size.height(), full_size.width())
         else:
-            self._empty = True
+            self.empty = True
+            self.preview = False
+            self._photo_rect = QtCore.QRectF()
             self._photo.setPixmap(QPixmap())
+            self._tiled_photo.setPyramid(None)
+            self._mask_size = None
+            for layer in self.layers.values():
+                layer.reset()
+            self._seglayer.setImage(None)
+            self._update_outlines()
+        self.fitInView()
+
+    def swapPhoto(self, pixmap):
+        """Replace a preview with the full resolution image, keeping the mask, history and zoom"""
+        self._set_photo_pixmap(pixmap)
+
+    def _set_photo_pixmap(self, pixmap):
+        self._photo.setPixmap(pixmap)
+        self.preview = pixmap.size() != self._photo_rect.size().toSize()
+        self._photo.setTransform(QTransform.fromScale(self._photo_rect.width() / pixmap.width(),
+                                                      self._photo_rect.height() / pixmap.height()))
+
+    def preview_exceeded(self):
+        """Whether the preview is being shown at more than one screen pixel per preview pixel"""
+        return self.preview and self.transform().m11() * self._photo.transform().m11() > 1
+
+    def setPyramid(self, pyramid):
+        """Show an ImagePyramid, with the mask kept on disk to match"""
+        self._zoom = 0
+        self.empty = False
+        self.changed = False
+        self._photo.setPixmap(QPixmap())
+        self.preview = False
+        self._photo_rect = QtCore.QRectF(0, 0, pyramid.width, pyramid.height)
+        self._tiled_photo.setPyramid(pyramid)
+        self._reset_layers(pyramid.height, pyramid.width, on_disk=True)
         self.fitInView()
 
     def save_state(self):
-        if self.future is not None:
-            while len(self.future) > 0:
-                present = self.future.pop()
-                del present
-        if self.seg_image is not None:
-            self.history.append(self.seg_image.copy())
+        """Start a new undoable operation, the tiles it changes are recorded before they are modified"""
+        self.history.begin()
 
     def clear_history(self):
-        while len(self.history) > 0:
-            present = self.history.pop()
-            del present
+        for layer in self.layers.values():
+            layer.history.clear()
 
     def undo(self):
-        if len(self.history) > 0:
-            self.future.append(self.seg_image)
-            present = self.history.pop()
-            self.seg_image = present
-            self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
+        if self.mask is not None and self.history.undo(self.mask):
+            self._seglayer.invalidate()
 
     def redo(self):
-        if len(self.future) > 0:
-            self.history.append(self.seg_image)
-            present = self.future.pop()
-            self.seg_image = present
-            self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
-
-    def setSegLayer(self, pixmap=None):
-        if not self._photo.pixmap().isNull():
+        if self.mask is not None and self.history.redo(self.mask):
+            self._seglayer.invalidate()
+
+    def set_mask(self, mask, name=None):
+        """Make mask the array of a layer, the active one by default"""
+        if name is None:
+            name = self.active_layer
+        layer = self.layers[name]
+        layer.mask = mask
+        layer.image = mask_image(mask)
+        if name == self.active_layer:
+            self._seglayer.setImage(layer.image, mask)
+
+    def replace_mask(self, mask):
+        """Replace the whole class mask as a single undoable operation"""
+        if self.mask is not None:
             self.save_state()
-            self.seg_image = QImage(pixmap.toImage())
-            self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
+            self.history.touch_changed(self.mask, mask)
+            self.history.commit()
+        if self.mask is not None and self.mask.shape == mask.shape:
+            self.mask[...] = mask
+            self._seglayer.invalidate()
+        else:
+            new_mask = allocate_mask(mask.shape[0], mask.shape[1], on_disk=self._mask_on_disk)
+            new_mask[...] = mask
+            self.set_mask(new_mask)
+
+    @timed('set mask')
+    def setSegLayer(self, mask=None):
+        if not self.photoRect().isEmpty():
+            self.replace_mask(mask)
 
     def resetSegLayer(self):
-        if not self._photo.pixmap().isNull():
+        if not self.photoRect().isEmpty():
             self.changed = True
-            self.save_state()
-            del self.seg_image
-            self.seg_image = QImage(self._photo.pixmap().width(), self._photo.pixmap().height(), QImage.Format_ARGB32_Premultiplied)
-            self.seg_image.fill(QtCore.Qt.transparent)
-            self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
+            rect = self.photoRect()
+            # A read-only view of a single zero, so clearing a large mask doesn't allocate a second one
+            self.replace_mask(np.broadcast_to(np.uint8(EMPTY), (int(rect.height()), int(rect.width()))))
 
     def wheelEvent(self, event):
         if self.hasPhoto() and not self.start:
@@ -122,23 +459,24 @@ class ImageSegmenterView(QGraphicsView):
                 self._zoom -= 1
             if self._zoom > 0:
                 self.scale(factor, factor)
+                if self.preview_exceeded():
+                    self.fullResolutionRequested.emit()
             elif self._zoom == 0:
                 self.fitInView()
             else:
                 self._zoom = 0
 
     def mousePressEvent(self, event):
-        if not self._photo.pixmap().isNull():
+        if not self.photoRect().isEmpty():
             if event.button() == QtCore.Qt.LeftButton:
+                if self.preview:
+                    self.fullResolutionRequested.emit()
                 self.save_state()
                 self.start = True
-                self.painter = QPainter(self.seg_image)
-                if self.erase:
-                    self.painter.setCompositionMode(QPainter.CompositionMode_Clear)
-                self.painter.setPen(self.segmenter_pen)
+                self.filled_superpixels = set()
                 self.paint_point(event.pos())
             elif event.button() == QtCore.Qt.RightButton:
-                if not self._photo.pixmap().isNull():
+                if not self.photoRect().isEmpty():
                     self.setDragMode(QGraphicsView.ScrollHandDrag)
                     self.scroll_origin = self.mapToScene(event.pos())
                 # if self._photo.isUnderMouse():
@@ -146,7 +484,7 @@ class ImageSegmenterView(QGraphicsView):
         super(ImageSegmenterView, self).mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
-        if not self._photo.pixmap().isNull():
+        if not self.photoRect().isEmpty():
             if self.start:
                 self.paint_point(event.pos())
             if event.buttons() & QtCore.Qt.RightButton:
@@ -157,42 +495,71 @@ class ImageSegmenterView(QGraphicsView):
         super(ImageSegmenterView, self).mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
-        if not self._photo.pixmap().isNull():
+        if not self.photoRect().isEmpty():
             if self.start:
                 self.start = False
                 self.prev_point = None
-                self.painter.end()
+                self.history.commit()
             if self.dragMode() == QGraphicsView.ScrollHandDrag:
                 self.setDragMode(QGraphicsView.NoDrag)
 
+    @timed('paint point')
     def paint_point(self, pos):
         self.changed = True
         pos = self.mapToScene(pos).toPoint()
-        if self.prev_point is not None:
-            self.painter.drawLine(self.prev_point, pos)
+        prev_point = self.prev_point if self.prev_point is not None else pos
+        radius = self.pen_size // 2 + 2
+        dirty = QtCore.QRect(QtCore.QPoint(min(prev_point.x(), pos.x()) - radius, min(prev_point.y(), pos.y()) - radius),
+                             QtCore.QPoint(max(prev_point.x(), pos.x()) + radius, max(prev_point.y(), pos.y()) + radius))
+        if self.superpixel_brush and self.superpixels is not None and self.superpixels.full_shape == self.mask.shape:
+            self.fill_superpixels(prev_point, pos, dirty)
         else:
-            self.painter.drawPoint(pos)
+            self.history.touch(self.mask, dirty.left(), dirty.top(), dirty.right() + 1, dirty.bottom() + 1)
+            # Thick lines are drawn with round caps, so a zero length line is a dot
+            cv2.line(self.mask, (prev_point.x(), prev_point.y()), (pos.x(), pos.y()), int(self.brush_class), self.pen_size)
+            self._seglayer.invalidate(QtCore.QRectF(dirty))
         self.prev_point = pos
-        self._seglayer.setPixmap(QPixmap.fromImage(self.seg_image))
+
+    def fill_superpixels(self, prev_point, pos, dirty):
+        """Fill every superpixel under a stroke segment with the brush class, each one only once per stroke"""
+        height, width = self.mask.shape
+        x0, y0 = max(0, dirty.left()), max(0, dirty.top())
+        x1, y1 = min(width, dirty.right() + 1), min(height, dirty.bottom() + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        stroke = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        cv2.line(stroke, (prev_point.x() - x0, prev_point.y() - y0), (pos.x() - x0, pos.y() - y0), 1, self.pen_size)
+        ids = np.unique(self.superpixels.labels_in_rect(x0, y0, x1, y1)[stroke > 0]).tolist()
+        ids = [idx for idx in ids if idx not in self.filled_superpixels]
+        if len(ids) == 0:
+            return
+        self.filled_superpixels.update(ids)
+        x0, y0, x1, y1 = self.superpixels.full_bounds(ids)
+        self.history.touch(self.mask, x0, y0, x1, y1)
+        region = np.isin(self.superpixels.labels_in_rect(x0, y0, x1, y1), ids)
+        self.mask[y0:y1, x0:x1][region] = self.brush_class
+        self._seglayer.invalidate(QtCore.QRectF(x0, y0, x1 - x0, y1 - y0))
 
     def set_foreground(self):
-        self.erase = False
-        self.segmenter_pen.setColor(QtCore.Qt.green)
+        self.brush_class = FOREGROUND
 
     def set_possible_foreground(self):
-        self.erase = False
-        self.segmenter_pen.setColor(QtCore.Qt.blue)
+        self.brush_class = POSSIBLE_FOREGROUND
 
     def set_possible_background(self):
-        self.erase = True
-        self.segmenter_pen.setColor(QtCore.Qt.transparent)
+        self.brush_class = EMPTY
 
     def set_background(self):
-        self.erase = False
-        self.segmenter_pen.setColor(QtCore.Qt.red)
+        self.brush_class = BACKGROUND
 
     def set_pen_size(self, size):
-        self.segmenter_pen.setWidth(size)
+        self.pen_size = size
+
+    def set_superpixels(self, superpixels):
+        self.superpixels = superpixels
+
+    def set_superpixel_brush(self, enabled):
+        self.superpixel_brush = enabled
 
     def set_opacity(self, value):
         self._seglayer.setOpacity(value / 100)
@@ -200,7 +567,9 @@ class ImageSegmenterView(QGraphicsView):
     def hide_image(self):
         if self.image_hidden:
             self._photo.setOpacity(1)
+            self._tiled_photo.setOpacity(1)
             self.image_hidden = False
         else:
             self._photo.setOpacity(0)
+            self._tiled_photo.setOpacity(0)
             self.image_hidden = True
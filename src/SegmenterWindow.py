@@ -1,16 +1,25 @@
-import cv2
-import glob
-import imghdr
 import os
-import tempfile
-from pathlib import Path
-import numpy as np
+import time
 
-from PySide2.QtWidgets import QVBoxLayout, QHBoxLayout, QToolButton, QSpinBox, QLineEdit, QGraphicsView, QSlider, QWidget, QApplication, QFileDialog, QMainWindow, QAction, QMessageBox, QPushButton, QLabel, QGroupBox, QComboBox
-from PySide2.QtGui import QPixmap, QImage
-from PySide2.QtCore import Slot, Qt
+from PySide2.QtWidgets import QVBoxLayout, QHBoxLayout, QToolButton, QSpinBox, QLineEdit, QWidget, QApplication, QFileDialog, QMainWindow, QAction, QActionGroup, QMessageBox, QPushButton, QLabel, QGroupBox, QProgressBar
+from PySide2.QtGui import QPixmap, QImage, QImageIOHandler, QImageReader
+from PySide2.QtCore import Slot, Qt, QThreadPool, QFileSystemWatcher, QTimer
 from .SegmenterView import ImageSegmenterView
-from .CustomClasses import LabeledComboBox, LabeledSlider, LabeledSpinBox, ClickableLineEdit
+from .AutoTune import LatencyTuner
+from .Engines import ENGINES
+from .Filmstrip import FilmstripDelegate, FilmstripModel, FilmstripView, ThumbnailLoader
+from .GrabCut import GrabCutState
+from .ImageCache import ImageCache
+from .LabelIndex import LABEL_TYPES, LabelIndex, label_folder, label_name
+from .Manifest import DirectoryManifest
+from .Masks import MASK_FORMATS, PNG_COMPRESSION_LEVELS, read_mask
+from .MaskStore import MaskStore, store_dir
+from .Profiling import ProfileCapture, recorder, timed
+from .Project import PROJECT_DIR, ProjectManifest, ProjectStore, last_image_dir, set_last_image_dir
+from .Pyramid import ImagePyramid, image_pixels
+from .Workers import (CalibrationWorker, DirectoryScanner, GrabCutWorker, ImageLoader, MaskSaver, MaskStoreSync,
+                      SuperpixelWorker)
+from .CustomClasses import LabeledComboBox, LabeledSlider, LabeledSpinBox, ClickableLineEdit, LatencyDialog
 
 
 def ensure_dir(*paths):
@@ -26,16 +35,6 @@ def ensure_dir(*paths):
     return full_path
 
 
-def QImage_to_CVMat(image):
-    image = image.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
-    width = image.width()
-    height = image.height()
-
-    ptr = image.constBits()
-    arr = np.array(ptr).reshape(height, width, 4)
-    return arr
-
-
 class SegmenterWidget(QWidget):
     def __init__(self):
         super(SegmenterWidget, self).__init__()
@@ -44,26 +43,90 @@ class SegmenterWidget(QWidget):
         self.src_paths = []
         self.current_idx = None
         self.prev_idx = 0
-        label_types = [
-            'Foot',
-            'Inner Wound',
-            'Outer Wound'
-        ]
-
-        # Load last used image directory
-        self.meta_file = os.path.join(os.path.dirname(__file__), 'meta.txt')
-        if os.path.exists(self.meta_file):
-            with open(self.meta_file, 'r') as f:
-                last_active_image_dir = f.readline().strip()
-                # print(last_active_image_dir)
-                if os.path.exists(last_active_image_dir):
-                    self.active_image_dir = last_active_image_dir
+        # Incremented whenever the image or label type changes so that background results can be checked for staleness
+        self.context_token = 0
+        self.grabcut_worker = None
+        # Colour models from previous GrabCut runs, keyed by (image path, label type)
+        self.grabcut_states = {}
+        self.thread_pool = QThreadPool.globalInstance()
+        # Decoded images and label masks, with the neighbours of the current image loaded ahead of time
+        self.image_cache = ImageCache(budget_mb=1024)
+        # One of Masks.MASK_FORMATS and a png zlib level, used when saving label files
+        self.mask_format = 'RGBA'
+        self.png_compression = 3
+        # Label files are written one at a time in the background, in the order they were saved
+        self.save_pool = QThreadPool(self)
+        self.save_pool.setMaxThreadCount(1)
+        # Whether saved masks are also kept in a MaskStore per label folder, set per image directory
+        self.use_mask_store = False
+        # MaskStore of each label folder, only ever written to from the save pool
+        self.mask_stores = {}
+        self.current_image = None
+        self.prefetch_count = 3
+        self.prefetching = set()
+        self.prefetch_pool = QThreadPool(self)
+        self.prefetch_pool.setMaxThreadCount(2)
+        # Images larger than this are shown from a tiled pyramid rather than decoded into a single QImage
+        self.max_image_pixels = 64 * 1024 * 1024
+        # Images at least this many times the viewer size are shown from a reduced decode while the full one loads
+        self.preview_factor = 2
+        self.pyramid_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ImageSegmenter', 'pyramids')
+        # The least recently used pyramids are removed once they take up more than this
+        self.pyramid_cache_bytes = 8 * 1024 ** 3
+        self.superpixel_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ImageSegmenter', 'superpixels')
+        self.thumbnail_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'ImageSegmenter', 'thumbnails')
+        self.thumbnail_size = 96
+        # Superpixels of the current image, computed in the background while the superpixel brush or mode is in use
+        self.superpixels = None
+        self.superpixels_pending = set()
+        self.manifest = None
+        # Database of the file list, label status and session for the open image directory
+        self.project = None
+        self.project_dir = PROJECT_DIR
+        # Image to open once the directory listing comes in, when resuming a session
+        self.resume_image = None
+        self.grabcut_started = None
+        # Picks GrabCut's working resolution and iterations to fit a target latency, calibrated once per machine
+        self.latency_tuner = LatencyTuner()
+        if not self.latency_tuner.calibrated:
+            calibration = CalibrationWorker()
+            calibration.signals.finished.connect(self.calibration_finished)
+            self.thread_pool.start(calibration)
+        # Image shape, options and whether it was warm started, for the GrabCut run the tuner set up
+        self.grabcut_tuning = None
+        self.dir_scanner = None
+        self.awaiting_first_image = False
+        label_types = list(LABEL_TYPES)
+        self.label_types = label_types
+        # Which images have masks for each label type, kept current by saves and by watching the label folders
+        self.label_index = LabelIndex(label_types)
+        self.label_watcher = QFileSystemWatcher(self)
+        self.label_watcher.directoryChanged.connect(self.label_folder_changed)
+        # Folders are rescanned once they stop changing, as a single save changes a folder more than once
+        self.changed_label_folders = set()
+        self.label_rescan_timer = QTimer(self)
+        self.label_rescan_timer.setSingleShot(True)
+        self.label_rescan_timer.setInterval(250)
+        self.label_rescan_timer.timeout.connect(self.rescan_label_folders)
 
         # Set up Segmenter Widget
         self.image_title = QLineEdit(self)
         self.image_title.setText('--None--')
         self.image_title.setReadOnly(True)
         self.viewer = ImageSegmenterView(self)
+        self.viewer.fullResolutionRequested.connect(self.load_full_image)
+        # Every label type of the current image is kept in its own layer, so switching between them is instant
+        self.viewer.set_layer_names(label_types)
+
+        # Filmstrip of every image in the folder, with a badge for each label type it has a mask for
+        self.thumbnail_loader = ThumbnailLoader(self.thumbnail_cache_dir, self.thumbnail_size, parent=self)
+        self.filmstrip_model = FilmstripModel(self.thumbnail_loader, self.label_index, label_types, self)
+        self.filmstrip = FilmstripView(self.thumbnail_loader, self)
+        self.filmstrip.setItemDelegate(FilmstripDelegate(self.thumbnail_size, self.filmstrip))
+        self.filmstrip.setModel(self.filmstrip_model)
+        self.filmstrip.setFixedWidth(self.thumbnail_size + 8 + self.filmstrip.verticalScrollBar().sizeHint().width() + 4)
+        self.filmstrip.clicked.connect(self.filmstrip_clicked)
+        self.filmstrip.activated.connect(self.filmstrip_clicked)
 
         # Bottom Toolbar Widgets
 
@@ -97,6 +160,7 @@ class SegmenterWidget(QWidget):
         self.skip_label_btn = QToolButton(self)
         self.skip_label_btn.setText('Next Labeled Image  ')
         self.skip_label_btn.clicked.connect(self.skipto_next_label)
+        self.label_count = QLabel(self)
 
         ## Sliders
         self.opacity_slider = LabeledSlider('Mask Opacity: {}%',
@@ -140,11 +204,18 @@ class SegmenterWidget(QWidget):
         self.eraser_button.setChecked(False)
         self.eraser_button.setAutoExclusive(True)
         self.eraser_button.clicked.connect(self.viewer.set_possible_background)
+        self.superpixel_btn = QPushButton('Superpixel Brush')
+        self.superpixel_btn.setCheckable(True)
+        self.superpixel_btn.setChecked(False)
+        self.superpixel_btn.setToolTip('Fill whole superpixels under the brush instead of painting pixels')
+        self.superpixel_btn.toggled.connect(self.viewer.set_superpixel_brush)
+        self.superpixel_btn.toggled.connect(self.request_superpixels)
         brush_layout = QVBoxLayout()
         brush_layout.addWidget(self.foreground_btn)
         brush_layout.addWidget(self.poss_foreground_btn)
         brush_layout.addWidget(self.background_btn)
         brush_layout.addWidget(self.eraser_button)
+        brush_layout.addWidget(self.superpixel_btn)
         self.brush_box.setLayout(brush_layout)
 
         ## Image Action Buttons
@@ -162,9 +233,33 @@ class SegmenterWidget(QWidget):
         self.clear_button.setText('Clear Mask')
         self.clear_button.clicked.connect(self.viewer.resetSegLayer)
 
+        self.engine_options = LabeledComboBox("Segmentation Engine", items=list(ENGINES))
+        for idx, engine in enumerate(ENGINES.values()):
+            self.engine_options.combo_box.setItemData(idx, engine.description, Qt.ToolTipRole)
+        self.engine_options.currentTextChanged.connect(self.request_superpixels)
+        self.engine_options.currentTextChanged.connect(self.update_latency_box)
+        self.latency_label = QLabel('Target Latency', self)
+        self.latency_box = QSpinBox(self)
+        self.latency_box.setRange(0, 10000)
+        self.latency_box.setSingleStep(100)
+        self.latency_box.setSuffix(' ms')
+        self.latency_box.setSpecialValueText('Off')
+        self.latency_box.setToolTip('How long GrabCut should take. It works at the highest resolution that fits, '
+                                    'or at 1/8 scale when off.')
+        target = self.latency_tuner.target
+        self.latency_box.setValue(0 if target is None else int(round(target * 1000)))
+        self.latency_box.valueChanged.connect(self.set_target_latency)
+        self.update_latency_box(self.engine_options.currentText())
         self.grabcut_button = QToolButton(self)
-        self.grabcut_button.setText('Run &GrabCut Segmenter')
+        self.grabcut_button.setText('Run &Segmenter')
         self.grabcut_button.clicked.connect(self.run_grabcut)
+        self.grabcut_progress = QProgressBar(self)
+        self.grabcut_progress.setTextVisible(False)
+        self.grabcut_progress.hide()
+        self.cancel_grabcut_button = QToolButton(self)
+        self.cancel_grabcut_button.setText('Cancel Segmenter')
+        self.cancel_grabcut_button.clicked.connect(self.cancel_grabcut)
+        self.cancel_grabcut_button.hide()
 
         self.hide_image_button = QToolButton(self)
         self.hide_image_button.setText('Show/&Hide Image')
@@ -194,6 +289,7 @@ class SegmenterWidget(QWidget):
         Skippers = QVBoxLayout()
         Skippers.addWidget(self.skip_btn)
         Skippers.addWidget(self.skip_label_btn)
+        Skippers.addWidget(self.label_count)
 
         # BottomToolbar.addWidget(self.skip_btn)
         BottomToolbar.addLayout(Skippers)
@@ -207,14 +303,20 @@ class SegmenterWidget(QWidget):
         RightToolbar.addWidget(self.undo_btn)
         RightToolbar.addWidget(self.redo_btn)
         RightToolbar.addStretch()
-        # self.gc_spinner.setFixedHeight(0)
-        # RightToolbar.addWidget(self.gc_spinner)
         RightToolbar.addWidget(self.hide_image_button)
+        RightToolbar.addWidget(self.engine_options)
+        LatencySelector = QHBoxLayout()
+        LatencySelector.addWidget(self.latency_label)
+        LatencySelector.addWidget(self.latency_box)
+        RightToolbar.addLayout(LatencySelector)
         RightToolbar.addWidget(self.grabcut_button)
+        RightToolbar.addWidget(self.grabcut_progress)
+        RightToolbar.addWidget(self.cancel_grabcut_button)
         RightToolbar.addWidget(self.save_button)
         RightToolbar.addWidget(self.clear_button)
 
         TopLayout = QHBoxLayout()
+        TopLayout.addWidget(self.filmstrip)
         ImageLayout = QVBoxLayout()
         ImageLayout.addWidget(self.image_title)
         ImageLayout.addWidget(self.viewer)
@@ -228,10 +330,59 @@ class SegmenterWidget(QWidget):
         MainLayout.addLayout(FlatSliders)
         MainLayout.addLayout(BottomStack)
 
+        self.restore_session()
+
     @Slot()
     def exit_app(self, checked):
         QApplication.quit()
 
+    def restore_session(self):
+        """Reopen the last image directory at the image, label folder and label type it was left on"""
+        image_dir = last_image_dir()
+        if image_dir is None:
+            return
+        store = ProjectStore(image_dir, self.project_dir)
+        try:
+            session = store.session()
+        finally:
+            store.close()
+        if session.get('label_type') in self.label_types:
+            self.label_options.setCurrentText(session['label_type'])
+        label_dir = session.get('label_dir')
+        if label_dir is not None and not os.path.isdir(label_dir):
+            label_dir = None
+        self.open_project(image_dir, label_dir, session.get('current_image'))
+
+    def open_project(self, image_dir, label_dir=None, current_image=None):
+        """Open an image directory and its project store, starting at the named image if it is given and exists"""
+        # Unsaved masks have to be saved while the folders they belong to are still the active ones
+        if len(self.viewer.changed_layers()) > 0:
+            result = self.show_save_warning()
+            if result == QMessageBox.Save:
+                self.saveSegmentation()
+            elif result == QMessageBox.Cancel:
+                return
+        self.clear_images()
+        if self.project is not None:
+            self.project.close()
+        self.project = ProjectStore(image_dir, self.project_dir)
+        set_last_image_dir(image_dir)
+        self.use_mask_store = self.project.session().get('mask_store') == '1'
+        self.active_image_dir = image_dir
+        if label_dir is not None:
+            self.active_label_dir = label_dir
+        elif self.active_label_dir is None:
+            self.active_label_dir = self.active_image_dir
+        self.current_label_dir.setText(self.active_label_dir)
+        # Nothing is known about the new directory's images until its listing comes in
+        self.awaiting_first_image = True
+        self.project.set_session(label_dir=self.active_label_dir, label_type=self.label_options.currentText())
+        self.label_dir = ensure_dir(os.path.join(self.active_label_dir, self.label_options.currentText().replace(' ', '_')))
+        self.set_label_root(self.active_label_dir)
+        self.current_dir.setText(self.active_image_dir)
+        self.resume_image = current_image
+        self.open_image_dir(self.active_image_dir)
+
     def set_image_dir(self):
         dialog = QFileDialog(self, 'Select Image Directory')
         dialog.setFileMode(QFileDialog.Directory)
@@ -241,27 +392,86 @@ class SegmenterWidget(QWidget):
             selected_dir = dialog.selectedFiles()[0]
             if not os.path.isdir(selected_dir):
                 selected_dir = os.path.dirname(selected_dir)
-            self.active_image_dir = selected_dir
-            with open(self.meta_file, 'a+') as f:
-                f.write('Set Image Dir: ' + self.active_image_dir + '\n')
-            if self.active_label_dir is None:
-                self.active_label_dir = self.active_image_dir
-                self.current_label_dir.setText(self.active_label_dir)
-                with open(self.meta_file, 'a+') as f:
-                    f.write('Set Label Dir: ' + self.active_label_dir + '\n')
-            self.label_dir = ensure_dir(os.path.join(self.active_label_dir, self.label_options.currentText().replace(' ', '_')))
-            # image_paths = glob.glob(os.path.join(self.active_image_dir, '*.png')) + glob.glob(os.path.join(self.active_image_dir, '*.jpg'))
-            paths = glob.glob(os.path.join(self.active_image_dir, '*'))
-            image_paths = []
-            for path in paths:
-                if os.path.isdir(path):
-                    continue
-                if imghdr.what(path) in ['jpeg', 'png', 'jpg']:
-                    image_paths.append(path)
-            self.src_paths = sorted(image_paths)
-            self.current_dir.setText(self.active_image_dir)
-            self.image_idx.setRange(1, len(self.src_paths))
-            self.goto_image(1)
+            self.open_project(selected_dir)
+
+    def clear_images(self):
+        """Forget the open directory's images, so none of them are shown or saved while another directory is listed"""
+        self.invalidate_context()
+        self.src_paths = []
+        self.current_idx = None
+        self.prev_idx = 0
+        self.current_image = None
+        self.superpixels = None
+        self.viewer.set_superpixels(None)
+        self.viewer.setPhoto(None)
+        self.image_title.setText('--None--')
+        self.label_index.set_paths(self.src_paths)
+        self.filmstrip_model.set_paths(self.src_paths)
+        self.image_idx.setRange(0, 0, quiet=True)
+        self.image_idx.setValue(0, quiet=True)
+        self.update_label_count()
+
+    def open_image_dir(self, image_dir):
+        """List the images in a directory from its manifest, scanning in the background if it is out of date
+
+        The first image is shown as soon as any images are known, and the list fills in as the scan finds more.
+        """
+        if self.dir_scanner is not None:
+            self.dir_scanner.cancel()
+            self.dir_scanner = None
+        if self.project is not None:
+            self.manifest = ProjectManifest(self.project).load()
+        else:
+            self.manifest = DirectoryManifest(image_dir).load()
+        self.awaiting_first_image = True
+        if self.manifest.is_current():
+            self.add_image_paths(self.manifest.image_paths())
+            self.store_label_status()
+        else:
+            scanner = DirectoryScanner(self.manifest)
+            scanner.signals.found.connect(self.scan_found)
+            scanner.signals.finished.connect(self.scan_finished)
+            self.dir_scanner = scanner
+            self.thread_pool.start(scanner)
+
+    def scan_found(self, scanner, paths):
+        if scanner is self.dir_scanner:
+            self.add_image_paths(paths)
+
+    def scan_finished(self, scanner):
+        if scanner is self.dir_scanner:
+            self.dir_scanner = None
+            self.store_label_status()
+
+    def add_image_paths(self, paths):
+        if self.awaiting_first_image:
+            # The first batch replaces the previous directory's images
+            if len(paths) == 0:
+                return
+            self.awaiting_first_image = False
+            self.src_paths = sorted(paths)
+            self.label_index.set_paths(self.src_paths)
+            self.filmstrip_model.set_paths(self.src_paths)
+            self.update_label_count()
+            idx = 1
+            names = [os.path.basename(path) for path in self.src_paths]
+            if self.resume_image in names:
+                idx = names.index(self.resume_image) + 1
+            self.resume_image = None
+            self.image_idx.setRange(1, len(self.src_paths), quiet=True)
+            self.image_idx.setValue(idx, quiet=True)
+            self.goto_image(idx)
+        else:
+            current_path = self.src_paths[self.current_idx]
+            self.src_paths = sorted(set(self.src_paths).union(paths))
+            self.label_index.set_paths(self.src_paths)
+            self.filmstrip_model.set_paths(self.src_paths)
+            self.update_label_count()
+            self.current_idx = self.src_paths.index(current_path)
+            self.prev_idx = self.current_idx + 1
+            self.image_idx.setRange(1, len(self.src_paths), quiet=True)
+            self.image_idx.setValue(self.prev_idx, quiet=True)
+            self.filmstrip.set_current_row(self.current_idx)
 
     def set_label_dir(self):
         dialog = QFileDialog(self, 'Select Label Directory')
@@ -274,104 +484,263 @@ class SegmenterWidget(QWidget):
                 selected_dir = os.path.dirname(selected_dir)
             self.active_label_dir = selected_dir
             self.current_label_dir.setText(self.active_label_dir)
-            with open(self.meta_file, 'a+') as f:
-                f.write('Set Label Dir: ' + self.active_label_dir + '\n')
+            if self.project is not None:
+                self.project.set_session(label_dir=self.active_label_dir)
             self.label_dir = ensure_dir(os.path.join(self.active_label_dir, self.label_options.currentText().replace(' ', '_')))
-            if self.active_image_dir is not None:
-                image_name = os.path.basename(self.src_paths[self.current_idx])
-                image_name, suff = os.path.splitext(image_name)
-                self.current_label_path = os.path.join(self.label_dir, image_name + '_label.png')
-                if os.path.exists(self.current_label_path):
-                    self.viewer.setSegLayer(QPixmap(self.current_label_path))
-                else:
-                    self.viewer.resetSegLayer()
-                self.viewer.changed = False
+            self.set_label_root(self.active_label_dir)
+            if len(self.src_paths) > 0:
+                self.current_label_path = self.label_path(self.label_options.currentText())
+                self.load_layers()
 
     def label_changed(self, value):
+        """Switch to the layer for another label type, which is already in memory along with its undo history"""
+        # A GrabCut run belongs to the layer it was started on
+        self.context_token += 1
+        self.cancel_grabcut()
+        self.viewer.set_active_layer(value)
         if len(self.src_paths) > 0:
-            if self.viewer.changed:
-                result = self.show_save_warning()
-                if result == QMessageBox.Save:
-                    self.saveSegmentation()
-                elif result == QMessageBox.Cancel:
-                    self.label_options.revert()
-                    return
-                elif result == QMessageBox.Discard:
-                    pass
+            if self.project is not None:
+                self.project.set_session(label_type=value)
             self.label_dir = ensure_dir(os.path.join(self.active_label_dir, value.replace(' ', '_')))
-            image_name = os.path.basename(self.src_paths[self.current_idx])
-            image_name, suff = os.path.splitext(image_name)
-            self.current_label_path = os.path.join(self.label_dir, image_name + '_label.png')
-            if os.path.exists(self.current_label_path):
-                self.viewer.setSegLayer(QPixmap(self.current_label_path))
-            else:
-                self.viewer.resetSegLayer()
-            self.viewer.changed = False
+            if self.label_dir not in self.label_watcher.directories():
+                self.label_watcher.addPath(self.label_dir)
+            self.update_label_count()
+            self.current_label_path = self.label_path(value)
 
+    def label_path(self, label_type, idx=None):
+        """Path of the mask for a label type of an image, the current one by default"""
+        if idx is None:
+            idx = self.current_idx
+        return os.path.join(label_folder(self.active_label_dir, label_type), label_name(self.src_paths[idx]))
+
+    def load_layers(self):
+        """Load the saved mask of every label type for the current image into its layer"""
+        for label_type in self.label_types:
+            self.viewer.load_layer(label_type, self.load_label(self.label_path(label_type)))
+
+    @timed('goto image')
     def goto_image(self, idx):
         if len(self.src_paths) > 0:
-            if self.viewer.changed:
+            if len(self.viewer.changed_layers()) > 0:
                 result = self.show_save_warning()
                 if result == QMessageBox.Save:
                     self.saveSegmentation()
                 elif result == QMessageBox.Cancel:
                     self.image_idx.setValue(self.prev_idx, quiet=True)
+                    self.filmstrip.set_current_row(self.prev_idx - 1)
                     return
                 elif result == QMessageBox.Discard:
                     pass
+            self.invalidate_context()
             self.viewer.clear_history()
             self.current_idx = idx - 1
-            self.viewer.setPhoto(QPixmap(self.src_paths[self.current_idx]))
+            path = self.src_paths[self.current_idx]
+            if path in self.image_cache or not self.show_preview(path):
+                self.current_image = self.load_image(path)
+                if isinstance(self.current_image, ImagePyramid):
+                    self.viewer.setPyramid(self.current_image)
+                else:
+                    self.viewer.setPhoto(QPixmap.fromImage(self.current_image))
             image_name = os.path.basename(self.src_paths[self.current_idx])
             image_name, suff = os.path.splitext(image_name)
             self.image_title.setText(image_name)
-            self.current_label_path = os.path.join(self.label_dir, image_name + '_label.png')
-            if os.path.exists(self.current_label_path):
-                self.viewer.setSegLayer(QPixmap(self.current_label_path))
+            if self.project is not None:
+                self.project.set_session(current_image=os.path.basename(path))
+            self.current_label_path = self.label_path(self.label_options.currentText())
+            self.load_layers()
+            self.superpixels = None
+            self.viewer.set_superpixels(None)
+            self.request_superpixels()
             self.prev_idx = idx
+            self.filmstrip.set_current_row(self.current_idx)
+            self.prefetch()
+
+    def load_image(self, path):
+        """Get a decoded image from the cache, or decode it now if it was not prefetched. Returns None for missing files
+
+        Images over max_image_pixels are returned as an ImagePyramid instead, which is not cached.
+        """
+        image = self.image_cache.get(path)
+        if image is None and os.path.exists(path):
+            if image_pixels(path) > self.max_image_pixels:
+                QApplication.setOverrideCursor(Qt.WaitCursor)
+                try:
+                    with timed('open pyramid'):
+                        return ImagePyramid.open(path, self.pyramid_cache_dir,
+                                                 max_cache_bytes=self.pyramid_cache_bytes)
+                finally:
+                    QApplication.restoreOverrideCursor()
+            with timed('decode image'):
+                image = QImage(path)
+            self.image_cache.put(path, image)
+        return image
+
+    def load_label(self, path):
+        """Get a label mask as a class mask from the cache, or read it now. Returns None for missing files"""
+        label = self.image_cache.get(path)
+        if label is None and os.path.exists(path):
+            with timed('load mask'):
+                label = read_mask(path)
+            self.image_cache.put(path, label)
+        return label
+
+    def show_preview(self, path):
+        """Show a reduced resolution decode of an image that is much larger than the viewer, and load the rest later
+
+        Jpegs are decoded at the reduced size directly. The full image is decoded in the background and swapped in when
+        it's ready, or straight away if it's needed sooner. Returns False if no preview was shown.
+        """
+        reader = QImageReader(path)
+        # Formats without scaled decoding, like png, would have to be fully decoded for the preview anyway
+        if not reader.supportsOption(QImageIOHandler.ScaledSize):
+            return False
+        size = reader.size()
+        target = self.viewer.viewport().size()
+        if not size.isValid() or size.width() * size.height() > self.max_image_pixels:
+            return False
+        if size.width() < self.preview_factor * target.width() and size.height() < self.preview_factor * target.height():
+            return False
+        reader.setScaledSize(size.scaled(target, Qt.KeepAspectRatio))
+        with timed('decode preview'):
+            preview = reader.read()
+        if preview.isNull():
+            return False
+        self.current_image = None
+        self.viewer.setPhoto(QPixmap.fromImage(preview), full_size=size)
+        if path not in self.prefetching:
+            self.prefetching.add(path)
+            loader = ImageLoader([path], [], self.image_cache, max_pixels=self.max_image_pixels)
+            loader.signals.finished.connect(self.prefetched)
+            # Ahead of any queued prefetches
+            self.prefetch_pool.start(loader, 1)
+        return True
+
+    def load_full_image(self):
+        """Swap the preview for the full resolution image, decoding it now if the background load hasn't finished"""
+        if self.viewer.preview:
+            self.current_image = self.load_image(self.src_paths[self.current_idx])
+            self.viewer.swapPhoto(QPixmap.fromImage(self.current_image))
+
+    def prefetch(self):
+        """Load the images and masks up to prefetch_count steps either side of the current image in the background"""
+        image_paths = []
+        label_paths = []
+        for offset in range(1, self.prefetch_count + 1):
+            for idx in [self.current_idx + offset, self.current_idx - offset]:
+                if 0 <= idx < len(self.src_paths):
+                    image_paths.append(self.src_paths[idx])
+                    label_paths.extend(self.label_path(label_type, idx) for label_type in self.label_types)
+        image_paths = [path for path in image_paths if path not in self.prefetching and path not in self.image_cache]
+        label_paths = [path for path in label_paths if path not in self.prefetching and path not in self.image_cache]
+        if len(image_paths) + len(label_paths) > 0:
+            self.prefetching.update(image_paths)
+            self.prefetching.update(label_paths)
+            loader = ImageLoader(image_paths, label_paths, self.image_cache, max_pixels=self.max_image_pixels)
+            loader.signals.finished.connect(self.prefetched)
+            self.prefetch_pool.start(loader)
+
+    def request_superpixels(self, *args):
+        """Compute the current image's superpixels in the background if the superpixel brush or engine needs them"""
+        if self.current_idx is None or len(self.src_paths) == 0 or self.superpixels is not None:
+            return
+        if not self.superpixel_btn.isChecked() and not ENGINES[self.engine_options.currentText()].uses_superpixels:
+            return
+        path = self.src_paths[self.current_idx]
+        if path not in self.superpixels_pending:
+            self.superpixels_pending.add(path)
+            worker = SuperpixelWorker(path, self.superpixel_cache_dir)
+            worker.signals.finished.connect(self.superpixels_ready)
+            self.thread_pool.start(worker)
+
+    def superpixels_ready(self, path, superpixels):
+        self.superpixels_pending.discard(path)
+        if self.current_idx is not None and self.current_idx < len(self.src_paths) and self.src_paths[self.current_idx] == path:
+            self.superpixels = superpixels
+            self.viewer.set_superpixels(superpixels)
+
+    def prefetched(self, paths):
+        self.prefetching.difference_update(paths)
+        if self.viewer.preview and self.src_paths[self.current_idx] in paths:
+            self.load_full_image()
 
     def skipto_next(self):
-        # print(self.current_idx)
-        if self.current_idx < len(self.src_paths):
-            check_idx = self.current_idx
-            found = False
-            while check_idx < len(self.src_paths):
-                # print(check_idx, len(self.src_paths))
-                image_name = os.path.basename(self.src_paths[check_idx])
-                image_name, suff = os.path.splitext(image_name)
-                label_path = os.path.join(self.label_dir, image_name + '_label.png')
-                if os.path.exists(label_path):
-                    check_idx += 1
-                    continue
-                else:
-                    found = True
-                    break
-            if found:
+        if self.current_idx is not None and self.current_idx < len(self.src_paths):
+            check_idx = self.label_index.next_unlabelled(self.label_options.currentText(), self.current_idx)
+            if check_idx is not None:
                 self.image_idx.setValue(check_idx + 1)
             else:
                 return QMessageBox.warning(self, "Segmenter Tool", "No unlabeled images found for label type '{}'".format(self.label_options.currentText()),
                                    QMessageBox.Ok, QMessageBox.Ok)
 
     def skipto_next_label(self):
-        if self.current_idx < len(self.src_paths):
-            check_idx = self.current_idx + 1
-            found = False
-            while check_idx < len(self.src_paths):
-                image_name = os.path.basename(self.src_paths[check_idx])
-                image_name, suff = os.path.splitext(image_name)
-                label_path = os.path.join(self.label_dir, image_name + '_label.png')
-                if os.path.exists(label_path):
-                    found = True
-                    break
-                else:
-                    check_idx += 1
-                    continue
-            if found:
+        if self.current_idx is not None and self.current_idx < len(self.src_paths):
+            check_idx = self.label_index.next_labelled(self.label_options.currentText(), self.current_idx + 1)
+            if check_idx is not None:
                 self.image_idx.setValue(check_idx + 1)
             else:
                 return QMessageBox.warning(self, "Segmenter Tool", "No labeled images found for label type '{}'".format(self.label_options.currentText()),
                                    QMessageBox.Ok, QMessageBox.Ok)
 
+    def set_label_root(self, label_root):
+        watched = self.label_watcher.directories()
+        if len(watched) > 0:
+            self.label_watcher.removePaths(watched)
+        self.label_index.set_label_root(label_root)
+        for label_type in self.label_types:
+            folder = label_folder(label_root, label_type)
+            if os.path.isdir(folder):
+                self.label_watcher.addPath(folder)
+        self.store_label_status()
+        self.update_label_count()
+        self.sync_mask_stores()
+
+    def label_folder_changed(self, path):
+        self.changed_label_folders.add(os.path.normpath(path))
+        self.label_rescan_timer.start()
+
+    def rescan_label_folders(self):
+        """Update the label index from the folders that changed, which for the tool's own saves is already current"""
+        folders = self.changed_label_folders
+        self.changed_label_folders = set()
+        changed = {}
+        for label_type in self.label_types:
+            if os.path.normpath(label_folder(self.active_label_dir, label_type)) in folders:
+                indices = self.label_index.rescan(label_type)
+                if len(indices) > 0:
+                    changed[label_type] = indices
+        if len(changed) > 0:
+            self.store_label_status(changed=changed)
+            self.update_label_count()
+
+    def store_label_status(self, label_types=None, changed=None):
+        """Copy which images are labelled from the label index into the project store
+
+        changed maps label types to the indices of the only images whose status needs to be written.
+        """
+        if self.project is None or self.awaiting_first_image or self.dir_scanner is not None:
+            return
+        if changed is not None:
+            for label_type, indices in changed.items():
+                names = [(os.path.basename(self.src_paths[idx]), self.label_index.is_labelled(label_type, idx))
+                         for idx in indices]
+                self.project.update_labelled(label_type, [name for name, labelled in names if labelled],
+                                             [name for name, labelled in names if not labelled])
+            return
+        for label_type in label_types or self.label_types:
+            self.project.set_labelled(label_type, [os.path.basename(self.src_paths[idx])
+                                                   for idx in self.label_index.labelled[label_type]])
+
+    def update_label_count(self):
+        text = 'Labeled: {} / {}'.format(self.label_index.count(self.label_options.currentText()), len(self.src_paths))
+        if self.project is not None:
+            text += ' ({} today)'.format(len(self.project.labelled_today(self.label_options.currentText())))
+        self.label_count.setText(text)
+        self.filmstrip_model.refresh_status()
+
+    def filmstrip_clicked(self, index):
+        if index.row() + 1 != self.prev_idx:
+            self.image_idx.setValue(index.row() + 1)
+
     def goto_next(self):
         if self.prev_idx < len(self.src_paths):
             self.image_idx.setValue(self.prev_idx + 1)
@@ -380,64 +749,178 @@ class SegmenterWidget(QWidget):
         if self.prev_idx > 1:
             self.image_idx.setValue(self.prev_idx - 1)
 
+    @timed('save/snapshot')
     def saveSegmentation(self):
-        if self.viewer.hasPhoto():
-            segmentation = QImage_to_CVMat(self.viewer.seg_image)
-            cv2.imwrite(self.current_label_path, segmentation)
-            self.viewer.changed = False
+        """Save the mask of the current label type, and of any other label type with unsaved changes"""
+        # Until the new directory's images are listed, the label folders belong to it but the image doesn't
+        if self.viewer.hasPhoto() and not self.awaiting_first_image and self.current_idx is not None:
+            label_types = [self.label_options.currentText()]
+            label_types += [label_type for label_type in self.viewer.changed_layers() if label_type not in label_types]
+            for label_type in label_types:
+                path = os.path.join(ensure_dir(label_folder(self.active_label_dir, label_type)),
+                                    label_name(self.src_paths[self.current_idx]))
+                mask = self.viewer.layers[label_type].mask.copy()
+                saver = MaskSaver(path, mask, self.mask_format, self.png_compression, self.mask_store(label_type))
+                saver.signals.failed.connect(self.save_failed)
+                saver.signals.store_failed.connect(self.mask_store_failed)
+                self.save_pool.start(saver)
+                # Cached as saved, so coming back to this image doesn't have to wait for the write to finish
+                self.image_cache.put(path, mask)
+                self.label_index.set_labelled(label_type, self.current_idx)
+                if self.project is not None:
+                    self.project.record_edit(os.path.basename(self.src_paths[self.current_idx]), label_type)
+                self.viewer.layers[label_type].changed = False
+            self.update_label_count()
+
+    def save_failed(self, path, message):
+        self.image_cache.discard(path)
+        for label_type in self.label_types:
+            self.label_index.rescan(label_type)
+        self.store_label_status()
+        self.update_label_count()
+        for label_type in self.label_types:
+            if path == self.label_path(label_type):
+                self.viewer.layers[label_type].changed = True
+        QMessageBox.critical(self, "Segmenter Tool", "Could not save {}\n{}".format(path, message), QMessageBox.Ok)
+
+    def flush_saves(self):
+        """Block until every queued label file has been written"""
+        self.save_pool.waitForDone()
+
+    def set_mask_format(self, mask_format):
+        self.mask_format = mask_format
+
+    def set_png_compression(self, level):
+        self.png_compression = level
+
+    def set_use_mask_store(self, enabled):
+        self.use_mask_store = enabled
+        if self.project is not None:
+            self.project.set_session(mask_store='1' if enabled else '0')
+        self.sync_mask_stores()
+
+    def mask_store(self, label_type):
+        """The MaskStore of a label type's folder, or None if the mask store is off"""
+        if not self.use_mask_store or self.active_label_dir is None:
+            return None
+        path = store_dir(label_folder(self.active_label_dir, label_type))
+        if path not in self.mask_stores:
+            # A store that can't be opened is skipped, so it never stops the label files being saved
+            try:
+                self.mask_stores[path] = MaskStore(path)
+            except Exception as e:
+                QMessageBox.warning(self, "Segmenter Tool", str(e), QMessageBox.Ok)
+                return None
+        return self.mask_stores[path]
+
+    def sync_mask_stores(self):
+        """Add any masks saved while the store was off, or by other tools, to the current label folders' stores"""
+        stores = []
+        for label_type in self.label_types:
+            store = self.mask_store(label_type)
+            if store is not None:
+                stores.append((label_folder(self.active_label_dir, label_type), store))
+        if len(stores) > 0:
+            worker = MaskStoreSync(stores)
+            worker.signals.failed.connect(self.mask_store_failed)
+            self.save_pool.start(worker)
+
+    def mask_store_failed(self, label_dir, message):
+        QMessageBox.warning(self, "Segmenter Tool", "Could not update the mask store of {}\n{}".format(label_dir, message),
+                            QMessageBox.Ok)
+
+    def calibration_finished(self, costs):
+        self.latency_tuner.set_costs(costs)
+
+    def set_target_latency(self, milliseconds):
+        self.latency_tuner.set_target(milliseconds / 1000.0 if milliseconds > 0 else None)
+
+    def update_latency_box(self, engine):
+        # Only plain GrabCut has its resolution picked by the tuner
+        self.latency_label.setEnabled(engine == 'GrabCut')
+        self.latency_box.setEnabled(engine == 'GrabCut')
 
     def run_grabcut(self):
-        if self.viewer.hasPhoto():
-            # self.gc_spinner.start()
-            image = QImage_to_CVMat(QPixmap(self.src_paths[self.current_idx]).toImage())[:, :, :3]
-            segmentation = QImage_to_CVMat(self.viewer.seg_image)
-            rescale_factor = 0.125
-            image_height, image_width = image.shape[:2]
-            image = cv2.resize(image, (int(image_width * rescale_factor), int(image_height * rescale_factor)), interpolation=cv2.INTER_NEAREST)
-            new_segmentation = cv2.resize(segmentation, (int(image_width * rescale_factor), int(image_height * rescale_factor)), interpolation=cv2.INTER_NEAREST)
-
-            pfg, fg, bg, pbg = np.split(new_segmentation / 255, segmentation.shape[-1], axis=-1)
-            pbg = 1 - pbg
-            has_bg = (pbg.sum() + bg.sum()) > 0
-            has_fg = (pfg.sum() + fg.sum()) > 0
-            if not (has_bg and has_fg):
-                if not has_bg:
-                    message = 'You must select some background or empty area.'
-                elif not has_fg:
-                    message = 'You must select some foreground or possible foreground.'
-                x = QMessageBox.critical(self, "Segmenter Tool", message, QMessageBox.Ok)
-                # self.gc_spinner.stop()
-                return
+        if self.viewer.hasPhoto() and self.grabcut_worker is None:
+            self.load_full_image()
+            segmentation = self.viewer.mask.copy()
+            state = self.grabcut_states.get(self.grabcut_key(), GrabCutState())
+            image = self.current_image
+            if isinstance(image, ImagePyramid):
+                image = image.level(0)
+            engine = self.engine_options.currentText()
+            options = {}
+            if ENGINES[engine].uses_superpixels and self.superpixels is not None:
+                options['superpixels'] = self.superpixels
+            self.grabcut_tuning = None
+            if engine == 'GrabCut' and self.latency_tuner.target is not None:
+                shape = (image.height(), image.width()) if isinstance(image, QImage) else image.shape[:2]
+                options.update(self.latency_tuner.choose(shape))
+                self.grabcut_tuning = (shape, options, state.is_warm())
+            worker = GrabCutWorker(self.context_token, image, segmentation, engine=engine, state=state, options=options)
+            worker.signals.progress.connect(self.grabcut_progressed)
+            worker.signals.finished.connect(self.grabcut_finished)
+            worker.signals.failed.connect(self.grabcut_failed)
+            worker.signals.cancelled.connect(self.grabcut_cancelled)
+            self.grabcut_worker = worker
+            self.grabcut_button.setEnabled(False)
+            self.grabcut_progress.setRange(0, 0)
+            self.grabcut_progress.show()
+            self.cancel_grabcut_button.show()
+            self.grabcut_started = time.perf_counter()
+            self.thread_pool.start(worker)
+
+    def cancel_grabcut(self):
+        if self.grabcut_worker is not None:
+            self.grabcut_worker.cancel()
+            self.grabcut_worker = None
+            self.grabcut_stopped()
 
-            mask = (cv2.GC_FGD * fg + cv2.GC_BGD * bg + cv2.GC_PR_FGD * pfg + cv2.GC_PR_BGD * pbg).astype(np.uint8)
-            bgd_model = np.zeros((1, 65), np.float64)
-            fgd_model = np.zeros((1, 65), np.float64)
-            mask, _, _ = cv2.grabCut(image, mask, None, bgd_model, fgd_model, 2, cv2.GC_INIT_WITH_MASK)
-            pfg = np.where(mask == cv2.GC_PR_FGD, 255, 0) + np.where(mask == cv2.GC_FGD, 255, 0)
-            # fg = np.where(mask==cv2.GC_FGD, 255, 0)
-            # bg = np.where(mask==cv2.GC_BGD, 255, 0)
-            fg = np.zeros_like(pfg)
-            bg = np.zeros_like(pfg)
-            pbg = np.zeros_like(pfg)
-            # pbg = np.where(mask == cv2.GC_PR_BGD, 0, 255) + np.where(mask == cv2.GC_BGD)
-            # new_segmentation = np.concatenate([pfg, fg, bg, pbg], axis=2).astype(np.uint8)
-            new_segmentation = cv2.resize(pfg, (image_width, image_height), interpolation=cv2.INTER_NEAREST)
-            new_segmentation = new_segmentation - segmentation[:, :, 1]
-            new_segmentation = np.concatenate([new_segmentation[:, :, np.newaxis], segmentation[:, :, 1:3]], axis=2)
-            new_segmentation = np.concatenate([new_segmentation, new_segmentation.max(axis=2, keepdims=True)], axis=2)
-            # new_segmentation = cv2.resize(new_segmentation, (image_width, image_height), interpolation=cv2.INTER_NEAREST)
-            # new_segmentation[:, :, 0] = new_segmentation[:, :, 0] - segmentation[:, :, 1]
-            # new_segmentation[:, :, 1:3] = segmentation[:, :, 1:3]
-            # new_segmentation[:, :, 3] = new_segmentation.max(axis=2)
-            # new_segmentation = np.where((segmentation[:, :, 1:2] == 255) + (segmentation[:, :, 2:3] == 255), segmentation, new_segmentation)
-            tempdir = tempfile.mkdtemp()
-            temp_png = os.path.join(tempdir, 'grabcut.png')
-            cv2.imwrite(temp_png, new_segmentation)
-            self.viewer.setSegLayer(QPixmap(temp_png))
+    def grabcut_key(self):
+        return self.src_paths[self.current_idx], self.label_options.currentText()
+
+    def invalidate_context(self):
+        self.context_token += 1
+        self.cancel_grabcut()
+        self.grabcut_states.clear()
+
+    def grabcut_stopped(self):
+        self.grabcut_button.setEnabled(True)
+        self.grabcut_progress.hide()
+        self.cancel_grabcut_button.hide()
+
+    def grabcut_progressed(self, step, total):
+        self.grabcut_progress.setRange(0, total)
+        self.grabcut_progress.setValue(step)
+
+    def is_current_grabcut(self, worker):
+        return worker is self.grabcut_worker and worker.token == self.context_token
+
+    def grabcut_finished(self, worker, segmentation):
+        if self.is_current_grabcut(worker):
+            self.grabcut_worker = None
+            self.grabcut_stopped()
+            self.grabcut_states[self.grabcut_key()] = worker.state
+            seconds = time.perf_counter() - self.grabcut_started
+            if self.project is not None:
+                self.project.record_grabcut(os.path.basename(self.src_paths[self.current_idx]),
+                                            self.label_options.currentText(), worker.engine, seconds)
+            if self.grabcut_tuning is not None:
+                shape, options, warm = self.grabcut_tuning
+                self.latency_tuner.observe(shape, options['rescale_factor'], options['iterations'], seconds, warm)
+            self.viewer.setSegLayer(segmentation)
             self.viewer.changed = True
-            os.remove(temp_png)
-            os.removedirs(tempdir)
-            # self.gc_spinner.stop()
+
+    def grabcut_failed(self, worker, message):
+        if self.is_current_grabcut(worker):
+            self.grabcut_worker = None
+            self.grabcut_stopped()
+            QMessageBox.critical(self, "Segmenter Tool", message, QMessageBox.Ok)
+
+    def grabcut_cancelled(self, worker):
+        if self.is_current_grabcut(worker):
+            self.grabcut_worker = None
+            self.grabcut_stopped()
 
     def show_save_warning(self):
         return QMessageBox.warning(self, "Segmenter Tool", 'This segmentation has been modified.\nDo you want to save your changes?',
@@ -452,6 +935,9 @@ class SegmenterWindow(QMainWindow):
         self.menu = self.menuBar()
         self.file_menu = self.menu.addMenu("File")
         self.edit_menu = self.menu.addMenu("Edit")
+        self.debug_menu = self.menu.addMenu("Debug")
+        self.latency_dialog = None
+        self.profile_capture = ProfileCapture()
 
         save_action = QAction("Save", self)
         save_action.setShortcut("Ctrl+S")
@@ -469,7 +955,7 @@ class SegmenterWindow(QMainWindow):
         redo_action.setShortcut('Shift+Ctrl+Z')
         redo_action.triggered.connect(self.widget.viewer.redo)
 
-        grabcut_action = QAction("Run GrabCut", self)
+        grabcut_action = QAction("Run Segmenter", self)
         grabcut_action.setShortcut("Ctrl+G")
         grabcut_action.triggered.connect(self.widget.run_grabcut)
 
@@ -477,18 +963,118 @@ class SegmenterWindow(QMainWindow):
         hide_action.setShortcut("Shift+H")
         hide_action.triggered.connect(self.widget.viewer.hide_image)
 
+        outlines_action = QAction('Show Other Masks as Outlines', self)
+        outlines_action.setShortcut("Shift+O")
+        outlines_action.setCheckable(True)
+        outlines_action.toggled.connect(self.widget.viewer.set_show_outlines)
+
+        filmstrip_action = QAction('Show Filmstrip', self)
+        filmstrip_action.setShortcut("Shift+F")
+        filmstrip_action.setCheckable(True)
+        filmstrip_action.setChecked(True)
+        filmstrip_action.toggled.connect(self.widget.filmstrip.setVisible)
+
+        mask_format_group = QActionGroup(self)
+        for mask_format in MASK_FORMATS:
+            format_action = QAction(mask_format, self)
+            format_action.setCheckable(True)
+            format_action.setChecked(mask_format == self.widget.mask_format)
+            format_action.triggered.connect(lambda checked, mask_format=mask_format: self.widget.set_mask_format(mask_format))
+            mask_format_group.addAction(format_action)
+
+        compression_group = QActionGroup(self)
+        for level in PNG_COMPRESSION_LEVELS:
+            compression_action = QAction(str(level), self)
+            compression_action.setCheckable(True)
+            compression_action.setChecked(level == self.widget.png_compression)
+            compression_action.triggered.connect(lambda checked, level=level: self.widget.set_png_compression(level))
+            compression_group.addAction(compression_action)
+
+        self.mask_store_action = QAction("Keep Mask Store", self)
+        self.mask_store_action.setCheckable(True)
+        self.mask_store_action.toggled.connect(self.widget.set_use_mask_store)
+        # The setting belongs to the image folder, so it can change whenever another folder is opened
+        self.file_menu.aboutToShow.connect(self.update_mask_store_action)
+
         self.file_menu.addAction(save_action)
+        self.file_menu.addAction(self.mask_store_action)
+        mask_format_menu = self.file_menu.addMenu("Mask Format")
+        mask_format_menu.addActions(mask_format_group.actions())
+        compression_menu = self.file_menu.addMenu("PNG Compression")
+        compression_menu.addActions(compression_group.actions())
         self.file_menu.addAction(exit_action)
         self.edit_menu.addAction(undo_action)
         self.edit_menu.addAction(redo_action)
         self.edit_menu.addAction(grabcut_action)
         self.edit_menu.addAction(hide_action)
+        self.edit_menu.addAction(outlines_action)
+        self.edit_menu.addAction(filmstrip_action)
+
+        latency_action = QAction("Latency Report", self)
+        latency_action.setShortcut("Ctrl+Shift+L")
+        latency_action.triggered.connect(self.show_latency_report)
+
+        save_latency_action = QAction("Save Latency Log...", self)
+        save_latency_action.triggered.connect(self.save_latency_log)
+
+        self.profile_action = QAction("Capture cProfile", self)
+        self.profile_action.setCheckable(True)
+        self.profile_action.toggled.connect(self.toggle_profile)
+
+        self.debug_menu.addAction(latency_action)
+        self.debug_menu.addAction(save_latency_action)
+        self.debug_menu.addAction(self.profile_action)
+
+        # The status bar shows the latest timed operation
+        self.last_latency = None
+        self.latency_timer = QTimer(self)
+        self.latency_timer.timeout.connect(self.update_latency_status)
+        self.latency_timer.start(500)
 
         self.setCentralWidget(self.widget)
 
+    def update_mask_store_action(self):
+        self.mask_store_action.blockSignals(True)
+        self.mask_store_action.setChecked(self.widget.use_mask_store)
+        self.mask_store_action.blockSignals(False)
+
+    def update_latency_status(self):
+        latest = recorder.latest
+        if latest is None or latest is self.last_latency:
+            return
+        self.last_latency = latest
+        name, seconds = latest
+        summary = recorder.summary(name)
+        self.statusBar().showMessage('{}: {:.1f} ms (p50 {:.1f} ms, p95 {:.1f} ms)'.format(
+            name, seconds * 1000, summary['p50_ms'], summary['p95_ms']))
+
+    def show_latency_report(self):
+        if self.latency_dialog is None:
+            self.latency_dialog = LatencyDialog(recorder, self)
+        self.latency_dialog.show()
+        self.latency_dialog.raise_()
+
+    def save_latency_log(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Save Latency Log', 'latency.json', 'JSON (*.json);;CSV (*.csv)')
+        if path:
+            try:
+                recorder.dump(path)
+            except OSError as e:
+                QMessageBox.critical(self, "Segmenter Tool", "Could not save {}\n{}".format(path, e), QMessageBox.Ok)
+
+    def toggle_profile(self, checked):
+        if checked:
+            self.profile_capture.start()
+            return
+        path, _ = QFileDialog.getSaveFileName(self, 'Save Profile', 'segmenter.prof', 'Profile (*.prof)')
+        try:
+            self.profile_capture.stop(path or None)
+        except OSError as e:
+            QMessageBox.critical(self, "Segmenter Tool", "Could not save {}\n{}".format(path, e), QMessageBox.Ok)
+
     @Slot()
     def exit_app(self, checked):
-        if self.widget.viewer.changed:
+        if len(self.widget.viewer.changed_layers()) > 0:
             result = self.widget.show_save_warning()
             if result == QMessageBox.Save:
                 self.widget.saveSegmentation()
@@ -496,4 +1082,11 @@ class SegmenterWindow(QMainWindow):
                 return
             elif result == QMessageBox.Discard:
                 pass
+        self.widget.flush_saves()
+        self.widget.thumbnail_loader.shutdown()
         QApplication.quit()
+
+    def closeEvent(self, event):
+        self.widget.flush_saves()
+        self.widget.thumbnail_loader.shutdown()
+        super(SegmenterWindow, self).closeEvent(event)
@@ -0,0 +1,264 @@
+import collections
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import cv2
+import numpy as np
+
+from .DiskCache import prune_cache, touch
+from .Pyramid import decode_reduced
+
+# Bumped whenever the labels computed for an image would change, so old cache files are not reused
+SUPERPIXEL_VERSION = 1
+
+
+def _watershed_labels(image, region_size):
+    """Over-segment a BGR image by flooding the colour gradient from a grid of markers
+
+    Used when OpenCV is built without the contrib ximgproc module that has SLIC.
+    """
+    height, width = image.shape[:2]
+    markers = np.zeros((height, width), np.int32)
+    ys = np.arange(region_size // 2, height, region_size)
+    xs = np.arange(region_size // 2, width, region_size)
+    markers[np.ix_(ys, xs)] = np.arange(1, len(ys) * len(xs) + 1, dtype=np.int32).reshape(len(ys), len(xs))
+    cv2.watershed(cv2.GaussianBlur(image, (3, 3), 0), markers)
+    # The pixels between regions are marked -1, give them the label of a neighbouring region
+    lines = markers <= 0
+    markers[lines] = 0
+    neighbours = cv2.dilate(markers.astype(np.float32), np.ones((3, 3), np.uint8)).astype(np.int32)
+    markers[lines] = neighbours[lines]
+    return np.maximum(markers - 1, 0)
+
+
+def _slic_labels(lab, region_size):
+    slic = cv2.ximgproc.createSuperpixelSLIC(lab, cv2.ximgproc.SLICO, region_size)
+    slic.iterate(10)
+    slic.enforceLabelConnectivity()
+    return slic.getLabels()
+
+
+def _relabel(labels):
+    """Renumber labels to 0 .. n - 1 without gaps"""
+    present = np.bincount(labels.ravel()) > 0
+    remap = (np.cumsum(present) - 1).astype(np.int32)
+    return remap[labels]
+
+
+class Superpixels(object):
+    """Over-segmentation of an image into small regions that follow its edges, and the graph of adjacent regions
+
+    Labels are computed at a working resolution of at most max_pixels and map onto the full resolution image by
+    nearest neighbour, so a region covers the same block of full resolution pixels wherever it is looked up. Each
+    region has its pixel count, mean Lab colour and bounding box, and each pair of touching regions an edge weighted by
+    the length of their shared boundary.
+    """
+    def __init__(self, labels, full_shape, colors):
+        self.labels = labels
+        self.full_shape = tuple(full_shape)
+        height, width = labels.shape
+        self.count = int(labels.max()) + 1
+        # Working resolution row and column of each full resolution row and column, the same mapping as INTER_NEAREST
+        self.row_map = (np.arange(self.full_shape[0], dtype=np.int64) * height // self.full_shape[0]).astype(np.int32)
+        self.col_map = (np.arange(self.full_shape[1], dtype=np.int64) * width // self.full_shape[1]).astype(np.int32)
+
+        flat = labels.ravel()
+        self.sizes = np.bincount(flat, minlength=self.count).astype(np.float64)
+        self.colors = colors
+
+        ys, xs = np.divmod(np.arange(flat.size, dtype=np.int32), width)
+        self.bboxes = np.empty((self.count, 4), np.int32)
+        self.bboxes[:, 0:2] = np.iinfo(np.int32).max
+        self.bboxes[:, 2:4] = -1
+        np.minimum.at(self.bboxes[:, 0], flat, xs)
+        np.minimum.at(self.bboxes[:, 1], flat, ys)
+        np.maximum.at(self.bboxes[:, 2], flat, xs + 1)
+        np.maximum.at(self.bboxes[:, 3], flat, ys + 1)
+
+        pairs = [(labels[:, :-1], labels[:, 1:]), (labels[:-1, :], labels[1:, :])]
+        keys = []
+        for first, second in pairs:
+            differs = first != second
+            low = np.minimum(first[differs], second[differs]).astype(np.int64)
+            high = np.maximum(first[differs], second[differs]).astype(np.int64)
+            keys.append(low * self.count + high)
+        keys, lengths = np.unique(np.concatenate(keys), return_counts=True)
+        self.edges = np.stack([keys // self.count, keys % self.count], axis=1).astype(np.int32)
+        self.edge_lengths = lengths.astype(np.float64)
+
+    @classmethod
+    def compute(cls, image, full_shape=None, max_pixels=2000000, num_superpixels=3000):
+        """Over-segment a BGR image, reducing it to max_pixels first. full_shape defaults to the image's own size"""
+        if full_shape is None:
+            full_shape = image.shape[:2]
+        height, width = image.shape[:2]
+        if height * width > max_pixels:
+            scale = (max_pixels / float(height * width)) ** 0.5
+            image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+            height, width = image.shape[:2]
+        region_size = max(8, int((height * width / float(num_superpixels)) ** 0.5))
+        lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+        if hasattr(cv2, 'ximgproc'):
+            labels = _slic_labels(lab, region_size)
+        else:
+            labels = _watershed_labels(image, region_size)
+        labels = _relabel(labels)
+        flat = labels.ravel()
+        sizes = np.maximum(np.bincount(flat), 1)
+        lab = lab.reshape(-1, 3).astype(np.float64)
+        colors = np.stack([np.bincount(flat, weights=lab[:, channel]) for channel in range(3)], axis=1) / sizes[:, None]
+        return cls(labels, full_shape, colors)
+
+    @classmethod
+    def open(cls, path, cache_dir=None, max_pixels=2000000, max_cache_bytes=1024 ** 3):
+        """Load the superpixels of an image file from cache_dir, or compute and store them. Returns None if unreadable
+
+        Only a reduced decode of the image is needed, which jpegs can do directly. A cache file that can't be read is
+        computed again, and the least recently used files are removed once the cache is over max_cache_bytes.
+        """
+        cache_path = None
+        if cache_dir is not None:
+            stat = os.stat(path)
+            key = '{}|{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, max_pixels,
+                                          SUPERPIXEL_VERSION)
+            cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+            try:
+                with np.load(cache_path) as data:
+                    superpixels = cls(data['labels'], data['full_shape'], data['colors'])
+                touch(cache_path)
+                return superpixels
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                pass
+        image, full_shape = decode_reduced(path, max_pixels)
+        if image is None:
+            return None
+        superpixels = cls.compute(image, full_shape, max_pixels)
+        if cache_path is not None:
+            superpixels._store(cache_path)
+            if max_cache_bytes is not None:
+                prune_cache(cache_dir, max_cache_bytes, keep=[cache_path])
+        return superpixels
+
+    def _store(self, cache_path):
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(cache_path))
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(f, labels=self.labels, full_shape=np.array(self.full_shape), colors=self.colors)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
+    def labels_in_rect(self, x0, y0, x1, y1):
+        """Labels of the full resolution pixels in [x0, x1) x [y0, y1)"""
+        return self.labels[self.row_map[y0:y1]][:, self.col_map[x0:x1]]
+
+    def full_bounds(self, ids):
+        """Full resolution (x0, y0, x1, y1) covering every region in ids"""
+        boxes = self.bboxes[ids]
+        x0, y0 = boxes[:, 0].min(), boxes[:, 1].min()
+        x1, y1 = boxes[:, 2].max(), boxes[:, 3].max()
+        return (int(np.searchsorted(self.col_map, x0)), int(np.searchsorted(self.row_map, y0)),
+                int(np.searchsorted(self.col_map, x1)), int(np.searchsorted(self.row_map, y1)))
+
+    def to_full(self, values):
+        """Full resolution image of a per-region array"""
+        return np.take(np.take(values[self.labels], self.row_map, axis=0), self.col_map, axis=1)
+
+    def class_counts(self, segmentation, classes):
+        """(count, len(classes)) array of how many full resolution pixels of each class fall in each region"""
+        counts = np.zeros((self.count, len(classes)), np.int64)
+        for idx, value in enumerate(classes):
+            ys, xs = np.nonzero(segmentation == value)
+            if len(ys) > 0:
+                counts[:, idx] = np.bincount(self.labels[self.row_map[ys], self.col_map[xs]], minlength=self.count)
+        return counts
+
+
+def min_cut(source_caps, sink_caps, edges, edge_caps):
+    """Minimum cut between a source and a sink joined to every node, with undirected edges between nodes
+
+    Solved with Dinic's max-flow algorithm, which is quick enough for graphs of a few thousand superpixels. Returns a
+    boolean array that is True for the nodes left on the source side.
+    """
+    num_nodes = len(source_caps)
+    source, sink = num_nodes, num_nodes + 1
+    # Flow straight from the source through a node to the sink doesn't need a search
+    direct = np.minimum(source_caps, sink_caps)
+    adjacency = [[] for _ in range(num_nodes + 2)]
+    heads = []
+    caps = []
+
+    def add_arc(u, v, forward, backward):
+        adjacency[u].append(len(heads))
+        heads.append(v)
+        caps.append(forward)
+        adjacency[v].append(len(heads))
+        heads.append(u)
+        caps.append(backward)
+
+    for node, cap in enumerate((source_caps - direct).tolist()):
+        if cap > 0:
+            add_arc(source, node, cap, 0.0)
+    for node, cap in enumerate((sink_caps - direct).tolist()):
+        if cap > 0:
+            add_arc(node, sink, cap, 0.0)
+    for (u, v), cap in zip(edges.tolist(), edge_caps.tolist()):
+        add_arc(u, v, cap, cap)
+
+    eps = 1e-9
+    while True:
+        level = [-1] * (num_nodes + 2)
+        level[source] = 0
+        queue = collections.deque([source])
+        while queue:
+            u = queue.popleft()
+            for arc in adjacency[u]:
+                if caps[arc] > eps and level[heads[arc]] < 0:
+                    level[heads[arc]] = level[u] + 1
+                    queue.append(heads[arc])
+        if level[sink] < 0:
+            break
+        next_arc = [0] * (num_nodes + 2)
+        path = []
+        u = source
+        while True:
+            if u == sink:
+                flow = min(caps[arc] for arc in path)
+                for arc in path:
+                    caps[arc] -= flow
+                    caps[arc ^ 1] += flow
+                path = []
+                u = source
+                continue
+            arcs = adjacency[u]
+            while next_arc[u] < len(arcs):
+                arc = arcs[next_arc[u]]
+                if caps[arc] > eps and level[heads[arc]] == level[u] + 1:
+                    break
+                next_arc[u] += 1
+            if next_arc[u] < len(arcs):
+                arc = arcs[next_arc[u]]
+                path.append(arc)
+                u = heads[arc]
+            elif u == source:
+                break
+            else:
+                # Dead end, so nothing more can get through this node in this phase
+                level[u] = -1
+                arc = path.pop()
+                u = heads[arc ^ 1]
+                next_arc[u] += 1
+
+    reachable = np.zeros(num_nodes + 2, dtype=bool)
+    reachable[source] = True
+    queue = collections.deque([source])
+    while queue:
+        u = queue.popleft()
+        for arc in adjacency[u]:
+            if caps[arc] > eps and not reachable[heads[arc]]:
+                reachable[heads[arc]] = True
+                queue.append(heads[arc])
+    return reachable[:num_nodes]
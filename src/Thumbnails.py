@@ -0,0 +1,63 @@
+import hashlib
+import os
+import tempfile
+
+import cv2
+
+from .Pyramid import decode_reduced
+
+# Bumped whenever the thumbnails made for an image would change, so old cache files are not reused
+THUMBNAIL_VERSION = 1
+
+
+def thumbnail_path(cache_dir, image_path, size):
+    """Cache file for the thumbnail of an image, keyed by its path, size and modification time
+
+    Returns None if the image can't be found.
+    """
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    key = '{}|{}|{}|{}|{}'.format(os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns, size, THUMBNAIL_VERSION)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    # Split over subfolders so that no folder gets too many files for large image sets
+    return os.path.join(cache_dir, digest[:2], digest + '.jpg')
+
+
+def _init_worker():
+    # Each process decodes its own image, so OpenCV's internal threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def make_thumbnail(job):
+    """Decode an image at reduced resolution, shrink it to fit in size x size and store it as a jpeg at cache_path
+
+    Run in a process pool. Returns (image path, cache path, error message or None).
+    """
+    image_path, cache_path, size = job
+    try:
+        image, _ = decode_reduced(image_path, size * size)
+        if image is None:
+            raise ValueError('Could not read image')
+        height, width = image.shape[:2]
+        scale = min(1.0, size / float(max(height, width)))
+        if scale < 1:
+            image = cv2.resize(image, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                               interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if not ok:
+            raise ValueError('Could not encode thumbnail')
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_path))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(encoded.tobytes())
+            os.replace(temp_path, cache_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    except (OSError, ValueError, cv2.error) as e:
+        return image_path, cache_path, str(e) or type(e).__name__
+    return image_path, cache_path, None
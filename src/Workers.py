@@ -0,0 +1,268 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PySide2.QtCore import QObject, QRunnable, Signal
+from PySide2.QtGui import QImage
+
+from .AutoTune import calibrate
+from .Conversions import qimage_to_bgr
+from .Engines import ENGINES
+from .GrabCut import GrabCutCancelled
+from .Manifest import IMAGE_FORMATS
+from .Masks import read_mask, write_mask
+from .MaskStore import mask_key
+from .Profiling import timed
+from .Pyramid import image_pixels
+from .Superpixels import Superpixels
+
+
+class DirectoryScanSignals(QObject):
+    found = Signal(object, object)
+    finished = Signal(object)
+
+
+class DirectoryScanner(QRunnable):
+    """Revalidates a DirectoryManifest and sniffs new or changed files in parallel
+
+    found is emitted with the scanner and a list of image paths, first for every image already in the manifest and
+    then in batches as newly sniffed images come in. The manifest is saved once the scan completes.
+    """
+    def __init__(self, manifest, max_workers=8, batch_interval=0.25):
+        super(DirectoryScanner, self).__init__()
+        self.manifest = manifest
+        self.max_workers = max_workers
+        self.batch_interval = batch_interval
+        self.signals = DirectoryScanSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @timed('directory scan')
+    def run(self):
+        try:
+            to_sniff = self.manifest.revalidate()
+        except OSError:
+            self.signals.finished.emit(self)
+            return
+        self.signals.found.emit(self, self.manifest.image_paths())
+        batch = []
+        last_emit = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.manifest.sniff, *args): args[0] for args in to_sniff}
+            for future in as_completed(futures):
+                if self._cancelled:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                name = futures[future]
+                entry = future.result()
+                self.manifest.entries[name] = entry
+                if entry['format'] in IMAGE_FORMATS:
+                    batch.append(os.path.join(self.manifest.image_dir, name))
+                if len(batch) > 0 and time.time() - last_emit > self.batch_interval:
+                    self.signals.found.emit(self, batch)
+                    batch = []
+                    last_emit = time.time()
+        if not self._cancelled:
+            if len(batch) > 0:
+                self.signals.found.emit(self, batch)
+            self.manifest.save()
+        self.signals.finished.emit(self)
+
+
+class GrabCutSignals(QObject):
+    progress = Signal(int, int)
+    finished = Signal(object, object)
+    failed = Signal(object, str)
+    cancelled = Signal(object)
+
+
+class SuperpixelSignals(QObject):
+    finished = Signal(str, object)
+
+
+class SuperpixelWorker(QRunnable):
+    """Loads or computes the superpixels of an image file in the background
+
+    finished is emitted with the path and the Superpixels, or None if the image couldn't be read.
+    """
+    def __init__(self, path, cache_dir=None):
+        super(SuperpixelWorker, self).__init__()
+        self.path = path
+        self.cache_dir = cache_dir
+        self.signals = SuperpixelSignals()
+
+    @timed('superpixels')
+    def run(self):
+        try:
+            superpixels = Superpixels.open(self.path, self.cache_dir)
+        except Exception:
+            # Always reported, as the path stays pending until it is
+            superpixels = None
+        self.signals.finished.emit(self.path, superpixels)
+
+
+class CalibrationSignals(QObject):
+    finished = Signal(object)
+
+
+class CalibrationWorker(QRunnable):
+    """Measures how fast GrabCut runs on this machine in the background
+
+    finished is emitted with the costs from AutoTune.calibrate(), to be given to a LatencyTuner on the UI thread.
+    """
+    def __init__(self):
+        super(CalibrationWorker, self).__init__()
+        self.signals = CalibrationSignals()
+
+    @timed('autotune calibration')
+    def run(self):
+        self.signals.finished.emit(calibrate())
+
+
+class ImageLoaderSignals(QObject):
+    finished = Signal(object)
+
+
+class ImageLoader(QRunnable):
+    """Decodes images and label masks into an ImageCache in the background
+
+    Images are decoded as QImages and labels as class masks. Paths are loaded in the given order, and missing files
+    and images over max_pixels (which are viewed from a pyramid instead) are skipped. finished is emitted with the
+    list of all paths once they have all been tried. Anything put in the cache while a path was being decoded, such as
+    a mask that was just saved, is kept rather than replaced with what was read from the file.
+    """
+    def __init__(self, image_paths, label_paths, cache, max_pixels=None):
+        super(ImageLoader, self).__init__()
+        self.image_paths = image_paths
+        self.label_paths = label_paths
+        self.cache = cache
+        self.max_pixels = max_pixels
+        self.signals = ImageLoaderSignals()
+
+    def run(self):
+        for path in self.image_paths:
+            if path not in self.cache and os.path.exists(path):
+                if self.max_pixels is not None and image_pixels(path) > self.max_pixels:
+                    continue
+                self.cache.add(path, QImage(path))
+        for path in self.label_paths:
+            if path not in self.cache and os.path.exists(path):
+                self.cache.add(path, read_mask(path))
+        self.signals.finished.emit(self.image_paths + self.label_paths)
+
+
+class MaskSaveSignals(QObject):
+    saved = Signal(str)
+    failed = Signal(str, str)
+    # The mask store folder and error, when the file was written but the mask couldn't be added to the store
+    store_failed = Signal(str, str)
+
+
+class MaskSaver(QRunnable):
+    """Encodes and writes a label mask in the background
+
+    mask should be a copy that nothing else modifies. The file is replaced atomically, so savers for the same path
+    must run in order on a single thread pool. If a MaskStore is given, the mask is also stored in it once the file
+    is written, and the store must only be written to from that same pool. A store that can't be updated doesn't fail
+    the save, it is reported with store_failed.
+    """
+    def __init__(self, path, mask, mask_format='RGBA', compression=3, store=None):
+        super(MaskSaver, self).__init__()
+        self.path = path
+        self.mask = mask
+        self.mask_format = mask_format
+        self.compression = compression
+        self.store = store
+        self.signals = MaskSaveSignals()
+
+    @timed('save/write')
+    def run(self):
+        try:
+            write_mask(self.path, self.mask, self.mask_format, self.compression)
+        except (OSError, ValueError) as e:
+            self.signals.failed.emit(self.path, str(e))
+            return
+        self.signals.saved.emit(self.path)
+        if self.store is not None:
+            try:
+                with timed('save/store'):
+                    self.store.put(mask_key(self.path), self.mask)
+            except (OSError, ValueError) as e:
+                self.signals.store_failed.emit(self.store.path, str(e))
+
+
+class MaskStoreSync(QRunnable):
+    """Brings the MaskStores of label folders up to date with their png files in the background
+
+    Runs on the same single thread pool as the MaskSavers that write to the stores. failed is emitted with the label
+    folder and the error for any store that couldn't be updated.
+    """
+    def __init__(self, stores):
+        super(MaskStoreSync, self).__init__()
+        # (label folder, MaskStore) pairs
+        self.stores = stores
+        self.signals = MaskSaveSignals()
+
+    @timed('mask store sync')
+    def run(self):
+        for label_dir, store in self.stores:
+            try:
+                if os.path.isdir(label_dir):
+                    store.sync_pngs(label_dir)
+            except (OSError, ValueError) as e:
+                self.signals.failed.emit(label_dir, str(e))
+            else:
+                self.signals.saved.emit(label_dir)
+
+
+class GrabCutWorker(QRunnable):
+    """Runs a segmentation engine, such as GrabCut, off the UI thread
+
+    token identifies the image/label context the job was started for so that stale results can be discarded. Every
+    signal passes the worker itself first, and the result is handed back as a class mask. After a successful run,
+    state holds the updated GrabCutState. image is a QImage, or a BGR array for images viewed from a pyramid. options
+    are passed on to the engine, such as precomputed superpixels.
+    """
+    def __init__(self, token, image, segmentation, engine='GrabCut', state=None, options=None):
+        super(GrabCutWorker, self).__init__()
+        self.token = token
+        self.image = image
+        self.segmentation = segmentation
+        self.engine = engine
+        self.options = options or {}
+        # Private copy so that a cancelled or stale job cannot touch the cached state
+        self.state = state.copy() if state is not None else None
+        self.signals = GrabCutSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    @timed('segment')
+    def run(self):
+        try:
+            with timed('segment/decode'):
+                if isinstance(self.image, QImage):
+                    image = qimage_to_bgr(self.image)
+                else:
+                    image = self.image
+            new_segmentation = ENGINES[self.engine].segment(image, self.segmentation,
+                                                            state=self.state,
+                                                            progress=self.signals.progress.emit,
+                                                            is_cancelled=self.is_cancelled,
+                                                            **self.options)
+        except GrabCutCancelled:
+            self.signals.cancelled.emit(self)
+        except ValueError as e:
+            self.signals.failed.emit(self, str(e))
+        except Exception as e:
+            # Anything else, e.g. an OpenCV error or a broken process pool, still has to free up the segmenter
+            self.signals.failed.emit(self, str(e) or type(e).__name__)
+        else:
+            self.signals.finished.emit(self, new_segmentation)